@@ -0,0 +1,11 @@
+import os
+
+### Settings picked up by `gunicorn app:app` when run from the repository root
+### With PROMETHEUS_MULTIPROC_DIR set every worker leaves its samples in that directory, a worker that exits
+### has to be marked dead or its gauges and live counts stay in /metrics for good (see metrics.py)
+
+
+def child_exit(server, worker):
+    if os.getenv("PROMETHEUS_MULTIPROC_DIR"):
+        from prometheus_client import multiprocess
+        multiprocess.mark_process_dead(worker.pid)
@@ -1,12 +1,14 @@
 from urllib.parse import urlparse
-import psycopg, os, json
+import asyncio, os, json
+import httpx
 from dotenv import load_dotenv
-from flask import Flask, g, redirect, url_for, render_template, request
+from flask import Flask, g, redirect, url_for, render_template, request, make_response, abort, Response
 from flask_login import LoginManager, login_required, current_user, login_user, logout_user
-from library_manager import discogs
+from library_manager import discogs, discogs_async, background, database, images, cli, reference_cache, search_cache, metrics, profiler, export
 from onelogin.saml2.auth import OneLogin_Saml2_Auth
 from library_manager.classes import User, AlbumEntry
-import dbq
+from library_manager.exceptions import DiscogsRateLimitError
+from library_manager import dbq
 
 #TODO: Handle actual error handling and logging...
 #TODO: Implement user error responses
@@ -14,9 +16,17 @@ import dbq
 
 
 load_dotenv()
-DATABASE_URL = os.getenv("DATABASE_URL")
 app = Flask(__name__)
 app.secret_key = os.getenv("SECRET_KEY")
+#Server-Timing header and Prometheus histograms for every route, hooked in before the DB setup below
+metrics.init_app(app)
+
+app.cli.add_command(cli.backfill_thumbnails)
+app.cli.add_command(cli.bulk_intake)
+app.cli.add_command(cli.rebuild_album_summary)
+app.cli.add_command(cli.run_benchmark)
+app.cli.add_command(cli.generate_catalog)
+app.cli.add_command(cli.export_catalog)
 
 login_manager = LoginManager()
 login_manager.init_app(app)
@@ -52,22 +62,22 @@ async def test_login_staff():
         login_user(user)
     return redirect(url_for('home'))
 
-### DB Setup and Teardown to keep connections fresh
-async def init_db():
-    return await psycopg.AsyncConnection.connect(DATABASE_URL)
-
-async def close_db(conn):
-    await conn.close()
+### DB Setup and Teardown, each request borrows a pooled connection and hands it back
+#Endpoints that borrow their own connection for as long as they need it (streamed responses), holding
+#g.db as well would tie up two connections for the whole download
+OWN_CONNECTION = {"export_catalog"}
 
 @app.before_request
 async def before_req():
-    g.db = await init_db()
+    if request.endpoint in OWN_CONNECTION:
+        return
+    g.db = await database.getconn()
 
 @app.teardown_request
 async def teardown(exception):
-    db = g.get('db', None)
+    db = g.pop('db', None)
     if db is not None:
-        await close_db(db)
+        await database.putconn(db)
 
 ### Login Logic
 ## This hasn't been tested yet
@@ -88,31 +98,17 @@ def prepare_flask_request(request_details):
 
 @login_manager.user_loader
 def load_user(user_id):
-#login manager doesn't like async so we have to do this this way
+#login manager doesn't like async so the lookup runs on the pool's own event loop
 #This works in the context of testing, however it might not work with SAML
-    with psycopg.Connection.connect(DATABASE_URL) as conn:
-        with conn.cursor() as cur:
-            cur.execute(
-                """
-                SELECT userid, firstname, lastname, email, role
-                FROM users
-                WHERE userid = %s
-                """,
-                (user_id,),
-            )
-            user_data = cur.fetchone()
-
-            if user_data:
-                uid = user_data[0]
-                # print(uid)
-                return User(
-                    str(uid),
-                    user_data[1],
-                    user_data[2],
-                    user_data[3],
-                    user_data[4],
-                )
-    return None
+#Users are cached per worker, the users/invitedusers triggers drop the entry as soon as a role, email or invite changes
+#A miss reads the user on the connection the request already holds (before_req runs first), borrowing a second
+#one per request would halve the pool and can leave requests waiting on each other until the pool times out
+    conn = g.get('db', None)
+    if conn is None:
+        load = lambda: database.wait(dbq.getUser, user_id)
+    else:
+        load = lambda: dbq.getUser(conn, user_id)
+    return background.run(reference_cache.cache.get("users", user_id, load, ttl=reference_cache.USER_TTL))
 
 
 @app.route("/login")
@@ -170,9 +166,10 @@ def logout():
 @app.route("/")
 @app.route("/search")
 async def home():
-    # Pagination: what order of entries to show, defaults to 0 shows first 50 entries
-    # Default could be changed in searchlibrary function
-    pagination = int(request.args.get('pagination', 0))
+    # Pagination: opaque keyset tokens, "after" pages forward from a row and "before" pages back
+    # No token shows the first 50 entries, page size could be changed in searchlibrary function
+    after = request.args.get('after', None)
+    before = request.args.get('before', None)
     #Album search parameter, defaults to empty string
     album_search = request.args.get('album', '')
     #Artist search parameter, defaults to empty string
@@ -183,17 +180,20 @@ async def home():
     track_search = request.args.get('track', '')
 
     conn = g.db
-    albums = await dbq.searchlibrary(conn, album_search, artist_search, genre_search, track_search, pagination)
-    #album returns as a tuple so to decode the image bytes we need to convert it to a list
-    albums = list(albums)
-    # Decode image bytes to str if they exist
-    # albums1 is named albums1 because albums is the name of the album detail route
-    for i, album1 in enumerate(albums):
-        album1 = list(album1)
-        if album1[4] is not None and isinstance(album1[4], bytes):
-            album1[4] = album1[4].decode('utf-8')
-        albums[i] = album1
-    return render_template("home.html", albums=albums, pagination=pagination)
+    backward = after is None and before is not None
+    cursor = dbq.decodeCursor(before if backward else after)
+    # A bad token just starts from the first page
+    if cursor is None:
+        backward = False
+    # Pages are cached per worker until the next album add, edit or delete
+    albums, more = await search_cache.search(conn, album_search, artist_search, genre_search, track_search, cursor, backward)
+    # Going forward there is a previous page whenever we started from a token, going backward there is always a next page
+    has_prev = more if backward else cursor is not None
+    has_next = True if backward else more
+    prev_cursor = dbq.encodeCursor(albums[0]) if albums and has_prev else None
+    next_cursor = dbq.encodeCursor(albums[-1]) if albums and has_next else None
+    # Album art is not part of the listing, each <img> loads it from album_art so the browser can cache it
+    return render_template("home.html", albums=albums, prev_cursor=prev_cursor, next_cursor=next_cursor)
 
 @app.route("/album/<album_uuid>")
 #Album details queried by UUID
@@ -203,10 +203,50 @@ async def album(album_uuid):
     if not album_entry:
         return redirect(url_for('home'))
 
-    # Fetch reviews for the album
-    reviews = await dbq.getReviewsForAlbum(conn, album_uuid)
+    # Reviews come back with the rest of the album
+    return render_template("album_detail.html", album=album_entry, reviews=album_entry.get_reviews())
 
-    return render_template("album_detail.html", album=album_entry, reviews=reviews)
+@app.route("/album/<uuid:album_uuid>/art")
+#Raw album art, cached by the browser and revalidated with the ETag, a malformed id is a 404 from the converter
+async def album_art(album_uuid):
+    conn = g.db
+    known_tags = list(request.if_none_match)
+    # ?size= picks one of the pre-generated thumbnails, falling back to the original if it hasn't been made yet
+    size = request.args.get('size', None, type=int)
+    tag = None
+    if size in images.THUMBNAIL_SIZES:
+        tag, mimetype, image = await dbq.getAlbumThumbnail(conn, album_uuid, size, known_tags)
+    if tag is None:
+        tag, picture = await dbq.getAlbumPicture(conn, album_uuid, known_tags)
+        if tag is None:
+            return {"error": "No album art"}, 404
+        image = None
+        if picture is not None:
+            image, mimetype = images.decode_picture(picture)
+            if image is None:
+                return {"error": "No album art"}, 404
+    # No image means the client's ETag matched
+    if image is None:
+        response = make_response("", 304)
+    else:
+        response = make_response(image)
+        response.mimetype = mimetype
+    response.set_etag(tag)
+    response.cache_control.public = True
+    response.cache_control.max_age = 3600
+    return response
+
+@app.route("/autocomplete/<kind>")
+#Typeahead suggestions for the search bar and the album form, JSON list of {value, uses}
+#Answers come from the per-worker suggestion cache until the library changes, so it can run on every keystroke
+async def autocomplete(kind):
+    if kind not in dbq.suggestKinds:
+        return {"error": "Unknown suggestion type"}, 404
+    suggestions = await search_cache.suggest(g.db, kind, request.args.get('q', ''))
+    response = make_response({"suggestions": [{"value": value, "uses": uses} for value, uses in suggestions]})
+    response.cache_control.public = True
+    response.cache_control.max_age = 60
+    return response
 
 ### Review Management
 
@@ -218,7 +258,8 @@ async def review_form(album_uuid, edit=False):
     if request.method == 'POST':
         review_text = request.form.get('review_text', '')
         if review_text:
-            await dbq.addReview(conn, review_text, current_user.id, album_uuid, )
+            async with dbq.unitOfWork(conn):
+                await dbq.addReview(conn, review_text, current_user.id, album_uuid, )
             return redirect(url_for('album_detail', album_uuid=album_uuid))
 
     album_entry = await dbq.getAlbum(conn, album_uuid)
@@ -261,11 +302,12 @@ async def delete_entry(album_uuid):
     if current_user.role not in ['staff', 'eboard']:
         return redirect(url_for('home'))
     ref = request.referrer or ''
-    print("Deleting album with UUID:", album_uuid)
+    app.logger.info("Deleting album %s (user %s)", album_uuid, current_user.id)
     conn = g.db
     if album_uuid:
         # Delete the album entry from the database
-        await dbq.removeAlbum(conn, album_uuid)
+        async with dbq.unitOfWork(conn):
+            await dbq.removeAlbum(conn, album_uuid)
         if ref.endswith('/') or ref.endswith('/search'):
             return redirect(url_for('home'))
         return redirect(url_for('manage_library'))
@@ -331,11 +373,17 @@ async def manage_library():
                     track_durations[x] if x < len(track_durations) else "",
                     track_fcc_clean[x] if x < len(track_fcc_clean) else False
                 ])
-            if not edit:
-                await dbq.addAlbum(g.db, albumname, shortcode, UPC, genre, release_date, artists, mediums, image, tracks)
-            if edit:
-                #TODO: handle UPCs better, currently each album can only have one UPC attached to its primary medium
-                await dbq.updateAlbum(g.db, album_uuid, albumname, shortcode, genre, release_date, image, tracks, artists, mediums)
+            # Resize the new cover off the event loop, the listing pages only ever load these
+            thumbnails = await asyncio.to_thread(images.make_thumbnails, image) if image else None
+            # The album, its tracks, links and thumbnails are saved as one transaction
+            async with dbq.unitOfWork(g.db):
+                if not edit:
+                    album_uuid = await dbq.addAlbum(g.db, albumname, shortcode, UPC, genre, release_date, artists, mediums, image, tracks)
+                if edit:
+                    #TODO: handle UPCs better, currently each album can only have one UPC attached to its primary medium
+                    await dbq.updateAlbum(g.db, album_uuid, albumname, shortcode, genre, release_date, image, tracks, artists, mediums)
+                if thumbnails is not None:
+                    await dbq.setAlbumThumbnails(g.db, album_uuid, thumbnails)
 
             return {"success": True}
         return {"error": "No album data received"}, 400
@@ -346,15 +394,16 @@ async def manage_library():
 @login_required
 #TODO: Implement this function to manage library parameters like valid genres and mediums
 #TODO: Implement genre verification
-def library_parameters():
+async def library_parameters():
     if current_user.role not in ['staff', 'eboard']:
         return redirect(url_for('home'))
     conn = g.db
 
     if request.method == 'GET':
-        mediums = dbq.getAllMediums(conn)
-        genres = dbq.getAllGenres(conn)
-        review_guidelines = dbq.getReviewGuidelines(conn)
+        # All three come from the reference cache, no queries once it's warm
+        mediums = await dbq.getAllMediums(conn)
+        genres = await dbq.getAllGenres(conn)
+        review_guidelines = await dbq.getReviewGuidelines(conn)
         return render_template("library_parameters.html")
 
     # TODO: Finish implementing this function to handle POST requests    # elif request.method == 'POST':
@@ -382,12 +431,17 @@ def library_parameters():
 @app.route("/fetch_upc", methods=["POST"])
 @login_required
 # Fetch album details from Discogs using UPC
-def fetch_upc():
+async def fetch_upc():
     if current_user.role not in ['staff', 'eboard', 'cdnerd']:
         return redirect(url_for('home'))
     upc = request.form.get('upc', None)
     if upc:
-        album_entry = discogs.search_upc(upc)
+        try:
+            album_entry = await background.wait(discogs_async.search_upc(upc))
+        except DiscogsRateLimitError:
+            return {"error": "Discogs is busy, try again in a minute"}, 429
+        except (asyncio.TimeoutError, httpx.HTTPError):
+            return {"error": "Discogs did not respond"}, 504
         if album_entry:
             return render_template("partials/album_form.html", album_entry=album_entry)
     return {"error": "Invalid UPC"}, 400
@@ -395,12 +449,17 @@ def fetch_upc():
 @app.route("/fetch_discogs", methods=["POST"])
 @login_required
 # Fetch album details from Discogs using Discogs ID
-def fetch_discogs():
+async def fetch_discogs():
     if current_user.role not in ['staff', 'eboard', 'cdnerd']:
         return redirect(url_for('home'))
     discogs_id = request.form.get('discogs_id', None)
     if discogs_id:
-        album_entry = discogs.search_by_id(discogs_id)
+        try:
+            album_entry = await background.wait(discogs_async.search_by_id(discogs_id))
+        except DiscogsRateLimitError:
+            return {"error": "Discogs is busy, try again in a minute"}, 429
+        except (asyncio.TimeoutError, httpx.HTTPError):
+            return {"error": "Discogs did not respond"}, 504
         if album_entry:
             return render_template("partials/album_form.html", album_entry=album_entry)
     return {"error": "Invalid Discogs ID"}, 400
@@ -426,19 +485,101 @@ async def update_users():
     if current_user.role != 'eboard':
         return redirect(url_for('home'))
     conn = g.db
-    # Check if the request contains an invite email
-    if request.form.get("invite_email"):
-        email = request.form.get("invite_email")
-        await dbq.inviteUser(conn, email)
-    # Check if the request contains a user id to deactivate
-    elif request.form.get("deactivate"):
-        uid = request.form.get("deactivate")
-        email = await dbq.getUserEmail(conn, uid)
-        await dbq.removeInvite(conn, email)
-    # Check if the request contains a user to change roles
-    elif request.form.get("changed_roles"):
-        changed_roles = request.form.get("changed_roles")
-        changed_roles_dict = json.loads(changed_roles)
-        for uid, new_role in changed_roles_dict.items():
-            await dbq.setUserRole(conn, uid, new_role)
-    return redirect(url_for("manage_users"))
\ No newline at end of file
+    # All the changes from one form submit land together or not at all
+    async with dbq.unitOfWork(conn):
+        # Check if the request contains an invite email
+        if request.form.get("invite_email"):
+            email = request.form.get("invite_email")
+            await dbq.inviteUser(conn, email)
+        # Check if the request contains a user id to deactivate
+        elif request.form.get("deactivate"):
+            uid = request.form.get("deactivate")
+            email = await dbq.getUserEmail(conn, uid)
+            await dbq.removeInvite(conn, email)
+        # Check if the request contains a user to change roles
+        elif request.form.get("changed_roles"):
+            changed_roles = request.form.get("changed_roles")
+            changed_roles_dict = json.loads(changed_roles)
+            for uid, new_role in changed_roles_dict.items():
+                await dbq.setUserRole(conn, uid, new_role)
+    return redirect(url_for("manage_users"))
+
+### Export
+@app.route("/export/catalog.<fmt>")
+@login_required
+# Whole catalog as CSV or JSONL for the automation system and audits, streamed in chunks as it comes off the database
+# Sync on purpose, Flask can only stream from a plain generator
+# Listed in OWN_CONNECTION, the stream's connection is the only one held while the download runs
+def export_catalog(fmt):
+    if current_user.role not in ['staff', 'eboard']:
+        return redirect(url_for('home'))
+    if fmt not in export.FORMATS:
+        return {"error": "Unknown export format"}, 404
+    response = Response(database.stream(export.chunks, fmt), mimetype=export.FORMATS[fmt])
+    response.headers["Content-Disposition"] = f"attachment; filename=catalog.{fmt}"
+    return response
+
+### Diagnostics
+@app.route("/metrics")
+# Prometheus scrape endpoint, per-endpoint request, database, Discogs and render timings summed over every worker
+# Scrapers can't log in, so it's guarded by METRICS_TOKEN as a bearer token when that is set
+def prometheus_metrics():
+    token = os.getenv("METRICS_TOKEN")
+    if token and request.headers.get("Authorization") != f"Bearer {token}":
+        abort(403)
+    body, content_type = metrics.exposition()
+    return body, 200, {"Content-Type": content_type}
+
+@app.route("/pool_stats")
+@login_required
+# Connection pool counters, including how long requests waited for a connection, commit counts and reference cache hits
+def pool_stats():
+    if current_user.role != 'eboard':
+        return redirect(url_for('home'))
+    reference = dict(reference_cache.cache.stats, hit_ratio=reference_cache.cache.hit_ratio())
+    return {"pool": database.stats(), "transactions": dbq.commitStats, "reference_cache": reference}
+
+@app.route("/search_stats")
+@login_required
+# Search page and autocomplete cache counters for this worker, stale counts lookups that found a page from before the last library change
+def search_stats():
+    if current_user.role != 'eboard':
+        return redirect(url_for('home'))
+    return {
+        name: dict(cache.stats, hit_ratio=cache.hit_ratio(), size=len(cache))
+        for name, cache in (("pages", search_cache.pages), ("suggestions", search_cache.suggestions))
+    }
+
+@app.route("/sql_profile")
+@login_required
+# Statements ranked by total time for this worker, tagged with the dbq function that sent them, plus the slow statement log
+# ?top=N limits the ranking, ?by=calls|max_seconds|rows changes the order, ?reset=1 starts a fresh profile
+def sql_profile():
+    if current_user.role != 'eboard':
+        return redirect(url_for('home'))
+    by = request.args.get("by", "seconds")
+    if by not in ("seconds", "calls", "max_seconds", "rows"):
+        return {"error": "Unknown ranking"}, 400
+    top = request.args.get("top", 20, type=int)
+    report = {
+        "enabled": profiler.SQL_PROFILE,
+        "since": profiler.profile.since,
+        "slow_query_ms": profiler.SLOW_QUERY_MS,
+        "functions": profiler.profile.functions(top),
+        "statements": profiler.profile.top(top, by),
+        "slow": profiler.profile.slow_log(),
+    }
+    if request.args.get("reset") == "1":
+        profiler.profile.reset()
+    return report
+
+@app.route("/discogs_stats")
+@login_required
+# Discogs response cache and rate limiter counters for this worker, queue depth covers every worker
+def discogs_stats():
+    if current_user.role != 'eboard':
+        return redirect(url_for('home'))
+    return {
+        "cache": dict(discogs.cache.stats, hit_ratio=discogs.cache.hit_ratio()),
+        "limiter": dict(discogs.limiter.stats, queue_depth=discogs.limiter.queue_depth()),
+    }
@@ -0,0 +1,34 @@
+import asyncio, os, threading
+
+#Flask runs every async view and hook in its own short lived event loop, so anything that has
+#to outlive a request (the db pool, pooled HTTP sessions) lives on this one loop in a daemon thread
+#instead. Other loops hand work over with submit()/wait(), sync code with run().
+_loop = None
+_pid = None
+_lock = threading.Lock()
+
+
+def loop():
+    global _loop, _pid
+    with _lock:
+        #Start a fresh loop after a fork (gunicorn --preload), threads don't survive it
+        if _loop is None or _pid != os.getpid():
+            _loop = asyncio.new_event_loop()
+            _pid = os.getpid()
+            threading.Thread(target=_loop.run_forever, name="background-loop", daemon=True).start()
+        return _loop
+
+
+def submit(coro):
+    #Schedule a coroutine on the background loop, returns a concurrent.futures.Future
+    return asyncio.run_coroutine_threadsafe(coro, loop())
+
+
+async def wait(coro):
+    #Await a coroutine that runs on the background loop from any other loop
+    return await asyncio.wrap_future(submit(coro))
+
+
+def run(coro):
+    #Blocking version for sync code
+    return submit(coro).result()
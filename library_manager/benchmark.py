@@ -0,0 +1,243 @@
+import itertools, json, os, random, time, uuid
+import psycopg
+from dotenv import load_dotenv
+from library_manager import dbq
+
+### Benchmarks for the data access layer, run with `flask --app app benchmark`
+### Every case calls dbq directly on one dedicated connection (no pool, no caches) against the
+### database in DATABASE_URL, so numbers only move when the queries do. Point it at a local
+### database loaded with `flask --app app generate-catalog`, never at production: the write
+### cases roll back but still take locks.
+
+load_dotenv()
+#Where results are saved with --save-baseline and compared against on every run
+BASELINE_PATH = os.getenv("BENCHMARK_BASELINE", "benchmark_baseline.json")
+#A case regresses when its p95 grows by more than this fraction, or it issues more queries
+BENCHMARK_TOLERANCE = float(os.getenv("BENCHMARK_TOLERANCE", 0.2))
+#Pages walked before the deep page is timed
+DEEP_PAGE = 20
+
+
+class CountingCursor(psycopg.AsyncCursor):
+    #Counts every statement sent, pipelined ones included, so a case reports its round trip budget
+    queries = 0
+
+    async def execute(self, query, params=None, **kwargs):
+        CountingCursor.queries += 1
+        return await super().execute(query, params, **kwargs)
+
+    async def executemany(self, query, params_seq, **kwargs):
+        CountingCursor.queries += 1
+        return await super().executemany(query, params_seq, **kwargs)
+
+
+def _percentile(samples: list, pct: float):
+    #Nearest-rank percentile of an already sorted list
+    return samples[max(0, min(len(samples) - 1, round(pct / 100 * len(samples) + 0.5) - 1))]
+
+
+async def _measure(conn, fn, inputs: list):
+    #Runs fn(conn, input) once per input, returning latency percentiles (ms), throughput and queries per call
+    timings = []
+    queries = CountingCursor.queries
+    started = time.perf_counter()
+    for value in inputs:
+        start = time.perf_counter()
+        await fn(conn, value)
+        timings.append((time.perf_counter() - start) * 1000)
+    elapsed = time.perf_counter() - started
+    timings.sort()
+    return {
+        "iterations": len(inputs),
+        "queries": round((CountingCursor.queries - queries) / len(inputs), 2),
+        "p50_ms": round(_percentile(timings, 50), 3),
+        "p95_ms": round(_percentile(timings, 95), 3),
+        "p99_ms": round(_percentile(timings, 99), 3),
+        "ops_per_s": round(len(inputs) / elapsed, 1),
+    }
+
+
+async def _sample(conn, rng: random.Random, iterations: int):
+    #Ids and search terms taken from the catalog itself, picked with the seeded rng so runs are comparable
+    async with conn.cursor() as cur:
+        await cur.execute("SELECT albumID, albumName, genre, artists FROM album_summary ORDER BY albumID LIMIT 5000")
+        albums = await cur.fetchall()
+        await cur.execute("SELECT trackName FROM track ORDER BY trackID LIMIT 5000")
+        tracks = [row[0] for row in await cur.fetchall()]
+        await cur.execute("SELECT userID FROM users ORDER BY userID LIMIT 1000")
+        users = [row[0] for row in await cur.fetchall()]
+        await cur.execute("SELECT mediumName FROM medium ORDER BY mediumName")
+        mediums = [row[0] for row in await cur.fetchall()]
+    if not albums or not tracks or not users:
+        raise RuntimeError("The catalog is empty, load one with generate-catalog first")
+
+    def word(text):
+        words = [w for w in (text or "").split() if len(w) > 2]
+        return rng.choice(words) if words else (text or "")[:3]
+
+    picks = [rng.choice(albums) for _ in range(iterations)]
+    return {
+        "albums": [album[0] for album in picks],
+        "album_terms": [word(album[1]) for album in picks],
+        "genre_terms": [album[2] for album in picks],
+        "artist_terms": [word(album[3].split(", ")[0]) for album in picks],
+        "track_terms": [word(rng.choice(tracks)) for _ in range(iterations)],
+        "users": [rng.choice(users) for _ in range(iterations)],
+        "mediums": mediums,
+    }
+
+
+def _newAlbum(rng: random.Random, sample: dict, tracks: int = 12, credits: int = 3):
+    #An album in the shape manage_library posts, with fresh names so the artist upsert does real work
+    tag = uuid.UUID(int=rng.getrandbits(128)).hex[:12]
+    artists = [f"Bench Artist {tag} {i}" for i in range(2)]
+    return {
+        "albumName": f"Bench Album {tag}",
+        "albumShort": tag[:5],
+        "albumUPC": str(rng.randrange(10 ** 11, 10 ** 12)),
+        "genre": "Rock",
+        "releaseDate": rng.randrange(1960, 2025),
+        "artistNames": artists,
+        "mediums": sample["mediums"][:1],
+        "picture": None,
+        "tracks": [[f"Bench Track {tag} {i}", artists + [f"Bench Guest {tag} {i} {c}" for c in range(credits)], "3:30", False]
+                   for i in range(tracks)],
+    }
+
+
+async def run(conn: psycopg.AsyncConnection, iterations: int = 200, seed: int = 0, only: str = None):
+    #Returns {case name: measurements}, only limits the run to cases whose name contains it
+    rng = random.Random(seed)
+    sample = await _sample(conn, rng, iterations)
+    results = {}
+
+    async def case(name, fn, inputs):
+        if only and only not in name:
+            return
+        #One untimed pass warms the plan cache and shared buffers
+        await fn(conn, inputs[0])
+        results[name] = await _measure(conn, fn, inputs)
+
+    #Every combination of search filters, first page
+    filters = ["album", "artist", "genre", "track"]
+    for size in range(len(filters) + 1):
+        for combo in itertools.combinations(filters, size):
+            def search(conn, i, combo=combo):
+                terms = {f: sample[f"{f}_terms"][i] if f in combo else "" for f in filters}
+                return dbq.searchlibrary(conn, terms["album"], terms["artist"], terms["genre"], terms["track"])
+            await case("search:" + ("+".join(combo) or "none"), search, list(range(iterations)))
+
+    #A page DEEP_PAGE pages into the unfiltered listing and a one-filter listing
+    for name, byGenre in (("search:deep", False), ("search:deep+genre", True)):
+        if only and only not in name:
+            continue
+        async def deepCursor(i, byGenre=byGenre):
+            genre = sample["genre_terms"][i] if byGenre else ""
+            cursor = None
+            for _ in range(DEEP_PAGE):
+                rows, more = await dbq.searchlibrary(conn, "", "", genre, "", cursor)
+                if not more:
+                    break
+                cursor = (rows[-1][4], rows[-1][5], rows[-1][0])
+            return genre, cursor
+        starts = [await deepCursor(i) for i in range(min(iterations, 20))]
+        await case(name, lambda conn, start: dbq.searchlibrary(conn, "", "", start[0], "", start[1]), starts * (iterations // len(starts) or 1))
+
+    await case("album:detail", dbq.getAlbum, sample["albums"])
+
+    #Write cases are rolled back so the catalog is the same for every iteration
+    async def add(conn, album):
+        async with dbq.rolledBackUnitOfWork(conn):
+            await dbq.addAlbum(conn, **album)
+    await case("manage_library:add", add, [_newAlbum(rng, sample) for _ in range(iterations)])
+
+    async def edit(conn, pair):
+        albumID, album = pair
+        album = dict(album)
+        del album["albumUPC"]
+        async with dbq.rolledBackUnitOfWork(conn):
+            await dbq.updateAlbum(conn, albumID, **album)
+    await case("manage_library:edit", edit, [(albumID, _newAlbum(rng, sample)) for albumID in sample["albums"]])
+
+    async def track(conn, credits):
+        async with dbq.rolledBackUnitOfWork(conn):
+            await dbq.addTrack(conn, "Bench Track", credits, "3:30")
+    await case("addTrack:40-credits", track, [[f"Bench Credit {rng.getrandbits(64):x} {c}" for c in range(40)] for _ in range(iterations)])
+
+    await case("user:get", dbq.getUser, sample["users"])
+    await case("user:role", dbq.getUserRole, sample["users"])
+    await case("review:album", dbq.getReviewsForAlbum, sample["albums"])
+    return results
+
+
+async def checkPaging(conn: psycopg.AsyncConnection, seed: int = 0, genres: int = 3, limit: int = 10):
+    #Walks every page of a few genre searches forward and then back again, returns [(genre, problem)]
+    #Every album of a genre gets the same similarity rank, so the pages only hold together if tied ranks
+    #are paged by (sortKey, albumID), cursors go through encodeCursor/decodeCursor like the home page's do
+    rng = random.Random(seed)
+    async with conn.cursor() as cur:
+        await cur.execute("SELECT DISTINCT genre FROM album_summary ORDER BY genre")
+        names = [row[0] for row in await cur.fetchall()]
+    problems = []
+    for genre in rng.sample(names, min(genres, len(names))):
+        async with conn.cursor() as cur:
+            await cur.execute("SELECT albumID FROM album_summary WHERE genre ILIKE %s", (dbq._like(genre),))
+            expected = {row[0] for row in await cur.fetchall()}
+
+        forward = []
+        cursor = None
+        while len(forward) <= len(expected):
+            rows, more = await dbq.searchlibrary(conn, "", "", genre, "", cursor, False, limit)
+            forward += [row[0] for row in rows]
+            if not more:
+                break
+            cursor = dbq.decodeCursor(dbq.encodeCursor(rows[-1]))
+        if len(forward) != len(set(forward)):
+            problems.append((genre, f"{len(forward) - len(set(forward))} albums repeated going forward"))
+        if set(forward) != expected:
+            problems.append((genre, f"{len(expected - set(forward))} albums skipped going forward"))
+        if not forward:
+            continue
+
+        backward = []
+        cursor = dbq.decodeCursor(dbq.encodeCursor(rows[-1]))
+        while len(backward) <= len(expected):
+            rows, more = await dbq.searchlibrary(conn, "", "", genre, "", cursor, True, limit)
+            backward = [row[0] for row in rows] + backward
+            if not more:
+                break
+            cursor = dbq.decodeCursor(dbq.encodeCursor(rows[0]))
+        if backward + forward[-1:] != forward:
+            problems.append((genre, "pages going back don't match the pages going forward"))
+    return problems
+
+
+async def connect(url: str):
+    #A plain connection outside the pool, so pool waits never show up in the numbers
+    return await psycopg.AsyncConnection.connect(url, cursor_factory=CountingCursor)
+
+
+def compare(results: dict, baseline: dict, tolerance: float = BENCHMARK_TOLERANCE):
+    #Returns [(case, reason)] for every case that got slower or chattier than the baseline
+    regressions = []
+    for name, now in results.items():
+        before = baseline.get(name)
+        if before is None:
+            continue
+        if now["queries"] > before["queries"]:
+            regressions.append((name, f"queries {before['queries']} -> {now['queries']}"))
+        if now["p95_ms"] > before["p95_ms"] * (1 + tolerance):
+            regressions.append((name, f"p95 {before['p95_ms']}ms -> {now['p95_ms']}ms"))
+    return regressions
+
+
+def load_baseline(path: str = BASELINE_PATH):
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        return json.load(f)
+
+
+def save_baseline(results: dict, path: str = BASELINE_PATH):
+    with open(path, "w") as f:
+        json.dump(results, f, indent=2, sort_keys=True)
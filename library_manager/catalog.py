@@ -0,0 +1,334 @@
+import asyncio, base64, functools, io, itertools, os, random, re, time, uuid
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timedelta, timezone
+import psycopg
+from PIL import Image
+from library_manager import images
+
+### Synthetic catalog for local development and benchmarks, run with `flask --app app generate-catalog`
+### The same seed and sizes always produce the same library, row for row
+### Albums are generated in CATALOG_SHARDS independent shards, each in a worker process that writes its rows
+### over its own connection with binary COPY, so generating and loading run on every core at once.
+### Secondary indexes are dropped for the load and rebuilt in parallel before album_summary is filled
+### Emptying the tables and dropping their indexes takes the owner of the tables, not the app's library role,
+### so url is the owner's connection string (CATALOG_DATABASE_URL for the command)
+
+#Defaults roughly match the station's production library
+CATALOG_ALBUMS = 100_000
+CATALOG_ARTISTS = 200_000
+CATALOG_TRACKS_PER_ALBUM = 15
+CATALOG_USERS = 500
+CATALOG_REVIEWS = 50_000
+#Exponent of the Zipf distribution artists are drawn from, higher means a few artists dominate more
+ZIPF_EXPONENT = 1.1
+#Share of albums that are compilations credited to several artists
+COMPILATION_SHARE = 0.08
+#Chance a track credits guests on top of the album artists
+GUEST_CREDIT_SHARE = 0.25
+PLACEHOLDER_COVERS = 16
+#Albums are split into this many shards, each generated from its own seed, so the library is the same
+#however many worker processes share the shards out
+CATALOG_SHARDS = 16
+
+#Tables the generator owns, a reset truncates all of them
+TABLES = ["users", "invitedusers", "medium", "artist", "album", "album_thumbnail", "track",
+          "album_artist", "album_medium", "album_track", "artist_track", "review", "review_album", "album_summary",
+          "suggestion"]
+#Built in the database from the loaded tables, their indexes go on once they are filled
+DERIVED = ["album_summary", "suggestion"]
+#Columns and their types for the binary COPY of each loaded table, in the order the rows hold them
+COLUMNS = {
+    "users": (["userID", "firstName", "lastName", "email", "role"], ["uuid", "varchar", "varchar", "varchar", "varchar"]),
+    "invitedusers": (["inviteID", "email"], ["uuid", "varchar"]),
+    "medium": (["mediumID", "mediumName"], ["uuid", "varchar"]),
+    "artist": (["artistID", "artistName"], ["uuid", "varchar"]),
+    "album": (["albumID", "albumName", "albumShort", "genre", "picture", "releaseDate"], ["uuid", "varchar", "varchar", "varchar", "bytea", "int4"]),
+    "album_thumbnail": (["albumID", "size", "mimetype", "image"], ["uuid", "int4", "varchar", "bytea"]),
+    "track": (["trackID", "trackName", "trackDuration", "fccClean"], ["uuid", "varchar", "varchar", "bool"]),
+    "album_artist": (["artistID", "albumID"], ["uuid", "uuid"]),
+    "album_medium": (["albumUPC", "albumID", "mediumID"], ["varchar", "uuid", "uuid"]),
+    "album_track": (["albumID", "trackID", "trackNumber"], ["uuid", "uuid", "int4"]),
+    "artist_track": (["artistID", "trackID"], ["uuid", "uuid"]),
+    "review": (["reviewID", "review", "userID", "reviewDate", "hidden"], ["uuid", "text", "uuid", "timestamptz", "bool"]),
+    "review_album": (["reviewID", "albumID"], ["uuid", "uuid"]),
+}
+
+MEDIUMS = ["CD", "Vinyl", "Cassette", "7\"", "Digital"]
+#Weights for how many mediums an album comes on, 1 is by far the most common
+MEDIUM_COUNTS = [0.7, 0.22, 0.08]
+GENRES = ["Rock", "Pop", "Hip Hop", "Electronic", "Jazz", "Folk", "Country", "Metal", "Punk", "Indie",
+          "Classical", "Blues", "Soul", "Reggae", "Experimental", "Ambient", "R&B", "Latin", "World", "Soundtrack"]
+#Genre popularity falls off like the artists do
+GENRE_WEIGHTS = [1 / (rank + 1) for rank in range(len(GENRES))]
+ROLES = ["member", "cdnerd", "staff", "eboard"]
+ROLE_WEIGHTS = [0.8, 0.1, 0.07, 0.03]
+
+FIRST_NAMES = ["Alex", "Sam", "Jordan", "Taylor", "Casey", "Riley", "Morgan", "Jamie", "Avery", "Quinn",
+               "Rowan", "Skyler", "Drew", "Emerson", "Harper", "Kai", "Logan", "Parker", "Reese", "Sage"]
+LAST_NAMES = ["Smith", "Garcia", "Kim", "Nguyen", "Okafor", "Rossi", "Novak", "Silva", "Cohen", "Haddad",
+              "Murphy", "Ivanova", "Tanaka", "Moreau", "Fischer", "Larsen", "Khan", "Lopez", "Walsh", "Adeyemi"]
+WORDS = ["Neon", "Velvet", "Static", "Golden", "Broken", "Electric", "Silent", "Paper", "Midnight", "Crystal",
+         "Hollow", "Wild", "Northern", "Lost", "Burning", "Glass", "Iron", "Ocean", "Summer", "Winter",
+         "Ghost", "River", "Machine", "Garden", "Satellite", "Echo", "Signal", "Mirror", "Harbor", "Canyon",
+         "Lights", "Hearts", "Wolves", "Dreams", "Shadows", "Horizon", "Radio", "Motel", "Fever", "Parade",
+         "Cathedral", "Tides", "Thunder", "Circuit", "Orchard", "Skyline", "Voltage", "Lantern", "Avenue", "Meadow"]
+SENTENCES = ["Strong opener, the rest of the side never quite matches it.",
+             "Good for late night rotation.",
+             "Track three has an FCC issue in the second verse.",
+             "Warm production, a little long in the middle.",
+             "Great pick for the Friday show.",
+             "The single is the obvious play but the closer is better.",
+             "Sounds dated now but still fun.",
+             "Instrumental cuts work well as bed music."]
+
+
+def _uuid(rng: random.Random):
+    return uuid.UUID(int=rng.getrandbits(128), version=4)
+
+
+def _upc(number: int):
+    #12 digit UPC-A with a valid check digit
+    digits = f"{number:011d}"
+    odd = sum(int(d) for d in digits[0::2])
+    even = sum(int(d) for d in digits[1::2])
+    return digits + str((10 - (odd * 3 + even) % 10) % 10)
+
+
+def _title(rng: random.Random, words: int):
+    return " ".join(rng.choice(WORDS) for _ in range(words))
+
+
+def _covers(rng: random.Random):
+    #A few flat colour covers stand in for real art, stored like manage_library stores uploads
+    covers = []
+    for _ in range(PLACEHOLDER_COVERS):
+        image = Image.new("RGB", (300, 300), tuple(rng.randrange(256) for _ in range(3)))
+        buffer = io.BytesIO()
+        image.save(buffer, "PNG")
+        picture = b"data:image/png;base64," + base64.b64encode(buffer.getvalue())
+        covers.append((picture, images.make_thumbnails(picture)))
+    return covers
+
+
+@functools.lru_cache(maxsize=1)
+def _shared(seed: int, artists: int, users: int):
+    #Users, mediums, artists and cover art, every process builds the same ones from the seed
+    #Returns ({table: rows}, artistIDs, artist popularity, mediumIDs, covers)
+    rng = random.Random(seed)
+    tables = {}
+
+    userIDs = [_uuid(rng) for _ in range(users)]
+    #The first user is always an eboard member so the generated library can be managed straight away
+    roles = ["eboard"] + rng.choices(ROLES, ROLE_WEIGHTS, k=users - 1)
+    emails = [f"user{i}@example.com" for i in range(users)]
+    tables["users"] = [(userIDs[i], rng.choice(FIRST_NAMES), rng.choice(LAST_NAMES), emails[i], roles[i]) for i in range(users)]
+    tables["invitedusers"] = [(_uuid(rng), email) for email in emails]
+
+    mediumIDs = [_uuid(rng) for _ in MEDIUMS]
+    tables["medium"] = list(zip(mediumIDs, MEDIUMS))
+
+    #Artist names are word pairs, numbered once the pairs run out so artistName stays unique
+    artistIDs = [_uuid(rng) for _ in range(artists)]
+    names = set()
+    artistNames = []
+    for i in range(artists):
+        name = f"The {_title(rng, 1)} {rng.choice(WORDS)}" if rng.random() < 0.3 else f"{rng.choice(FIRST_NAMES)} {_title(rng, 1)}"
+        if name in names:
+            name = f"{name} {i}"
+        names.add(name)
+        artistNames.append(name)
+    tables["artist"] = list(zip(artistIDs, artistNames))
+    #Zipf popularity: the artist at rank r is picked in proportion to 1 / r^s
+    popularity = list(itertools.accumulate(1 / (rank + 1) ** ZIPF_EXPONENT for rank in range(artists)))
+    return tables, artistIDs, popularity, mediumIDs, _covers(rng)
+
+
+def _shard(seed: int, shard: int, albums: int, artists: int, tracksPerAlbum: int, users: int):
+    #Rows for one shard's albums: the albums, their thumbnails, tracks and links, as {table: rows}
+    _, artistIDs, popularity, mediumIDs, covers = _shared(seed, artists, users)
+    rng = random.Random(f"{seed}:{shard}")
+    albumRows, thumbnailRows, trackRows = [], [], []
+    albumArtistRows, albumMediumRows, albumTrackRows, artistTrackRows = [], [], [], []
+    for i in range(albums * shard // CATALOG_SHARDS, albums * (shard + 1) // CATALOG_SHARDS):
+        albumID = _uuid(rng)
+        if rng.random() < COMPILATION_SHARE:
+            credited = set(rng.choices(artistIDs, cum_weights=popularity, k=rng.randint(3, 10)))
+        else:
+            credited = set(rng.choices(artistIDs, cum_weights=popularity, k=rng.choice([1, 1, 1, 2])))
+        credited = list(credited)
+        picture, thumbnails = rng.choice(covers) if rng.random() < 0.9 else (None, [])
+        albumRows.append((albumID, _title(rng, rng.randint(1, 4)), _title(rng, 1)[:5].upper(), rng.choices(GENRES, GENRE_WEIGHTS)[0],
+                          picture, rng.randint(1955, 2025)))
+        thumbnailRows += [(albumID, size, mimetype, image) for size, mimetype, image in thumbnails]
+        albumArtistRows += [(artistID, albumID) for artistID in credited]
+        #Each album gets its own run of UPCs so intake duplicate checks behave like the real thing
+        for m, mediumID in enumerate(rng.sample(mediumIDs, rng.choices([1, 2, 3], MEDIUM_COUNTS)[0])):
+            albumMediumRows.append((_upc(i * 3 + m), albumID, mediumID))
+        for number in range(1, max(1, round(rng.gauss(tracksPerAlbum, tracksPerAlbum / 3))) + 1):
+            trackID = _uuid(rng)
+            minutes, seconds = divmod(rng.randint(90, 480), 60)
+            trackRows.append((trackID, _title(rng, rng.randint(1, 3)), f"{minutes}:{seconds:02d}", rng.random() < 0.85))
+            albumTrackRows.append((albumID, trackID, number))
+            #Compilations credit one artist per track, everything else credits the album artists
+            trackArtists = {rng.choice(credited)} if len(credited) > 2 else set(credited)
+            if rng.random() < GUEST_CREDIT_SHARE:
+                trackArtists.update(rng.choices(artistIDs, cum_weights=popularity, k=rng.randint(1, 3)))
+            artistTrackRows += [(artistID, trackID) for artistID in trackArtists]
+    #In load order, the link tables reference the albums and tracks before them
+    return {"album": albumRows, "album_thumbnail": thumbnailRows, "track": trackRows, "album_artist": albumArtistRows,
+            "album_medium": albumMediumRows, "album_track": albumTrackRows, "artist_track": artistTrackRows}
+
+
+def _reviews(seed: int, albumIDs: list, userIDs: list, reviews: int):
+    #Popular albums collect most of the reviews, a reviewer only reviews an album once
+    #albumIDs are in album order, the first albums are the popular ones
+    rng = random.Random(f"{seed}:reviews")
+    reviewRows, reviewAlbumRows = [], []
+    reviewed = set()
+    now = datetime(2025, 1, 1, tzinfo=timezone.utc)
+    albumPopularity = list(itertools.accumulate(1 / (rank + 1) ** ZIPF_EXPONENT for rank in range(len(albumIDs))))
+    for albumID, userID in zip(rng.choices(albumIDs, cum_weights=albumPopularity, k=reviews), rng.choices(userIDs, k=reviews)):
+        if (albumID, userID) in reviewed:
+            continue
+        reviewed.add((albumID, userID))
+        reviewID = _uuid(rng)
+        text = " ".join(rng.sample(SENTENCES, rng.randint(1, 3)))
+        reviewRows.append((reviewID, text, userID, now - timedelta(minutes=rng.randrange(3 * 365 * 24 * 60)), rng.random() < 0.05))
+        reviewAlbumRows.append((reviewID, albumID))
+    return {"review": reviewRows, "review_album": reviewAlbumRows}
+
+
+async def _copy(conn: psycopg.AsyncConnection, tables: dict):
+    #Writes {table: rows} in order with binary COPY, the rows go straight from the tuples to the wire format
+    #Returns the number of rows written
+    written = 0
+    async with conn.cursor() as cur:
+        for table, rows in tables.items():
+            columns, types = COLUMNS[table]
+            async with cur.copy(f"COPY {table} ({', '.join(columns)}) FROM STDIN (FORMAT BINARY)") as copy:
+                copy.set_types(types)
+                for row in rows:
+                    await copy.write_row(row)
+            written += len(rows)
+    return written
+
+
+async def _loadShardAsync(url: str, seed: int, shard: int, albums: int, artists: int, tracksPerAlbum: int, users: int):
+    tables = _shard(seed, shard, albums, artists, tracksPerAlbum, users)
+    async with await psycopg.AsyncConnection.connect(url) as conn:
+        written = await _copy(conn, tables)
+    return [row[0] for row in tables["album"]], written
+
+
+def _loadShard(url: str, seed: int, shard: int, albums: int, artists: int, tracksPerAlbum: int, users: int):
+    #Runs in a worker process, generates and commits one shard, returns (the shard's albumIDs in order, rows written)
+    return asyncio.run(_loadShardAsync(url, seed, shard, albums, artists, tracksPerAlbum, users))
+
+
+async def _parallel(url: str, statements: list, jobs: int):
+    #Runs independent (statement, params) pairs over up to jobs connections at once, each committing on its own
+    pending = list(statements)
+    async def worker():
+        async with await psycopg.AsyncConnection.connect(url, autocommit=True) as conn:
+            while pending:
+                statement, params = pending.pop(0)
+                await conn.execute(statement, params)
+    await asyncio.gather(*(worker() for _ in range(min(jobs, len(pending)))))
+
+
+async def _prepare(url: str, shared: dict):
+    #Empties the tables, drops their secondary indexes and the suggestion triggers for the load, and loads
+    #the rows every shard references. Returns ([(table, index definition)], [(table, trigger)]) to restore later
+    async with await psycopg.AsyncConnection.connect(url) as conn, conn.cursor() as cur:
+        await cur.execute(f"TRUNCATE {', '.join(TABLES)} CASCADE")
+        #Maintaining the trigram and secondary indexes row by row is most of a load's cost, build them once at the end
+        await cur.execute("""
+            SELECT tablename, indexname, indexdef FROM pg_indexes
+            WHERE schemaname = current_schema() AND tablename = ANY(%s)
+            AND indexname NOT IN (SELECT conname FROM pg_constraint)
+        """, (TABLES,))
+        indexes = await cur.fetchall()
+        for _, name, _ in indexes:
+            await cur.execute(f'DROP INDEX "{name}"')
+        #Shards loading at once would all be upserting the same suggestion rows, they're counted once at the end instead
+        await cur.execute("""
+            SELECT tgrelid::regclass::text, tgname FROM pg_trigger
+            WHERE NOT tgisinternal AND tgname ~ '_suggestions_' AND tgrelid::regclass::text = ANY(%s)
+        """, (TABLES,))
+        triggers = await cur.fetchall()
+        for table, name in triggers:
+            await cur.execute(f'ALTER TABLE {table} DISABLE TRIGGER "{name}"')
+        await _copy(conn, shared)
+    #IF NOT EXISTS so a failed load can put back whatever it hadn't rebuilt yet
+    return [(table, re.sub(r"^CREATE (UNIQUE )?INDEX ", r"CREATE \1INDEX IF NOT EXISTS ", definition)) for table, _, definition in indexes], triggers
+
+
+async def _restore(url: str, indexes: list, triggers: list, jobs: int, tables: list):
+    #Rebuilds the dropped indexes of tables, in parallel, and turns the suggestion triggers back on
+    await _parallel(url, [(definition, None) for table, definition in indexes if table in tables], jobs)
+    async with await psycopg.AsyncConnection.connect(url) as conn, conn.cursor() as cur:
+        for table, name in triggers:
+            await cur.execute(f'ALTER TABLE {table} ENABLE TRIGGER "{name}"')
+
+
+async def _loadReviews(url: str, tables: dict):
+    async with await psycopg.AsyncConnection.connect(url) as conn:
+        return await _copy(conn, tables)
+
+
+async def _finish(url: str, indexes: list, triggers: list, jobs: int):
+    #Counts the suggestions, indexes album_summary and suggestion, turns the triggers back on and refreshes statistics
+    async with await psycopg.AsyncConnection.connect(url, autocommit=True) as conn:
+        await conn.execute("SELECT rebuild_suggestions()")
+    await _restore(url, indexes, triggers, jobs, DERIVED)
+    async with await psycopg.AsyncConnection.connect(url, autocommit=True) as conn:
+        await conn.execute(f"ANALYZE {', '.join(TABLES)}")
+
+
+def load(url: str, seed: int = 0, albums: int = CATALOG_ALBUMS, artists: int = CATALOG_ARTISTS, tracksPerAlbum: int = CATALOG_TRACKS_PER_ALBUM,
+         users: int = CATALOG_USERS, reviews: int = CATALOG_REVIEWS, jobs: int = None, progress=None):
+    #Replaces everything in TABLES with the generated library over connections to url
+    #jobs is how many shards are generated and loaded at once, one per CPU by default
+    #progress(step, rows, seconds) is called after each step
+    #Shards commit as they finish, a load that fails part way leaves a partial library with its indexes
+    #and triggers put back, running it again starts over
+    jobs = jobs or os.cpu_count() or 1
+    start = time.monotonic()
+    shared, *_ = _shared(seed, artists, users)
+    indexes, triggers = asyncio.run(_prepare(url, shared))
+    if progress:
+        progress("artists/users", sum(len(rows) for rows in shared.values()), time.monotonic() - start)
+    try:
+        start = time.monotonic()
+        albumIDs, written = [], 0
+        with ProcessPoolExecutor(max_workers=jobs) as pool:
+            shards = [pool.submit(_loadShard, url, seed, shard, albums, artists, tracksPerAlbum, users) for shard in range(CATALOG_SHARDS)]
+            #Shard order, not finishing order, so the album popularity ranking is the same every time
+            for future in shards:
+                ids, rows = future.result()
+                albumIDs += ids
+                written += rows
+        if progress:
+            progress("albums", written, time.monotonic() - start)
+
+        start = time.monotonic()
+        userIDs = [row[0] for row in shared["users"]]
+        written = asyncio.run(_loadReviews(url, _reviews(seed, albumIDs, userIDs, reviews)))
+        if progress:
+            progress("reviews", written, time.monotonic() - start)
+
+        #Indexes first, refresh_album_summary looks up every album's links through them
+        start = time.monotonic()
+        asyncio.run(_parallel(url, [(definition, None) for table, definition in indexes if table not in DERIVED], jobs))
+        if progress:
+            progress("indexes", len(indexes), time.monotonic() - start)
+        start = time.monotonic()
+        step = max(1, -(-len(albumIDs) // jobs))
+        asyncio.run(_parallel(url, [("SELECT refresh_album_summary(%s::uuid[])", (albumIDs[i:i + step],))
+                                     for i in range(0, len(albumIDs), step)], jobs))
+        asyncio.run(_finish(url, indexes, triggers, jobs))
+        if progress:
+            progress("album_summary", len(albumIDs), time.monotonic() - start)
+    except BaseException:
+        asyncio.run(_restore(url, indexes, triggers, jobs, TABLES))
+        raise
@@ -21,7 +21,7 @@ class User(UserMixin):
         return str(self.id)
     
 class AlbumEntry():
-    def __init__(self, upc, album_name, artists_name, genre, shortcode, release_date, mediums, image, tracks, album_id=None):
+    def __init__(self, upc, album_name, artists_name, genre, shortcode, release_date, mediums, image, tracks, album_id=None, reviews=None):
         self.upc = upc
         self.album_name = album_name
         self.artist_name = artists_name
@@ -32,6 +32,7 @@ class AlbumEntry():
         self.image = image
         self.tracks = tracks
         self.album_id = album_id
+        self.reviews = reviews
     
     def get_upc(self):
         return self.upc
@@ -61,4 +62,7 @@ class AlbumEntry():
         return self.tracks
 
     def get_album_id(self):
-        return self.album_id
\ No newline at end of file
+        return self.album_id
+
+    def get_reviews(self):
+        return self.reviews
\ No newline at end of file
@@ -0,0 +1,125 @@
+import asyncio, click, csv, time
+from concurrent.futures import ProcessPoolExecutor
+from library_manager import benchmark, catalog, database, dbq, export, images, intake
+
+### Command line tools, registered on the app so they run with `flask --app app <command>`
+### Every command borrows connections from the same pool as the web app (see database.py), except
+### generate-catalog, which connects as the table owner given by CATALOG_DATABASE_URL
+
+
+@click.command("backfill-thumbnails")
+@click.option("--workers", default=None, type=int, help="Resize processes, defaults to one per CPU")
+@click.option("--batch", default=100, show_default=True, help="Albums fetched from the database at a time")
+# Generate thumbnails for every album that has a picture but no thumbnails yet
+def backfill_thumbnails(workers, batch):
+    done = 0
+    skipped = 0
+    after = None
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        while True:
+            rows = database.run(dbq.getAlbumsWithoutThumbnails, after, batch)
+            if not rows:
+                break
+            after = rows[-1][0]
+            album_ids = [row[0] for row in rows]
+            pictures = [bytes(row[1]) for row in rows]
+            for album_id, thumbnails in zip(album_ids, pool.map(images.make_thumbnails, pictures)):
+                if not thumbnails:
+                    skipped += 1
+                    continue
+                database.run(dbq.setAlbumThumbnails, album_id, thumbnails)
+                done += 1
+            click.echo(f"{done} albums done, {skipped} skipped")
+    click.echo(f"Finished: {done} albums thumbnailed, {skipped} pictures could not be read")
+
+
+@click.command("rebuild-album-summary")
+# Fill album_summary from scratch, needed once on a database created before the table existed
+def rebuild_album_summary():
+    database.run(dbq.rebuildAlbumSummary)
+    click.echo("album_summary rebuilt")
+
+
+@click.command("bulk-intake")
+@click.argument("upc_file", type=click.File("r"))
+@click.option("--report", "report_file", type=click.File("w"), default="-", help="Where to write the CSV report, defaults to stdout")
+@click.option("--concurrency", default=intake.INTAKE_CONCURRENCY, show_default=True, help="Discogs lookups in flight at once")
+# Look up a CSV or newline list of barcodes on Discogs and add every album not already in the library
+def bulk_intake(upc_file, report_file, concurrency):
+    upcs = intake.read_upcs(upc_file.read())
+    click.echo(f"{len(upcs)} barcodes read", err=True)
+    rows = database.run(intake.intake, upcs, concurrency)
+    writer = csv.writer(report_file)
+    writer.writerow(["upc", "status", "detail"])
+    writer.writerows(rows)
+    counts = {}
+    for row in rows:
+        counts[row[1]] = counts.get(row[1], 0) + 1
+    click.echo(", ".join(f"{count} {status}" for status, count in sorted(counts.items())), err=True)
+
+
+@click.command("benchmark")
+@click.option("--iterations", default=200, show_default=True, help="Timed calls per case")
+@click.option("--seed", default=0, show_default=True, help="Seed for the ids and search terms picked from the catalog")
+@click.option("--only", default=None, help="Only run cases whose name contains this, e.g. search: or manage_library")
+@click.option("--baseline", "baseline_path", default=benchmark.BASELINE_PATH, show_default=True, help="Baseline JSON to compare against")
+@click.option("--save-baseline", is_flag=True, help="Store this run as the new baseline")
+@click.option("--tolerance", default=benchmark.BENCHMARK_TOLERANCE, show_default=True, help="Allowed p95 growth before a case counts as a regression")
+# Check search paging, then time the dbq queries against the local database and flag regressions against the stored baseline
+def run_benchmark(iterations, seed, only, baseline_path, save_baseline, tolerance):
+    async def measure():
+        conn = await benchmark.connect(database.DATABASE_URL)
+        try:
+            return await benchmark.checkPaging(conn, seed), await benchmark.run(conn, iterations, seed, only)
+        finally:
+            await conn.close()
+    problems, results = asyncio.run(measure())
+    for genre, problem in problems:
+        click.echo(f"PAGING {genre}: {problem}", err=True)
+
+    baseline = benchmark.load_baseline(baseline_path) or {}
+    click.echo(f"{'case':<28}{'queries':>9}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'ops/s':>10}{'base p95':>10}")
+    for name, result in results.items():
+        before = baseline.get(name, {}).get("p95_ms", "")
+        click.echo(f"{name:<28}{result['queries']:>9}{result['p50_ms']:>10}{result['p95_ms']:>10}{result['p99_ms']:>10}{result['ops_per_s']:>10}{before:>10}")
+
+    if save_baseline:
+        benchmark.save_baseline(results, baseline_path)
+        click.echo(f"Baseline saved to {baseline_path}")
+        raise SystemExit(1 if problems else 0)
+    regressions = benchmark.compare(results, baseline, tolerance)
+    for name, reason in regressions:
+        click.echo(f"REGRESSION {name}: {reason}", err=True)
+    if regressions or problems:
+        raise SystemExit(1)
+
+
+@click.command("generate-catalog")
+@click.option("--seed", default=0, show_default=True, help="Same seed and sizes, same library")
+@click.option("--albums", default=catalog.CATALOG_ALBUMS, show_default=True)
+@click.option("--artists", default=catalog.CATALOG_ARTISTS, show_default=True)
+@click.option("--tracks-per-album", default=catalog.CATALOG_TRACKS_PER_ALBUM, show_default=True, help="Average, actual counts vary per album")
+@click.option("--users", default=catalog.CATALOG_USERS, show_default=True)
+@click.option("--reviews", default=catalog.CATALOG_REVIEWS, show_default=True)
+@click.option("--jobs", default=None, type=int, help="Shards generated and loaded at once, defaults to one per CPU")
+@click.option("--database-url", envvar="CATALOG_DATABASE_URL", required=True,
+              help="Connection string for the owner of the library tables (TRUNCATE, DROP/CREATE INDEX and ALTER TABLE "
+                   "need it, the app's library role can't), defaults to CATALOG_DATABASE_URL")
+@click.confirmation_option(prompt="This empties the users, review and every album table first, continue?")
+# Replace the library with a seeded synthetic catalog, for local development and benchmarks only
+def generate_catalog(seed, albums, artists, tracks_per_album, users, reviews, jobs, database_url):
+    start = time.monotonic()
+    def progress(step, rows, seconds):
+        click.echo(f"{step:<16}{rows:>10} rows {seconds:>7.1f}s")
+    catalog.load(database_url, seed, albums, artists, tracks_per_album, users, reviews, jobs, progress)
+    click.echo(f"Loaded in {time.monotonic() - start:.1f}s")
+
+
+@click.command("export-catalog")
+@click.option("--format", "fmt", type=click.Choice(sorted(export.FORMATS)), default="csv", show_default=True)
+@click.option("--output", type=click.File("w", encoding="utf-8"), default="-", help="Where to write the export, defaults to stdout")
+@click.option("--batch", default=export.EXPORT_BATCH, show_default=True, help="Albums fetched from the database at a time")
+# Stream every album with its artists, mediums/UPCs and tracks to a CSV or JSONL file
+def export_catalog(fmt, output, batch):
+    for chunk in database.stream(export.chunks, fmt, batch):
+        output.write(chunk)
@@ -0,0 +1,154 @@
+import asyncio, os, threading
+from contextlib import aclosing, asynccontextmanager
+from dotenv import load_dotenv
+from psycopg_pool import AsyncConnectionPool
+from library_manager import background, profiler
+
+load_dotenv()
+DATABASE_URL = os.getenv("DATABASE_URL")
+#Pool sizing, all of these can be overridden in .env
+POOL_MIN_SIZE = int(os.getenv("DB_POOL_MIN_SIZE", 2))
+POOL_MAX_SIZE = int(os.getenv("DB_POOL_MAX_SIZE", 10))
+#Seconds a request will wait for a free connection before failing
+POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", 30))
+#Idle connections above min_size are closed after this many seconds
+POOL_MAX_IDLE = float(os.getenv("DB_POOL_MAX_IDLE", 600))
+#Every connection is recycled after this many seconds, even if it is busy all day
+POOL_MAX_LIFETIME = float(os.getenv("DB_POOL_MAX_LIFETIME", 3600))
+#Executions before psycopg prepares a statement on its own, statements dbq runs with prepare=True skip the wait
+#"off" turns prepared statements off altogether, needed behind a transaction pooling pgbouncer
+PREPARE_THRESHOLD = os.getenv("DB_PREPARE_THRESHOLD", "5")
+PREPARE_THRESHOLD = None if PREPARE_THRESHOLD == "off" else int(PREPARE_THRESHOLD)
+#Prepared statements kept per connection, least recently used dropped first
+#Room for every search shape (see dbq._searchShape) plus the other hot queries
+PREPARED_MAX = int(os.getenv("DB_PREPARED_MAX", 200))
+
+#The pool (and its background maintenance tasks) lives on the shared background loop,
+#the connections it hands out are safe to use from the request loop
+_pool = None
+_pid = None
+_lock = threading.Lock()
+
+
+async def _configure(conn):
+    #Run once on every new connection before it joins the pool
+    conn.prepared_max = PREPARED_MAX
+
+
+async def _open():
+    pool = AsyncConnectionPool(
+        DATABASE_URL,
+        min_size=POOL_MIN_SIZE,
+        max_size=POOL_MAX_SIZE,
+        timeout=POOL_TIMEOUT,
+        max_idle=POOL_MAX_IDLE,
+        max_lifetime=POOL_MAX_LIFETIME,
+        # Health check run on every connection before it is handed out
+        check=AsyncConnectionPool.check_connection,
+        # Every statement is counted and timed against the request that sent it, and profiled unless SQL_PROFILE=0
+        kwargs={"cursor_factory": profiler.cursor_factory(), "prepare_threshold": PREPARE_THRESHOLD},
+        configure=_configure,
+        name="library",
+        open=False,
+    )
+    await pool.open()
+    return pool
+
+
+def _start():
+    global _pool, _pid
+    with _lock:
+        #Reopen after a fork (gunicorn --preload) so workers never share sockets
+        if _pool is not None and _pid == os.getpid():
+            return
+        _pool = background.run(_open())
+        _pid = os.getpid()
+
+
+def _submit(coro_fn, *args):
+    #Schedule coro_fn(*args) on the pool loop, returns a concurrent.futures.Future
+    _start()
+    return background.submit(coro_fn(*args))
+
+
+async def getconn():
+    #Borrow a connection, waits up to POOL_TIMEOUT if the pool is exhausted
+    return await asyncio.wrap_future(_submit(lambda: _pool.getconn()))
+
+
+async def putconn(conn):
+    #Return a connection, the pool rolls back anything left uncommitted
+    await asyncio.wrap_future(_submit(_pool.putconn, conn))
+
+
+@asynccontextmanager
+async def connection():
+    conn = await getconn()
+    try:
+        yield conn
+    finally:
+        await putconn(conn)
+
+
+async def _with_conn(coro_fn, *args):
+    async with _pool.connection() as conn:
+        return await coro_fn(conn, *args)
+
+
+def run(coro_fn, *args):
+    #Blocking helper for sync code (flask-login, CLI commands)
+    #Runs coro_fn(conn, *args) on the pool loop with a borrowed connection and returns the result
+    return _submit(_with_conn, coro_fn, *args).result()
+
+
+async def wait(coro_fn, *args):
+    #Same as run() for async callers, including ones already on the background loop
+    return await asyncio.wrap_future(_submit(_with_conn, coro_fn, *args))
+
+
+async def _next(agen):
+    #StopAsyncIteration can't cross back to the calling thread cleanly, so the end is flagged instead
+    try:
+        return True, await agen.__anext__()
+    except StopAsyncIteration:
+        return False, None
+
+
+async def _stream_with_conn(agen_fn, *args):
+    #aclosing so an iterator closed early (a client gone mid download) closes the generator, and whatever
+    #transaction or cursor it holds, before the connection goes back to the pool
+    async with _pool.connection() as conn, aclosing(agen_fn(conn, *args)) as agen:
+        async for item in agen:
+            yield item
+
+
+def stream(agen_fn, *args):
+    #Blocking iterator for sync code (streamed responses, CLI commands) over the async generator agen_fn(conn, *args)
+    #Each item is produced on the pool loop, the borrowed connection is held until the iterator is exhausted or closed
+    _start()
+    agen = _stream_with_conn(agen_fn, *args)
+    try:
+        while True:
+            more, item = background.run(_next(agen))
+            if not more:
+                return
+            yield item
+    finally:
+        background.run(agen.aclose())
+
+
+def stats():
+    #Pool counters (pool_size, pool_available, requests_waiting, requests_wait_ms, ...)
+    #get_stats() is used instead of pop_stats() so several readers see the same totals
+    if _pool is None:
+        return {}
+    return _pool.get_stats()
+
+
+def close():
+    global _pool, _pid
+    with _lock:
+        if _pool is None:
+            return
+        background.run(_pool.close())
+        _pool = _pid = None
@@ -1,205 +1,705 @@
+import base64, contextvars, functools, json, uuid
+from datetime import datetime
+from contextlib import asynccontextmanager
 import psycopg
+from library_manager.classes import User, AlbumEntry
+from library_manager.reference_cache import cache as referenceCache
 from library_manager.exceptions import *
 
 
+#################################################
+#               Transactions                    #
+#################################################
+
+#Connection whose unit of work is open in the current request/job, if any
+_unitOfWork = contextvars.ContextVar("unitOfWork", default=None)
+#Per process, commits is real COMMITs sent, deferred is commits a writer skipped inside a unit of work
+commitStats = {"commits": 0, "rollbacks": 0, "deferred": 0}
+
+@asynccontextmanager
+async def unitOfWork(conn: psycopg.AsyncConnection):
+    #Everything the dbq writers do inside this block commits (or rolls back) together, once, at the end
+    #Nested blocks on the same connection just join the outer one
+    if _unitOfWork.get() is conn:
+        yield conn
+        return
+    token = _unitOfWork.set(conn)
+    try:
+        yield conn
+    except BaseException:
+        await conn.rollback()
+        commitStats["rollbacks"] += 1
+        raise
+    else:
+        await conn.commit()
+        commitStats["commits"] += 1
+    finally:
+        _unitOfWork.reset(token)
+
+@asynccontextmanager
+async def rolledBackUnitOfWork(conn: psycopg.AsyncConnection):
+    #A unit of work that is always thrown away, for dry runs like the benchmark's write cases
+    #The writers inside defer their commits as usual and the rollback at the end drops everything they did
+    #Open it outside any other unit of work on the connection, the rollback would take that one with it
+    token = _unitOfWork.set(conn)
+    try:
+        yield conn
+    finally:
+        _unitOfWork.reset(token)
+        await conn.rollback()
+        commitStats["rollbacks"] += 1
+
+async def _commit(conn: psycopg.AsyncConnection):
+    #What every writer calls instead of conn.commit(), a no-op while a unit of work is open
+    if _unitOfWork.get() is conn:
+        commitStats["deferred"] += 1
+        return
+    await conn.commit()
+    commitStats["commits"] += 1
+
+
+#################################################
+#             Constraint Handling               #
+#################################################
+
+#Which exception a violated constraint turns into, and which argument holds the offending id
+#Names are the ones Postgres generates for the tables in libraryschema.sql
+_constraintErrors = {
+    "album_artist_albumid_fkey": (AlbumNotFoundError, "albumID"),
+    "album_artist_artistid_fkey": (ArtistNotFoundError, "artistID"),
+    "album_medium_albumid_fkey": (AlbumNotFoundError, "albumID"),
+    "album_medium_mediumid_fkey": (MediumNotFoundError, "mediumID"),
+    "album_track_albumid_fkey": (AlbumNotFoundError, "albumID"),
+    "album_track_trackid_fkey": (TrackNotFoundError, "trackID"),
+    "artist_track_artistid_fkey": (ArtistNotFoundError, "artistID"),
+    "artist_track_trackid_fkey": (TrackNotFoundError, "trackID"),
+    "review_album_albumid_fkey": (AlbumNotFoundError, "albumID"),
+    "review_album_reviewid_fkey": (ReviewNotFoundError, "reviewID"),
+    "review_album_pkey": (ReviewAlreadyExistsError, "reviewID"),
+    "users_userid_fk": (UserNotFoundError, "userID"),
+}
+
+#Table and exception for each id a writer can be handed
+_idTables = {
+    "albumID": ("album", AlbumNotFoundError),
+    "artistID": ("artist", ArtistNotFoundError),
+    "mediumID": ("medium", MediumNotFoundError),
+    "trackID": ("track", TrackNotFoundError),
+    "reviewID": ("review", ReviewNotFoundError),
+    "userID": ("users", UserNotFoundError),
+}
+
+@asynccontextmanager
+async def _constraints(conn: psycopg.AsyncConnection, **ids):
+    #Lets the foreign keys do the existence checks, mapping a violation to the library_manager.exceptions error
+    try:
+        yield
+    except psycopg.errors.IntegrityError as e:
+        #Outside a unit of work nobody else will clear the failed transaction
+        if _unitOfWork.get() is not conn:
+            await conn.rollback()
+        mapped = _constraintErrors.get(e.diag.constraint_name)
+        if mapped is None:
+            raise
+        error, key = mapped
+        raise error(ids[key]) from e
+
+async def _raiseMissing(conn: psycopg.AsyncConnection, *pairs, **ids):
+    #Only called once a write or lookup matched nothing, one query to say which id (if any) doesn't exist
+    #pairs are extra (key, value) checks run after ids, for writers handed two ids of the same kind
+    checks = [(key, value) for key, value in list(ids.items()) + list(pairs) if key in _idTables]
+    async with conn.cursor() as cur:
+        await cur.execute("SELECT " + ", ".join(
+            f"EXISTS (SELECT 1 FROM {_idTables[key][0]} WHERE {key} = %s)" for key, _ in checks
+        ), [value for _, value in checks])
+        found = await cur.fetchone()
+    for (key, value), exists in zip(checks, found):
+        if not exists:
+            raise _idTables[key][1](value)
+
+async def _writeAndList(conn: psycopg.AsyncConnection, write: str, writeParams: tuple, listing: str, listingParams: tuple, summary: bool = False, missing: tuple = (), **ids):
+    #Runs a link table write and the listing that reflects it in a single pipelined round trip
+    #summary also rebuilds the album's album_summary row in the same batch
+    #missing adds (key, value) pairs to check after ids when the write matched nothing
+    #Returns the listing rows, raising the matching not-found error if an id in ids doesn't exist
+    async with _constraints(conn, **ids), conn.cursor() as cur, conn.cursor() as listCur:
+        async with conn.pipeline():
+            await cur.execute(write, writeParams)
+            if summary:
+                await listCur.execute(_refreshSummary, ([ids["albumID"]],))
+            await listCur.execute(listing, listingParams)
+        changed = cur.rowcount
+        rows = await listCur.fetchall()
+    if not changed:
+        await _raiseMissing(conn, *missing, **ids)
+    await _commit(conn)
+    return rows
+
+
 #################################################
 #        Super Cool Search Functions            #
 #################################################
 
-async def searchlibrary(conn: psycopg.AsyncConnection, album: str, artist: str, genre: str, track: str, start: int = 0, limit: int = 50):
-    async with conn.cursor() as cur:
-        query = """
-        SELECT DISTINCT album.albumID, album.albumName, album.genre, artist.artistName, album.picture
-        FROM album
-        LEFT JOIN album_artist ON album.albumID = album_artist.albumID
-        LEFT JOIN artist ON album_artist.artistID = artist.artistID
-        LEFT JOIN album_track ON album.albumID = album_track.albumID
-        LEFT JOIN track ON album_track.trackID = track.trackID
-        WHERE 1=1
-        """
-        params = []
-        if album:
-            query += " AND album.albumName ILIKE %s"
-            params.append(f"%{album}%")
-        if artist:
-            query += " AND artist.artistName ILIKE %s"
-            params.append(f"%{artist}%")
-        if genre:
-            query += " AND album.genre ILIKE %s"
-            params.append(f"%{genre}%")
-        if track:
-            query += " AND track.trackName ILIKE %s"
-            params.append(f"%{track}%")
-
-        query += " ORDER BY album.albumName ASC LIMIT %s OFFSET %s"
-        params.extend([limit, start])
-
-        await cur.execute(query, params)
-        return await cur.fetchall()
+def _like(term: str):
+    #Wrap a search term for ILIKE, escaping the user's own wildcards
+    term = term.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+    return f"%{term}%"
+
+def encodeCursor(row):
+    #Opaque page token from a searchlibrary row, holds the row's sort key (rank, sortKey, albumID)
+    key = json.dumps([row[4], row[5], str(row[0])])
+    return base64.urlsafe_b64encode(key.encode("utf-8")).decode("ascii")
+
+def decodeCursor(token: str):
+    #Returns None for a missing or tampered token so the listing just starts over
+    if not token:
+        return None
+    try:
+        rank, sortKey, album_id = json.loads(base64.urlsafe_b64decode(token.encode("ascii")))
+        return float(rank), str(sortKey), uuid.UUID(album_id)
+    except (ValueError, TypeError):
+        return None
+
+#Statements run on every page view are executed with prepare=True, so each pooled connection parses and
+#plans them once and reuses the server-side prepared statement after that (psycopg keeps an LRU of them,
+#sized by DB_PREPARED_MAX in database.py). Search SQL is built per combination of filters and paging
+#rather than per term, which keeps it to a bounded set of shapes that can be prepared the same way.
+
+@functools.lru_cache(maxsize=None)
+def _searchShape(album: bool, artist: bool, genre: bool, track: bool, paged: bool, backward: bool):
+    #SQL for one combination of filters and paging, 16 filter sets x (first page, next, previous, last) at most
+    filters = []
+    scores = []
+    if album:
+        filters.append("albumName ILIKE %(album_like)s")
+        scores.append("similarity(albumName, %(album)s)")
+    if artist:
+        #artists is the whole display string, word_similarity scores the best matching stretch of it
+        filters.append("artists ILIKE %(artist_like)s")
+        scores.append("word_similarity(%(artist)s, artists)")
+    if genre:
+        filters.append("genre ILIKE %(genre_like)s")
+        scores.append("similarity(genre, %(genre)s)")
+    if track:
+        track_match = """
+            FROM album_track
+            JOIN track ON album_track.trackID = track.trackID
+            WHERE album_track.albumID = album_summary.albumID AND track.trackName ILIKE %(track_like)s"""
+        filters.append(f"EXISTS (SELECT 1 {track_match})")
+        scores.append(f"(SELECT max(similarity(track.trackName, %(track)s)) {track_match})")
+
+    where = " AND ".join(filters) if filters else "TRUE"
+    #With no terms every rank is 0, leaving it out of the ORDER BY lets (sortKey, albumID) use its index
+    #similarity() is a real, the rank is widened to float8 so the value a cursor carries back through
+    #Python compares equal to the one it was read from, otherwise rows tied on rank are skipped or repeated
+    if scores:
+        rank = f"({' + '.join(scores)})::float8"
+        order = [("rank", "DESC"), ("sortKey", "ASC"), ("albumID", "ASC")]
+    else:
+        rank = "0::float8"
+        order = [("sortKey", "ASC"), ("albumID", "ASC")]
+    keyset = "TRUE"
+    if paged:
+        after = "<" if backward else ">"
+        keyset = f"(sortKey, albumID) {after} (%(c_key)s, %(c_id)s)"
+        if scores:
+            before = ">" if backward else "<"
+            keyset = f"(rank {before} %(c_rank)s::float8 OR (rank = %(c_rank)s::float8 AND {keyset}))"
+    if backward:
+        flip = {"ASC": "DESC", "DESC": "ASC"}
+        order = [(column, flip[direction]) for column, direction in order]
+    return f"""
+        SELECT albumID, albumName, genre, artists, rank, sortKey, mediums, trackCount
+        FROM (
+            SELECT albumID, albumName, genre, artists, sortKey, mediums, trackCount, {rank} AS rank
+            FROM album_summary
+            WHERE {where}
+        ) scored
+        WHERE {keyset}
+        ORDER BY {", ".join(f"{column} {direction}" for column, direction in order)}
+        LIMIT %(limit)s
+    """
+
+async def searchlibrary(conn: psycopg.AsyncConnection, album: str, artist: str, genre: str, track: str, cursor: tuple = None, backward: bool = False, limit: int = 50):
+    #Reads album_summary, one row per album, so a page is exactly limit rows and needs no joins
+    #Every filter can use its trigram index (see libraryschema.sql), tracks aren't summarised
+    #so the track filter is the one EXISTS probe left
+    #Matches are ranked by trigram similarity to the search terms, best match first
+    #Pages are keyset based: cursor is the sort key of the last row seen (or the first row when
+    #going backward), so every page is an index range scan no matter how deep it is
+    #Returns (rows, more) where rows are (albumID, albumName, genre, artists, rank, sortKey, mediums, trackCount)
+    #and more says if there is another page in the direction travelled
+    params = {}
+    if album:
+        params.update(album=album, album_like=_like(album))
+    if artist:
+        params.update(artist=artist, artist_like=_like(artist))
+    if genre:
+        params.update(genre=genre, genre_like=_like(genre))
+    if track:
+        params.update(track=track, track_like=_like(track))
+    if cursor:
+        params.update(c_rank=cursor[0], c_key=cursor[1], c_id=cursor[2])
+    #One extra row tells us whether there is another page
+    params.update(limit=limit + 1)
+    query = _searchShape(bool(album), bool(artist), bool(genre), bool(track), bool(cursor), bool(backward))
+
+    async with conn.cursor() as cur:
+        await cur.execute(query, params, prepare=True)
+        rows = await cur.fetchall()
+
+    page = rows[:limit]
+    if backward:
+        page.reverse()
+    return page, len(rows) > limit
 
 
 
 #################################################
-#          Album_Artist Table Queries           #
+#              Typeahead Suggestions            #
 #################################################
 
-async def getAlbumArtists(conn: psycopg.AsyncConnection, albumID: str):
+#Suggestions come from the suggestion table, the triggers in libraryschema.sql keep its use counts current
+#so a keystroke reads a handful of index entries instead of counting the library
+suggestKinds = ("artist", "album", "track", "genre")
+#Prefixes shorter than this match a large share of the names, so the most used names are walked in order
+#and filtered instead, the first matches found are the answer
+SUGGEST_SCAN_BELOW = 2
+#Typo matching needs a whole trigram to go on, and only the closest names are ranked by use
+SUGGEST_FUZZY_MIN = 3
+SUGGEST_FUZZY_CANDIDATES = 50
+
+_suggestByUses = """
+    SELECT name, uses FROM suggestion
+    WHERE kind = %(kind)s AND lower(name) LIKE %(prefix)s
+    ORDER BY uses DESC, name
+    LIMIT %(limit)s
+"""
+#~>=~ and ~<~ are the text_pattern_ops comparisons, unlike LIKE they give a range scan even in a generic plan
+_suggestByPrefix = """
+    SELECT name, uses FROM suggestion
+    WHERE kind = %(kind)s AND lower(name) ~>=~ %(low)s AND lower(name) ~<~ %(high)s
+    ORDER BY uses DESC, name
+    LIMIT %(limit)s
+"""
+_suggestFuzzy = """
+    SELECT name, uses FROM (
+        SELECT name, uses FROM suggestion
+        WHERE kind = %(kind)s AND name %% %(term)s
+        ORDER BY name <-> %(term)s
+        LIMIT %(candidates)s
+    ) closest
+    ORDER BY uses DESC, name
+    LIMIT %(limit)s
+"""
+
+def _prefix(term: str):
+    #Lowercased LIKE pattern, escaping the user's own wildcards
+    term = term.lower().replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+    return f"{term}%"
+
+def _prefixRange(term: str):
+    #Bounds of every lowercased string starting with term, byte order matches code point order in UTF-8
+    low = term.lower()
+    last = ord(low[-1]) + 1
+    #Skip the surrogates, Postgres won't take them in a string
+    if 0xD800 <= last <= 0xDFFF:
+        last = 0xE000
+    return low, low[:-1] + chr(min(last, 0x10FFFF))
+
+async def suggest(conn: psycopg.AsyncConnection, kind: str, term: str, limit: int = 10):
+    #Top names of one kind for the autocomplete endpoint as (name, uses), most used first
+    #Prefix matches come first, if there aren't enough of them the names closest to term by
+    #trigram distance fill in, which also catches typos
+    #search_cache keeps the answer per typed prefix until the library changes
+    params = {"kind": kind, "term": term, "limit": limit, "candidates": SUGGEST_FUZZY_CANDIDATES}
     async with conn.cursor() as cur:
-        await cur.execute("""
-            SELECT artist.artistName
-            FROM album_artist
-            JOIN artist ON album_artist.artistID = artist.artistID
-            WHERE album_artist.albumID = %s
-        """, (albumID,))
-        return await cur.fetchall()
+        if len(term) < SUGGEST_SCAN_BELOW:
+            params["prefix"] = _prefix(term)
+            await cur.execute(_suggestByUses, params, prepare=True)
+        else:
+            params["low"], params["high"] = _prefixRange(term)
+            await cur.execute(_suggestByPrefix, params, prepare=True)
+        suggestions = await cur.fetchall()
+        if len(suggestions) < limit and len(term) >= SUGGEST_FUZZY_MIN:
+            await cur.execute(_suggestFuzzy, params, prepare=True)
+            seen = {row[0] for row in suggestions}
+            suggestions += [row for row in await cur.fetchall() if row[0] not in seen][:limit - len(suggestions)]
+    return suggestions
 
-async def addAlbumArtist(conn: psycopg.AsyncConnection, albumID: str, artistID: str):
-    from dbq.album import verifyAlbumUUID
-    from dbq.artist import verifyArtistUUID
-    if not await verifyAlbumUUID(conn, albumID):
-        raise AlbumNotFoundError(albumID)
-    if not await verifyArtistUUID(conn, artistID):
-        raise ArtistNotFoundError(artistID)
+
+#################################################
+#            Album Table Queries                #
+#################################################
+
+#Rebuilds the album_summary rows for a list of albumIDs (see refresh_album_summary in libraryschema.sql)
+_refreshSummary = "SELECT refresh_album_summary(%s::uuid[])"
+
+def _libraryChanged():
+    #Bumps the library generation so this worker's cached search pages go stale straight away
+    #The library triggers send the same bump to the other workers once the transaction commits
+    referenceCache.invalidate("library")
+
+async def getAlbumPicture(conn: psycopg.AsyncConnection, albumID: str, knownTags: list = ()):
+    #Returns (tag, picture) where tag is the md5 of the stored picture kept in album.pictureTag, usable as an ETag
+    #picture is left out (None) when the tag is one the client already has, so a 304 never reads the bytea
+    async with conn.cursor() as cur:
+        await cur.execute("""
+            SELECT pictureTag, CASE WHEN pictureTag = ANY(%s) THEN NULL ELSE picture END
+            FROM album
+            WHERE albumID = %s
+        """, (list(knownTags), albumID), prepare=True)
+        row = await cur.fetchone()
+        if row is None or row[0] is None:
+            return None, None
+        return row[0], row[1]
+
+#Everything the album page and the edit form need, one row per album whatever the track count
+#Track credits come from a lateral subquery instead of a getTrackArtists call per track
+_albumDetailQuery = """
+    SELECT album.albumName, album.albumShort, album.genre, album.releaseDate,
+        (SELECT coalesce(json_agg(artist.artistName), '[]')
+         FROM album_artist
+         JOIN artist ON artist.artistID = album_artist.artistID
+         WHERE album_artist.albumID = album.albumID),
+        (SELECT coalesce(json_agg(json_build_array(medium.mediumName, album_medium.albumUPC)), '[]')
+         FROM album_medium
+         JOIN medium ON medium.mediumID = album_medium.mediumID
+         WHERE album_medium.albumID = album.albumID),
+        (SELECT coalesce(json_agg(json_build_array(track.trackName, credits.names, track.trackDuration, track.fccClean)
+                               ORDER BY album_track.trackNumber, track.trackID), '[]')
+         FROM album_track
+         JOIN track ON track.trackID = album_track.trackID
+         CROSS JOIN LATERAL (
+             SELECT coalesce(json_agg(artist.artistName), '[]') AS names
+             FROM artist_track
+             JOIN artist ON artist.artistID = artist_track.artistID
+             WHERE artist_track.trackID = track.trackID
+         ) credits
+         WHERE album_track.albumID = album.albumID),
+        (SELECT coalesce(json_agg(json_build_array(review.reviewID, review.review, review.hidden, review.reviewDate, users.firstName, users.lastName) ORDER BY review.reviewDate), '[]')
+         FROM review_album
+         JOIN review ON review.reviewID = review_album.reviewID
+         JOIN users ON users.userID = review.userID
+         WHERE review_album.albumID = album.albumID)
+    FROM album
+    WHERE album.albumID = %s
+"""
+
+async def getAlbum(conn: psycopg.AsyncConnection, albumID: str):
+    #Returns a complete AlbumEntry or None, the picture is left out since album_art serves it
     async with conn.cursor() as cur:
+        await cur.execute(_albumDetailQuery, (albumID,), prepare=True)
+        row = await cur.fetchone()
+    if row is None:
+        return None
+    albumName, albumShort, genre, releaseDate, artists, mediums, tracks, reviews = row
+    upc = next((mediumUPC for _, mediumUPC in mediums if mediumUPC), None)
+    #Same tuple shape getReviewsForAlbum returns, json hands the date back as text
+    reviews = [(reviewID, review, hidden, datetime.fromisoformat(reviewDate), firstName, lastName)
+               for reviewID, review, hidden, reviewDate, firstName, lastName in reviews]
+    return AlbumEntry(upc, albumName, artists, genre, albumShort, releaseDate, [mediumName for mediumName, _ in mediums],
+                      None, tracks, album_id=str(albumID), reviews=reviews)
+
+async def verifyAlbumUUID(conn: psycopg.AsyncConnection, albumID: str):
+    async with conn.cursor() as cur:
+        await cur.execute("SELECT albumid FROM album WHERE albumid = %s", (albumID,), prepare=True)
+        UUID = await cur.fetchone()
+        return str(UUID[0]) if UUID else None
+
+async def _addAlbumLinks(conn: psycopg.AsyncConnection, cur: psycopg.AsyncCursor, albumID, albumUPC: str, artistNames: list, mediums: list, tracks: list, albumRow: tuple = None):
+    #Writes the tracks and every album_artist/album_medium/album_track/artist_track row for an album
+    #Artists are resolved up front, the rest goes out as one pipelined batch of set-based inserts
+    #albumRow is an optional (query, params) to run first in the same batch
+    artists = await resolveArtists(conn, list(artistNames) + [name for track in tracks for name in track[1]])
+    albumArtists = list(dict.fromkeys(artists[name] for name in artistNames))
+    #Track ids are made here so the artist_track pairs don't need a round trip to learn them
+    trackIDs = [uuid.uuid4() for _ in tracks]
+    credits = list(dict.fromkeys((artists[name], trackID) for trackID, track in zip(trackIDs, tracks) for name in track[1]))
+
+    async with conn.pipeline():
+        if albumRow:
+            await cur.execute(*albumRow)
         await cur.execute("""
             INSERT INTO album_artist (albumID, artistID)
-            VALUES (%s, %s)
-        """, (albumID, artistID))
-        await conn.commit()
-        return await getAlbumArtists(conn, albumID)
+            SELECT %s, unnest(%s::uuid[])
+        """, (albumID, albumArtists))
+        #Mediums that aren't in the medium table are skipped, the UPC goes on the first one that is
+        await cur.execute("""
+            INSERT INTO album_medium (albumID, mediumID, albumupc)
+            SELECT %s, mediumID, CASE WHEN row_number() OVER (ORDER BY ord) = 1 THEN %s END
+            FROM (
+                SELECT DISTINCT ON (medium.mediumID) medium.mediumID, names.ord
+                FROM unnest(%s::text[]) WITH ORDINALITY AS names(mediumName, ord)
+                JOIN medium ON medium.mediumName = names.mediumName
+                ORDER BY medium.mediumID, names.ord
+            ) found
+        """, (albumID, albumUPC, list(mediums)))
+        await cur.execute("""
+            INSERT INTO track (trackID, trackName, trackDuration, fccClean)
+            SELECT * FROM unnest(%s::uuid[], %s::text[], %s::text[], %s::bool[])
+        """, (trackIDs, [track[0] for track in tracks], [track[2] or "" for track in tracks],
+              [bool(track[3]) if len(track) > 3 else False for track in tracks]))
+        #Tracks are numbered in the order the form listed them
+        await cur.execute("""
+            INSERT INTO album_track (albumID, trackID, trackNumber)
+            SELECT %s, trackID, ord
+            FROM unnest(%s::uuid[]) WITH ORDINALITY AS tracks(trackID, ord)
+        """, (albumID, trackIDs))
+        await cur.execute("""
+            INSERT INTO artist_track (artistID, trackID)
+            SELECT * FROM unnest(%s::uuid[], %s::uuid[])
+        """, ([credit[0] for credit in credits], [credit[1] for credit in credits]))
+        await cur.execute(_refreshSummary, ([albumID],))
+
+async def addAlbum(conn: psycopg.AsyncConnection, albumName: str, albumShort: str, albumUPC: str, genre: str, releaseDate: int, artistNames: list, mediums: list, picture, tracks: list):
+    #tracks are [trackName, [artistNames], trackDuration, fccClean] lists like manage_library builds
+    #The whole album is one transaction and about three round trips however many tracks and credits it has
+    if isinstance(picture, str):
+        picture = picture.encode("utf-8")
+    albumID = uuid.uuid4()
+    async with conn.cursor() as cur:
+        await _addAlbumLinks(conn, cur, albumID, albumUPC, artistNames, mediums, tracks, ("""
+            INSERT INTO album (albumID, albumName, albumShort, genre, picture, releaseDate)
+            VALUES (%s, %s, %s, %s, %s, %s)
+        """, (albumID, albumName, albumShort or "", genre, picture, releaseDate)))
+        await _commit(conn)
+        _libraryChanged()
+        return str(albumID)
+
+async def _removeAlbumLinks(cur: psycopg.AsyncCursor, albumID: str):
+    #Clears every link row and the album's own tracks, returns the UPC that was on the album
+    await cur.execute("DELETE FROM album_artist WHERE albumID = %s", (albumID,))
+    await cur.execute("DELETE FROM album_medium WHERE albumID = %s RETURNING albumupc", (albumID,))
+    upcs = [row[0] for row in await cur.fetchall() if row[0]]
+    await cur.execute("""
+        WITH gone AS (DELETE FROM album_track WHERE albumID = %s RETURNING trackID),
+        credits AS (DELETE FROM artist_track WHERE trackID IN (SELECT trackID FROM gone))
+        DELETE FROM track WHERE trackID IN (SELECT trackID FROM gone)
+    """, (albumID,))
+    return upcs[0] if upcs else None
+
+async def updateAlbum(conn: psycopg.AsyncConnection, albumID: str, albumName: str, albumShort: str, genre: str, releaseDate: int, picture, tracks: list, artistNames: list, mediums: list):
+    #Rewrites an album's links and tracks from scratch in one transaction
+    #picture None keeps the current art, the existing UPC is carried over to the new primary medium
+    if isinstance(picture, str):
+        picture = picture.encode("utf-8")
+    async with conn.cursor() as cur:
+        await cur.execute("""
+            UPDATE album
+            SET albumName = %s, albumShort = %s, genre = %s, releaseDate = %s, picture = COALESCE(%s, picture)
+            WHERE albumID = %s
+            RETURNING albumID
+        """, (albumName, albumShort or "", genre, releaseDate, picture, albumID))
+        if await cur.fetchone() is None:
+            raise AlbumNotFoundError(albumID)
+        albumUPC = await _removeAlbumLinks(cur, albumID)
+        await _addAlbumLinks(conn, cur, albumID, albumUPC, artistNames, mediums, tracks)
+        await _commit(conn)
+        _libraryChanged()
+        return albumID
+
+async def removeAlbum(conn: psycopg.AsyncConnection, albumID: str):
+    #Reviews are kept for the reviewers' history, only their link to the album goes
+    async with conn.cursor() as cur:
+        await _removeAlbumLinks(cur, albumID)
+        await cur.execute("DELETE FROM review_album WHERE albumID = %s", (albumID,))
+        await cur.execute("DELETE FROM album WHERE albumID = %s RETURNING albumID", (albumID,))
+        deleted = await cur.fetchone()
+        await _commit(conn)
+        _libraryChanged()
+        if deleted is None:
+            raise AlbumNotFoundError(albumID)
+        return str(deleted[0])
+
+async def rebuildAlbumSummary(conn: psycopg.AsyncConnection):
+    #Rebuilds every album_summary row, for databases that had albums before the table existed
+    async with conn.cursor() as cur:
+        await cur.execute("SELECT refresh_album_summary(array(SELECT albumID FROM album))")
+        await _commit(conn)
+    _libraryChanged()
 
-async def removeAlbumArtist(conn: psycopg.AsyncConnection, albumID: str, artistID: str):
-    from dbq.album import verifyAlbumUUID
-    from dbq.artist import verifyArtistUUID
+async def getExistingUPCs(conn: psycopg.AsyncConnection, upcs: list):
+    #Which of these barcodes are already on an album, as a set
+    async with conn.cursor() as cur:
+        await cur.execute("SELECT albumupc FROM album_medium WHERE albumupc = ANY(%s)", (list(upcs),))
+        return {str(row[0]) for row in await cur.fetchall()}
 
-    if not await verifyAlbumUUID(conn, albumID):
-        raise AlbumNotFoundError(albumID)
-    if not await verifyArtistUUID(conn, artistID):
-        raise ArtistNotFoundError(artistID)
+async def getAlbumsWithoutThumbnails(conn: psycopg.AsyncConnection, afterID: str = None, limit: int = 100):
+    #Albums that have a picture but no thumbnails yet, in albumID order so the backfill can page through them
     async with conn.cursor() as cur:
         await cur.execute("""
-            DELETE FROM album_artist
-            WHERE albumID = %s AND artistID = %s
-        """, (albumID, artistID))
-        await conn.commit()
-        return await getAlbumArtists(conn, albumID)
+            SELECT album.albumID, album.picture
+            FROM album
+            WHERE album.picture IS NOT NULL
+            AND (%s::uuid IS NULL OR album.albumID > %s::uuid)
+            AND NOT EXISTS (SELECT 1 FROM album_thumbnail WHERE album_thumbnail.albumID = album.albumID)
+            ORDER BY album.albumID
+            LIMIT %s
+        """, (afterID, afterID, limit))
+        return await cur.fetchall()
+
+#Every album with its artists, mediums/UPCs and tracks, pictures left out
+_exportQuery = """
+    SELECT album.albumID, album.albumName, album.albumShort, album.genre, album.releaseDate,
+        (SELECT coalesce(json_agg(artist.artistName ORDER BY artist.artistName), '[]')
+         FROM album_artist
+         JOIN artist ON artist.artistID = album_artist.artistID
+         WHERE album_artist.albumID = album.albumID),
+        (SELECT coalesce(json_agg(json_build_array(medium.mediumName, album_medium.albumUPC) ORDER BY medium.mediumName), '[]')
+         FROM album_medium
+         JOIN medium ON medium.mediumID = album_medium.mediumID
+         WHERE album_medium.albumID = album.albumID),
+        (SELECT coalesce(json_agg(json_build_array(track.trackName, credits.names, track.trackDuration, track.fccClean)
+                               ORDER BY album_track.trackNumber, track.trackID), '[]')
+         FROM album_track
+         JOIN track ON track.trackID = album_track.trackID
+         CROSS JOIN LATERAL (
+             SELECT coalesce(json_agg(artist.artistName ORDER BY artist.artistName), '[]') AS names
+             FROM artist_track
+             JOIN artist ON artist.artistID = artist_track.artistID
+             WHERE artist_track.trackID = track.trackID
+         ) credits
+         WHERE album_track.albumID = album.albumID)
+    FROM album
+    ORDER BY album.albumID
+"""
+
+async def exportAlbums(conn: psycopg.AsyncConnection, batch: int = 500):
+    #Yields lists of up to batch rows (albumID, albumName, albumShort, genre, releaseDate, artists, mediums, tracks)
+    #A named cursor keeps the result on the server, so memory stays at one batch however big the library is
+    #Runs in its own transaction (a savepoint inside a unit of work), the cursor lives until it ends
+    async with conn.transaction():
+        async with conn.cursor(name="export_albums") as cur:
+            cur.itersize = batch
+            await cur.execute(_exportQuery)
+            while True:
+                rows = await cur.fetchmany(batch)
+                if not rows:
+                    break
+                yield rows
 
-async def modifyAlbumArtist(conn: psycopg.AsyncConnection, albumID: str, oldArtistID: str, newArtistID: str):
-    from dbq.album import verifyAlbumUUID
-    from dbq.artist import verifyArtistUUID
 
-    if not await verifyAlbumUUID(conn, albumID):
-        raise AlbumNotFoundError(albumID)
-    if not await verifyArtistUUID(conn, oldArtistID):
-        raise ArtistNotFoundError(oldArtistID)
-    if not await verifyArtistUUID(conn, newArtistID):
-        raise ArtistNotFoundError(newArtistID)
+#################################################
+#          Album_Thumbnail Table Queries        #
+#################################################
+
+async def getAlbumThumbnail(conn: psycopg.AsyncConnection, albumID: str, size: int, knownTags: list = ()):
+    #Same contract as getAlbumPicture, returns (tag, mimetype, image) with image left out on a tag match
     async with conn.cursor() as cur:
         await cur.execute("""
-            UPDATE album_artist
-            SET artistID = %s
-            WHERE albumID = %s AND artistID = %s
-        """, (newArtistID, albumID, oldArtistID))
-        await conn.commit()
-        return await getAlbumArtists(conn, albumID)
+            SELECT tag, mimetype, CASE WHEN tag = ANY(%s) THEN NULL ELSE image END
+            FROM album_thumbnail
+            WHERE albumID = %s AND size = %s
+        """, (list(knownTags), albumID, size), prepare=True)
+        row = await cur.fetchone()
+        if row is None:
+            return None, None, None
+        return row[0], row[1], row[2]
 
-async def verifyAlbumArtist(conn: psycopg.AsyncConnection, albumID: str, artistID: str):
-    from dbq.album import verifyAlbumUUID
-    from dbq.artist import verifyArtistUUID
+async def setAlbumThumbnails(conn: psycopg.AsyncConnection, albumID: str, thumbnails: list):
+    #thumbnails is the [(size, mimetype, image)] list from images.make_thumbnails, replaces whatever was there
+    async with conn.cursor() as cur:
+        await cur.execute("DELETE FROM album_thumbnail WHERE albumID = %s", (albumID,))
+        await cur.executemany("""
+            INSERT INTO album_thumbnail (albumID, size, mimetype, image)
+            VALUES (%s, %s, %s, %s)
+        """, [(albumID, size, mimetype, image) for size, mimetype, image in thumbnails])
+        await _commit(conn)
+
+
+#################################################
+#          Album_Artist Table Queries           #
+#################################################
+
+_albumArtistsQuery = """
+    SELECT artist.artistName
+    FROM album_artist
+    JOIN artist ON album_artist.artistID = artist.artistID
+    WHERE album_artist.albumID = %s
+"""
+
+async def getAlbumArtists(conn: psycopg.AsyncConnection, albumID: str):
+    async with conn.cursor() as cur:
+        await cur.execute(_albumArtistsQuery, (albumID,))
+        return await cur.fetchall()
+
+async def addAlbumArtist(conn: psycopg.AsyncConnection, albumID: str, artistID: str):
+    return await _writeAndList(conn, """
+        INSERT INTO album_artist (albumID, artistID)
+        VALUES (%s, %s)
+    """, (albumID, artistID), _albumArtistsQuery, (albumID,), summary=True, albumID=albumID, artistID=artistID)
+
+async def removeAlbumArtist(conn: psycopg.AsyncConnection, albumID: str, artistID: str):
+    return await _writeAndList(conn, """
+        DELETE FROM album_artist
+        WHERE albumID = %s AND artistID = %s
+    """, (albumID, artistID), _albumArtistsQuery, (albumID,), summary=True, albumID=albumID, artistID=artistID)
 
-    if not await verifyAlbumUUID(conn, albumID):
-        raise AlbumNotFoundError(albumID)
-    if not await verifyArtistUUID(conn, artistID):
-        raise ArtistNotFoundError(artistID)
+async def modifyAlbumArtist(conn: psycopg.AsyncConnection, albumID: str, oldArtistID: str, newArtistID: str):
+    #A missing new artist trips the foreign key, a missing album or old artist just matches nothing
+    #and is then checked in the same order as before: album, old artist, new artist
+    rows = await _writeAndList(conn, """
+        UPDATE album_artist
+        SET artistID = %s
+        WHERE albumID = %s AND artistID = %s
+    """, (newArtistID, albumID, oldArtistID), _albumArtistsQuery, (albumID,), summary=True,
+        missing=(("artistID", oldArtistID), ("artistID", newArtistID)), albumID=albumID, artistID=newArtistID)
+    return rows
+
+async def verifyAlbumArtist(conn: psycopg.AsyncConnection, albumID: str, artistID: str):
     async with conn.cursor() as cur:
         await cur.execute("""
             SELECT 1
             FROM album_artist
             WHERE albumID = %s AND artistID = %s
         """, (albumID, artistID))
-        return await cur.fetchone() is not None
+        if await cur.fetchone() is not None:
+            return True
+    await _raiseMissing(conn, albumID=albumID, artistID=artistID)
+    return False
 
 
 #################################################
 #          Album_Medium Table Queries           #
 #################################################
 
+_albumMediumsQuery = """
+    SELECT medium.mediumName
+    FROM album_medium
+    JOIN medium ON album_medium.mediumID = medium.mediumID
+    WHERE album_medium.albumID = %s
+"""
+
 async def getAlbumMediums(conn: psycopg.AsyncConnection, albumID: str):
-    from dbq.album import verifyAlbumUUID
-    if not await verifyAlbumUUID(conn, albumID):
-        raise AlbumNotFoundError(albumID)
     async with conn.cursor() as cur:
-        await cur.execute("""
-            SELECT medium.mediumName
-            FROM album_medium
-            JOIN medium ON album_medium.mediumID = medium.mediumID
-            WHERE album_medium.albumID = %s
-        """, (albumID,))
-        return await cur.fetchall()
+        await cur.execute(_albumMediumsQuery, (albumID,))
+        mediums = await cur.fetchall()
+    #An album with no mediums is rare, only then check whether the album is there at all
+    if not mediums:
+        await _raiseMissing(conn, albumID=albumID)
+    return mediums
 
 async def addAlbumMedium(conn: psycopg.AsyncConnection, albumID: str, mediumID: str, albumUPC: str):
-    from dbq.album import verifyAlbumUUID
-    from dbq.medium import verifyMediumUUID
-
-    if not await verifyAlbumUUID(conn, albumID):
-        raise AlbumNotFoundError(albumID)
-    if not await verifyMediumUUID(conn, mediumID):
-        raise MediumNotFoundError(mediumID)
-    async with conn.cursor() as cur:
-        if albumUPC is None:
-            await cur.execute("""
-                INSERT INTO album_medium (albumID, mediumID)
-                VALUES (%s, %s)
-            """, (albumID, mediumID))
-        else:
-            await cur.execute("""
-                INSERT INTO album_medium (albumID, mediumID, albumupc)
-                VALUES (%s, %s, %s)
-            """, (albumID, mediumID, albumUPC))
-            await conn.commit()
-        return await getAlbumMediums(conn, albumID)
+    return await _writeAndList(conn, """
+        INSERT INTO album_medium (albumID, mediumID, albumupc)
+        VALUES (%s, %s, %s)
+    """, (albumID, mediumID, albumUPC), _albumMediumsQuery, (albumID,), summary=True, albumID=albumID, mediumID=mediumID)
 
 async def removeAlbumMedium(conn: psycopg.AsyncConnection, albumID: str, mediumID: str):
-    from dbq.album import verifyAlbumUUID
-    from dbq.medium import verifyMediumUUID
-
-    if not await verifyAlbumUUID(conn, albumID):
-        raise AlbumNotFoundError(albumID)
-    if not await verifyMediumUUID(conn, mediumID):
-        raise MediumNotFoundError(mediumID)
-    async with conn.cursor() as cur:
-        await cur.execute("""
-            DELETE FROM album_medium
-            WHERE albumID = %s AND mediumID = %s
-        """, (albumID, mediumID))
-        await conn.commit()
-        return await getAlbumMediums(conn, albumID)
+    return await _writeAndList(conn, """
+        DELETE FROM album_medium
+        WHERE albumID = %s AND mediumID = %s
+    """, (albumID, mediumID), _albumMediumsQuery, (albumID,), summary=True, albumID=albumID, mediumID=mediumID)
 
 async def modifyAlbumMediumUPC(conn: psycopg.AsyncConnection, albumID: str, mediumID: str, newUPC: str):
-    from dbq.album import verifyAlbumUUID
-    from dbq.medium import verifyMediumUUID
-
-    if not await verifyAlbumUUID(conn, albumID):
-        raise AlbumNotFoundError(albumID)
-    if not await verifyMediumUUID(conn, mediumID):
-        raise MediumNotFoundError(mediumID)
-    async with conn.cursor() as cur:
-        await cur.execute("""
-            UPDATE album_medium
-            SET albumupc = %s
-            WHERE albumID = %s AND mediumID = %s
-        """, (newUPC, albumID, mediumID))
-        await conn.commit()
-        return await getAlbumMediums(conn, albumID)
+    return await _writeAndList(conn, """
+        UPDATE album_medium
+        SET albumupc = %s
+        WHERE albumID = %s AND mediumID = %s
+    """, (newUPC, albumID, mediumID), _albumMediumsQuery, (albumID,), albumID=albumID, mediumID=mediumID)
 
 async def getAlbumMediumUPC(conn: psycopg.AsyncConnection, albumID: str, mediumID: str):
-    from dbq.album import verifyAlbumUUID
-    from dbq.medium import verifyMediumUUID
-
-    if not await verifyAlbumUUID(conn, albumID):
-        raise AlbumNotFoundError(albumID)
-    if not await verifyMediumUUID(conn, mediumID):
-        raise MediumNotFoundError(mediumID)
     async with conn.cursor() as cur:
         await cur.execute("""
             SELECT albumupc
@@ -207,23 +707,21 @@ async def getAlbumMediumUPC(conn: psycopg.AsyncConnection, albumID: str, mediumI
             WHERE albumID = %s AND mediumID = %s
         """, (albumID, mediumID))
         upc = await cur.fetchone()
-        return str(upc[0]) if upc else None
+    if upc is None:
+        await _raiseMissing(conn, albumID=albumID, mediumID=mediumID)
+    return str(upc[0]) if upc and upc[0] is not None else None
 
 async def verifyAlbumMedium(conn: psycopg.AsyncConnection, albumID: str, mediumID: str):
-    from dbq.album import verifyAlbumUUID
-    from dbq.medium import verifyMediumUUID
-
-    if not await verifyAlbumUUID(conn, albumID):
-        raise AlbumNotFoundError(albumID)
-    if not await verifyMediumUUID(conn, mediumID):
-        raise MediumNotFoundError(mediumID)
     async with conn.cursor() as cur:
         await cur.execute("""
             SELECT 1
             FROM album_medium
             WHERE albumID = %s AND mediumID = %s
         """, (albumID, mediumID))
-        return await cur.fetchone() is not None
+        if await cur.fetchone() is not None:
+            return True
+    await _raiseMissing(conn, albumID=albumID, mediumID=mediumID)
+    return False
 
 async def getAlbumNameByUPC(conn: psycopg.AsyncConnection, upc: str):
     async with conn.cursor() as cur:
@@ -241,47 +739,31 @@ async def getAlbumNameByUPC(conn: psycopg.AsyncConnection, upc: str):
 #          Album_Track Table Queries           #
 #################################################
 
+_albumTracksQuery = """
+    SELECT track.trackName
+    FROM album_track
+    JOIN track ON album_track.trackID = track.trackID
+    WHERE album_track.albumID = %s
+    ORDER BY album_track.trackNumber, track.trackID
+"""
+
 async def getAlbumTracks(conn: psycopg.AsyncConnection, albumID: str):
     async with conn.cursor() as cur:
-        await cur.execute("""
-            SELECT track.trackName
-            FROM album_track
-            JOIN track ON album_track.trackID = track.trackID
-            WHERE album_track.albumID = %s
-        """, (albumID,))
+        await cur.execute(_albumTracksQuery, (albumID,))
         return await cur.fetchall()
 
 async def addAlbumTrack(conn: psycopg.AsyncConnection, albumID: str, trackID: str):
-    from dbq.track import verifyTrackUUID
-    from dbq.album import verifyAlbumUUID
-
-    if not await verifyAlbumUUID(conn, albumID):
-        raise AlbumNotFoundError(albumID)
-    if not await verifyTrackUUID(conn, trackID):
-        raise TrackNotFoundError(trackID)
-    async with conn.cursor() as cur:
-        await cur.execute("""
-            INSERT INTO album_track (albumID, trackID)
-            VALUES (%s, %s)
-        """, (albumID, trackID))
-        await conn.commit()
-        return await getAlbumTracks(conn, albumID)
+    #The new track goes on the end of the album
+    return await _writeAndList(conn, """
+        INSERT INTO album_track (albumID, trackID, trackNumber)
+        VALUES (%s, %s, (SELECT coalesce(max(trackNumber), 0) + 1 FROM album_track WHERE albumID = %s))
+    """, (albumID, trackID, albumID), _albumTracksQuery, (albumID,), summary=True, albumID=albumID, trackID=trackID)
 
 async def removeAlbumTrack(conn: psycopg.AsyncConnection, albumID: str, trackID: str):
-    from dbq.track import verifyTrackUUID
-    from dbq.album import verifyAlbumUUID
-
-    if not await verifyAlbumUUID(conn, albumID):
-        raise AlbumNotFoundError(albumID)
-    if not await verifyTrackUUID(conn, trackID):
-        raise TrackNotFoundError(trackID)
-    async with conn.cursor() as cur:
-        await cur.execute("""
-            DELETE FROM album_track
-            WHERE albumID = %s AND trackID = %s
-        """, (albumID, trackID))
-        await conn.commit()
-        return await getAlbumTracks(conn, albumID)
+    return await _writeAndList(conn, """
+        DELETE FROM album_track
+        WHERE albumID = %s AND trackID = %s
+    """, (albumID, trackID), _albumTracksQuery, (albumID,), summary=True, albumID=albumID, trackID=trackID)
 
 
 
@@ -291,7 +773,7 @@ async def removeAlbumTrack(conn: psycopg.AsyncConnection, albumID: str, trackID:
 
 async def getArtistUUID(conn:psycopg.AsyncConnection, artistName: str):
     async with conn.cursor() as cur:
-        await cur.execute("SELECT artistid FROM artist WHERE artistname = %s", (artistName,))
+        await cur.execute("SELECT artistid FROM artist WHERE artistname = %s", (artistName,), prepare=True)
         UUID = await cur.fetchone()
         return str(UUID[0]) if UUID else None
 
@@ -301,21 +783,45 @@ async def verifyArtistUUID(conn:psycopg.AsyncConnection, artistID: str):
         UUID = await cur.fetchone()
         return str(UUID[0]) if UUID else None
 
-async def addArtist(conn:psycopg.AsyncConnection, artistName: str):
+async def resolveArtists(conn:psycopg.AsyncConnection, artistNames: list):
+    #name -> artistID for every name, creating the missing ones in a single statement
+    #Doesn't commit, the new artists go in with whatever write needed them
+    names = list(dict.fromkeys(artistNames))
+    if not names:
+        return {}
     async with conn.cursor() as cur:
-        if await getArtistUUID(conn, artistName) is None:
-            await cur.execute("INSERT INTO artist (artistName) VALUES (%s)", (artistName,))
-            await conn.commit()
-            return await getArtistUUID(conn, artistName)
-        else:
-            return await getArtistUUID(conn, artistName)
+        #Inserting in name order means two batches with overlapping names can't deadlock on each other
+        await cur.execute("""
+            WITH names AS (SELECT DISTINCT unnest(%s::text[]) AS artistName),
+            added AS (
+                INSERT INTO artist (artistName)
+                SELECT artistName FROM names ORDER BY artistName
+                ON CONFLICT (artistName) DO NOTHING
+                RETURNING artistID, artistName
+            )
+            SELECT artistID, artistName FROM added
+            UNION ALL
+            SELECT artist.artistID, artist.artistName FROM artist JOIN names USING (artistName)
+        """, (names,))
+        artists = {row[1]: row[0] for row in await cur.fetchall()}
+        missing = [name for name in names if name not in artists]
+        if missing:
+            #Another transaction committed these after our statement started, they're visible now
+            await cur.execute("SELECT artistID, artistName FROM artist WHERE artistName = ANY(%s)", (missing,))
+            artists.update({row[1]: row[0] for row in await cur.fetchall()})
+    return artists
+
+async def addArtist(conn:psycopg.AsyncConnection, artistName: str):
+    artists = await resolveArtists(conn, [artistName])
+    await _commit(conn)
+    return str(artists[artistName])
 
 async def removeArtist(conn:psycopg.AsyncConnection, artistName: str):
     async with conn.cursor() as cur:
         UUID = await getArtistUUID(conn, artistName)
         if UUID is not None:
             await cur.execute("DELETE FROM artist WHERE artistid = %s", (str(UUID[0]),))
-            await conn.commit()
+            await _commit(conn)
             return await getArtistUUID(conn, artistName)
         else:
             return ArtistNotFoundError(artistName)
@@ -325,9 +831,11 @@ async def modifyArtist(conn:psycopg.AsyncConnection, artistID: str, newArtistNam
         oldname = await cur.execute("SELECT artistName FROM artist WHERE artistid = %s", (artistID,))
         if oldname is not None:
             await cur.execute("UPDATE artist SET artistname = %s WHERE artistid = %s", (newArtistName, artistID))
+            #The artist display string on every album they're credited on changes with the name
+            await cur.execute("SELECT refresh_album_summary(array(SELECT albumID FROM album_artist WHERE artistID = %s))", (artistID,))
         else:
             raise ArtistNotFoundError(artistID)
-        await conn.commit()
+        await _commit(conn)
         return await getArtistUUID(conn, newArtistName)
 
 async def getArtistName(conn:psycopg.AsyncConnection, artistID: str):
@@ -341,47 +849,29 @@ async def getArtistName(conn:psycopg.AsyncConnection, artistID: str):
 #          Artist_Track Table Queries           #
 #################################################
 
+_artistTracksQuery = """
+    SELECT track.trackName
+    FROM artist_track
+    JOIN track ON artist_track.trackID = track.trackID
+    WHERE artist_track.artistID = %s
+"""
+
 async def getArtistTracks(conn: psycopg.AsyncConnection, artistID: str):
     async with conn.cursor() as cur:
-        await cur.execute("""
-            SELECT track.trackName
-            FROM artist_track
-            JOIN track ON artist_track.trackID = track.trackID
-            WHERE artist_track.artistID = %s
-        """, (artistID,))
+        await cur.execute(_artistTracksQuery, (artistID,))
         return await cur.fetchall()
 
 async def addArtistTrack(conn: psycopg.AsyncConnection, artistID: str, trackID: str):
-    from dbq.track import verifyTrackUUID
-    from dbq.artist import verifyArtistUUID
-
-    if not await verifyArtistUUID(conn, artistID):
-        raise ArtistNotFoundError(artistID)
-    if not await verifyTrackUUID(conn, trackID):
-        raise TrackNotFoundError(trackID)
-    async with conn.cursor() as cur:
-        await cur.execute("""
-            INSERT INTO artist_track (artistID, trackID)
-            VALUES (%s, %s)
-        """, (artistID, trackID))
-        await conn.commit()
-        return await getArtistTracks(conn, artistID)
+    return await _writeAndList(conn, """
+        INSERT INTO artist_track (artistID, trackID)
+        VALUES (%s, %s)
+    """, (artistID, trackID), _artistTracksQuery, (artistID,), artistID=artistID, trackID=trackID)
 
 async def removeArtistTrack(conn: psycopg.AsyncConnection, artistID: str, trackID: str):
-    from dbq.track import verifyTrackUUID
-    from dbq.artist import verifyArtistUUID
-
-    if not await verifyTrackUUID(conn, artistID):
-        raise ArtistNotFoundError(artistID)
-    if not await verifyArtistUUID(conn, trackID):
-        raise TrackNotFoundError(trackID)
-    async with conn.cursor() as cur:
-        await cur.execute("""
-            DELETE FROM artist_track
-            WHERE artistID = %s AND trackID = %s
-        """, (artistID, trackID))
-        await conn.commit()
-        return await getArtistTracks(conn, artistID)
+    return await _writeAndList(conn, """
+        DELETE FROM artist_track
+        WHERE artistID = %s AND trackID = %s
+    """, (artistID, trackID), _artistTracksQuery, (artistID,), artistID=artistID, trackID=trackID)
 
 async def getTrackArtists(conn: psycopg.AsyncConnection, trackID: str):
     async with conn.cursor() as cur:
@@ -399,6 +889,10 @@ async def getTrackArtists(conn: psycopg.AsyncConnection, trackID: str):
 #################################################
 
 async def getAllMediums(conn:psycopg.AsyncConnection):
+    #Served from the reference cache, the medium trigger clears it on any change
+    return list(await referenceCache.get("medium", "all", lambda: _loadAllMediums(conn)))
+
+async def _loadAllMediums(conn:psycopg.AsyncConnection):
     async with conn.cursor() as cur:
         await cur.execute("SELECT mediumid, mediumname FROM medium")
         mediums = await cur.fetchall()
@@ -423,7 +917,7 @@ async def addMedium(conn:psycopg.AsyncConnection, mediumName: str):
     async with conn.cursor() as cur:
         if await getMediumUUID(conn, mediumName) is None:
             await cur.execute("INSERT INTO medium (mediumName) VALUES (%s)", (mediumName,))
-            await conn.commit()
+            await _commit(conn)
             return await getMediumUUID(conn, mediumName)
         else:
             return await getMediumUUID(conn, mediumName)
@@ -436,8 +930,9 @@ async def removeMedium(conn:psycopg.AsyncConnection, mediumID: str, mediumModNam
             newMedUUID = await getMediumUUID(conn, mediumModName)
         async with conn.cursor() as cur:
             await cur.execute("UPDATE album_medium SET mediumid = %s WHERE mediumid = %s", (newMedUUID, (str(mediumID[0]))))
+            await cur.execute("SELECT refresh_album_summary(array(SELECT albumID FROM album_medium WHERE mediumID = %s))", (newMedUUID,))
             await cur.execute("DELETE FROM medium WHERE mediumid = %s", (str(mediumID[0]),))
-            await conn.commit()
+            await _commit(conn)
             return await verifyMediumUUID(conn, mediumID)
     else:
         return MediumNotFoundError(mediumID)
@@ -446,6 +941,7 @@ async def modifyMedium(conn:psycopg.AsyncConnection, mediumID: str, newMediumNam
     async with conn.cursor() as cur:
         if await verifyMediumUUID(conn, mediumID) is not None:
             await cur.execute("UPDATE medium SET mediumname = %s WHERE mediumid = %s", (newMediumName, mediumID))
+            await cur.execute("SELECT refresh_album_summary(array(SELECT albumID FROM album_medium WHERE mediumID = %s))", (mediumID,))
         else:
             raise MediumNotFoundError(mediumID)
 
@@ -461,58 +957,39 @@ async def getReviewUUID(conn:psycopg.AsyncConnection, reviewID: str):
         return str(UUID[0]) if UUID else None
 
 async def addReview(conn:psycopg.AsyncConnection, reviewText: str, userID: str, hidden: bool = True):
-    from dbq.user import verifyUserUUID
-
-    if await verifyUserUUID(conn, userID) is None:
-        raise UserNotFoundError(userID)
-    async with conn.cursor() as cur:
-        if await getReviewUUID(conn, reviewText) is None:
-            await cur.execute("INSERT INTO review (review, userID, hidden) VALUES (%s, %s, %s)", (reviewText, userID, hidden))
-            await conn.commit()
-            return await getReviewUUID(conn, reviewText)
-        else:
-            return await getReviewUUID(conn, reviewText)
+    #The review's foreign key stands in for the user lookup
+    async with _constraints(conn, userID=userID), conn.cursor() as cur:
+        await cur.execute("INSERT INTO review (review, userID, hidden) VALUES (%s, %s, %s) RETURNING reviewid", (reviewText, userID, hidden))
+        UUID = await cur.fetchone()
+    await _commit(conn)
+    return str(UUID[0])
 
 async def removeReview(conn:psycopg.AsyncConnection, reviewID: str):
     async with conn.cursor() as cur:
-        UUID = await getReviewUUID(conn, reviewID)
-        if UUID is not None:
-            await cur.execute("DELETE FROM review WHERE reviewid = %s", (str(UUID[0]),))
-            await conn.commit()
-            return await getReviewUUID(conn, reviewID)
-        else:
+        await cur.execute("DELETE FROM review WHERE reviewid = %s", (reviewID,))
+        if cur.rowcount == 0:
             return ReviewNotFoundError(reviewID)
+        await _commit(conn)
+        return None
 
-async def modifyReviewHidden(conn:psycopg.AsyncConnection, reviewID: str, hidden: bool):
+async def _updateReview(conn:psycopg.AsyncConnection, reviewID: str, assignments: str, params: tuple):
     async with conn.cursor() as cur:
-        UUID = await getReviewUUID(conn, reviewID)
-        if UUID is not None:
-            await cur.execute("UPDATE review SET hidden = %s WHERE reviewid = %s", (hidden, UUID))
-            await conn.commit()
-            return await getReviewUUID(conn, reviewID)
-        else:
-            raise ReviewNotFoundError(reviewID)
+        await cur.execute(f"UPDATE review SET {assignments} WHERE reviewid = %s RETURNING reviewid", (*params, reviewID))
+        UUID = await cur.fetchone()
+    if UUID is None:
+        raise ReviewNotFoundError(reviewID)
+    await _commit(conn)
+    return str(UUID[0])
+
+async def modifyReviewHidden(conn:psycopg.AsyncConnection, reviewID: str, hidden: bool):
+    return await _updateReview(conn, reviewID, "hidden = %s", (hidden,))
 
 async def modifyReviewText(conn:psycopg.AsyncConnection, reviewID: str, newReviewText: str):
-    async with conn.cursor() as cur:
-        UUID = await getReviewUUID(conn, reviewID)
-        if UUID is not None:
-            await cur.execute("UPDATE review SET review = %s WHERE reviewid = %s", (newReviewText, UUID))
-            await conn.commit()
-            await updateReviewDate(conn, reviewID)  # Update the review date after modifying the text
-            return await getReviewUUID(conn, newReviewText)
-        else:
-            raise ReviewNotFoundError(reviewID)
+    #Text and date move together in one statement
+    return await _updateReview(conn, reviewID, "review = %s, reviewDate = NOW()", (newReviewText,))
 
 async def updateReviewDate(conn:psycopg.AsyncConnection, reviewID: str):
-    async with conn.cursor() as cur:
-        UUID = await getReviewUUID(conn, reviewID)
-        if UUID is not None:
-            await cur.execute("UPDATE review SET reviewDate = NOW() WHERE reviewid = %s", (UUID,))
-            await conn.commit()
-            return await getReviewUUID(conn, reviewID)
-        else:
-            raise ReviewNotFoundError(reviewID)
+    return await _updateReview(conn, reviewID, "reviewDate = NOW()", ())
 
 async def getReviewsForAlbum(conn:psycopg.AsyncConnection, albumID: str):
     async with conn.cursor() as cur:
@@ -522,27 +999,32 @@ async def getReviewsForAlbum(conn:psycopg.AsyncConnection, albumID: str):
             JOIN users u ON r.userid = u.userid
             JOIN review_album ra ON r.reviewid = ra.reviewid
             WHERE ra.albumid = %s
-        """, (albumID,))
+        """, (albumID,), prepare=True)
         return await cur.fetchall()
 
 async def getReviewGuidelines(conn:psycopg.AsyncConnection):
+    return await referenceCache.get("parameters", "review_guidelines", lambda: _loadParameter(conn, "review_guidelines", "No guidelines set."))
+
+async def _loadParameter(conn:psycopg.AsyncConnection, key: str, default=None):
     async with conn.cursor() as cur:
-        await cur.execute("SELECT value FROM parameters WHERE key = %s", ('review_guidelines',))
+        await cur.execute("SELECT value FROM parameters WHERE key = %s", (key,))
         row = await cur.fetchone()
-        return row[0] if row else "No guidelines set."
+        return row[0] if row else default
 
 
 #################################################
 #          Review_Album Table Queries           #
 #################################################
 
+_albumReviewsQuery = """
+    SELECT reviewID
+    FROM review_album
+    WHERE albumID = %s
+"""
+
 async def getAlbumReviews(conn: psycopg.AsyncConnection, albumID: str):
     async with conn.cursor() as cur:
-        await cur.execute("""
-            SELECT reviewID
-            FROM review_album
-            WHERE albumID = %s
-        """, (albumID,))
+        await cur.execute(_albumReviewsQuery, (albumID,))
         return await cur.fetchall()
 
 async def verifyAlbumReview(conn: psycopg.AsyncConnection, albumID: str, reviewID: str):
@@ -555,34 +1037,28 @@ async def verifyAlbumReview(conn: psycopg.AsyncConnection, albumID: str, reviewI
         return await cur.fetchone() is not None
 
 async def addAlbumReview(conn: psycopg.AsyncConnection, albumID: str, reviewID: str):
-    from dbq.album import getAlbumUUID
-
-    if not await getAlbumUUID(conn, albumID):
-        raise AlbumNotFoundError(albumID)
-    if verifyAlbumReview(conn, albumID, reviewID):
-        raise ReviewAlreadyExistsError(reviewID)
-    async with conn.cursor() as cur:
-        await cur.execute("""
-            INSERT INTO review_album (albumID, reviewID)
-            VALUES (%s, %s)
-        """, (albumID, reviewID))
-        await conn.commit()
-        return await getAlbumReviews(conn, albumID)
+    #A review already on the album trips review_album_pkey -> ReviewAlreadyExistsError
+    return await _writeAndList(conn, """
+        INSERT INTO review_album (albumID, reviewID)
+        VALUES (%s, %s)
+    """, (albumID, reviewID), _albumReviewsQuery, (albumID,), albumID=albumID, reviewID=reviewID)
 
 async def removeAlbumReview(conn: psycopg.AsyncConnection, albumID: str, reviewID: str):
-    from dbq.album import getAlbumUUID
-
-    if not await getAlbumUUID(conn, albumID):
-        raise AlbumNotFoundError(albumID)
-    if not await verifyAlbumReview(conn, albumID, reviewID):
+    async with conn.cursor() as cur, conn.cursor() as listCur:
+        async with conn.pipeline():
+            await cur.execute("""
+                DELETE FROM review_album
+                WHERE albumID = %s AND reviewID = %s
+            """, (albumID, reviewID))
+            await listCur.execute(_albumReviewsQuery, (albumID,))
+        removed = cur.rowcount
+        reviews = await listCur.fetchall()
+    if not removed:
+        #Nothing linked, the album may be missing too, otherwise it's the review that isn't on it
+        await _raiseMissing(conn, albumID=albumID)
         raise ReviewNotFoundError(reviewID)
-    async with conn.cursor() as cur:
-        await cur.execute("""
-            DELETE FROM review_album
-            WHERE albumID = %s AND reviewID = %s
-        """, (albumID, reviewID))
-        await conn.commit()
-        return await getAlbumReviews(conn, albumID)
+    await _commit(conn)
+    return reviews
 
 
 #################################################
@@ -601,30 +1077,23 @@ async def getTrackUUID(conn:psycopg.AsyncConnection, trackName: str):
         return str(uuid[0]) if uuid else None
 
 async def addTrack(conn:psycopg.AsyncConnection, trackName: str, artistNames: list, trackDuration: str, fccClean: bool = False):
-    from dbq.artist_track import addArtistTrack
-    from dbq.artist import getArtistUUID, addArtist
-
-    async with conn.cursor() as cur:
-        for artist in artistNames:
-            artistUUID = []
-            if await getArtistUUID(conn, artist) is None:
-                uuid = await addArtist(conn, artist)
-            else:
-                uuid = await getArtistUUID(conn, artist)
-            artistUUID.append(uuid)
-        await cur.execute("INSERT INTO track (trackName, fccClean, trackDuration) VALUES (%s, %s, %s) RETURNING trackid", (trackName, fccClean, trackDuration))
-        await conn.commit()
-        trackUUID = await cur.fetchone()
-        for artist in artistUUID:
-            await addArtistTrack(conn, artist, str(trackUUID[0]))
-        return str(trackUUID[0])
+    artists = await resolveArtists(conn, artistNames)
+    trackUUID = uuid.uuid4()
+    async with conn.cursor() as cur, conn.pipeline():
+        await cur.execute("INSERT INTO track (trackID, trackName, fccClean, trackDuration) VALUES (%s, %s, %s, %s)", (trackUUID, trackName, fccClean, trackDuration))
+        await cur.execute("""
+            INSERT INTO artist_track (artistID, trackID)
+            SELECT unnest(%s::uuid[]), %s
+        """, (list(artists.values()), trackUUID))
+    await _commit(conn)
+    return str(trackUUID)
 
 async def removeTrack(conn:psycopg.AsyncConnection, trackUUID: str):
     async with conn.cursor() as cur:
         uuid = await verifyTrackUUID(conn, trackUUID)
         if uuid is not None:
             await cur.execute("DELETE FROM track WHERE trackid = %s", (str(uuid[0]),))
-            await conn.commit()
+            await _commit(conn)
             return await verifyTrackUUID(conn, trackUUID)
         else:
             return TrackNotFoundError(trackUUID)
@@ -641,7 +1110,7 @@ async def modifyTrack(conn:psycopg.AsyncConnection, trackID: str, newTrackName:
                 if trackDuration:
                     trackDuration = trackDuration[0]
             await cur.execute("UPDATE track SET trackname = %s, fccClean = %s, trackDuration = %s WHERE trackid = %s", (newTrackName, fccClean, trackDuration, trackID))
-            await conn.commit()
+            await _commit(conn)
             return await getTrackUUID(conn, newTrackName)
         else:
             raise TrackNotFoundError(trackID)
@@ -670,7 +1139,6 @@ async def verifyTrackName(conn:psycopg.AsyncConnection, trackName: str):
         return await cur.fetchone()  # Will return None if no results
 
 async def getTrackInfo(conn:psycopg.AsyncConnection, trackID: str):
-    from dbq.artist_track import getTrackArtists
     async with conn.cursor() as cur:
         await cur.execute("SELECT trackName, fccClean, trackDuration FROM track WHERE trackid = %s", (trackID,))
         track_info = await cur.fetchone()
@@ -688,16 +1156,18 @@ async def getTrackInfo(conn:psycopg.AsyncConnection, trackID: str):
 #               Genre Management                #
 #################################################
 
+#Genres live in the parameters table under the 'genre' key
 async def getAllGenres(conn:psycopg.AsyncConnection):
-    async with conn.cursor() as cur:
-        await cur.execute("SELECT FROM parameter WHERE parametername = 'genre'")
-        return await cur.fetchone()  # returns a list of genres
+    return await referenceCache.get("parameters", "genre", lambda: _loadParameter(conn, "genre"))
 
 async def updateGenre(conn:psycopg.AsyncConnection, genreName: str):
     async with conn.cursor() as cur:
-        await cur.execute("UPDATE parameter SET parametervalue = %s WHERE parametername = 'genre'", (genreName,))
-        await conn.commit()
-        return await getAllGenres(conn)
+        await cur.execute("""
+            INSERT INTO parameters (key, value) VALUES ('genre', %s)
+            ON CONFLICT (key) DO UPDATE SET value = EXCLUDED.value
+        """, (genreName,))
+        await _commit(conn)
+    return genreName
 
 
 #################################################
@@ -713,7 +1183,7 @@ async def inviteUser(conn:psycopg.AsyncConnection, email:str):
     async with conn.cursor() as cur:
         if await getUserInvite(conn,email) is False:
             await cur.execute("INSERT INTO invitedusers (email) VALUES (%s)",(email,))
-            await conn.commit()
+            await _commit(conn)
             return await getUserInvite(conn,email)
         else:
             raise UserAlreadyInvited(email)
@@ -721,7 +1191,9 @@ async def inviteUser(conn:psycopg.AsyncConnection, email:str):
 async def removeInvite(conn:psycopg.AsyncConnection, email:str):
     async with conn.cursor() as cur:
         await cur.execute("DELETE FROM invitedusers WHERE email = %s", (email,))
-        await conn.commit()
+        await _commit(conn)
+        #The NOTIFY reaches every worker, this worker stops serving the old User right away
+        referenceCache.invalidate("users")
         return await getUserInvite(conn, email)
 
 #################################################
@@ -736,14 +1208,13 @@ async def getAllUsers(conn:psycopg.AsyncConnection):
                             """)
         return await cur.fetchall()
 
-#Remove if unused
+#Used by load_user through database.run
 async def getUser(conn: psycopg.AsyncConnection, user_id: str):
     async with conn.cursor() as cur:
-        await cur.execute("SELECT userid, firstname, lastname, email, role FROM users WHERE userid = %s", (user_id,))
+        await cur.execute("SELECT userid, firstname, lastname, email, role FROM users WHERE userid = %s", (user_id,), prepare=True)
         user_data = await cur.fetchone()
-        uid = user_data[0]
         if user_data:
-            return User(str(uid), user_data[1], user_data[2], user_data[3], user_data[4])
+            return User(str(user_data[0]), user_data[1], user_data[2], user_data[3], user_data[4])
         return None
 
 async def getUserUUID(conn:psycopg.AsyncConnection, userEmail: str):
@@ -761,66 +1232,55 @@ async def addUser(conn:psycopg.AsyncConnection, firstName: str, lastName: str, e
     async with conn.cursor() as cur:
         if await getUserUUID(conn,email) is None:
             await cur.execute("INSERT INTO users (firstname, lastname, email) VALUES (%s,%s,%s)", (firstName,lastName,email,))
-            await conn.commit()
+            await _commit(conn)
             return await getUserUUID(conn,email)
         else:
             raise UserAlreadyExistsError(email)
 
 async def deleteUser(conn:psycopg.AsyncConnection, userID: str):
-    if await verifyUserUUID(conn, userID) is None:
+    async with conn.cursor() as cur:
+        await cur.execute("DELETE FROM users WHERE userid = %s", (userID,))
+        if cur.rowcount == 0:
+            raise UserNotFoundError(userID)
+        await _commit(conn)
+        referenceCache.invalidate("users", userID)
+        return None
+
+async def _getUserColumn(conn:psycopg.AsyncConnection, userID: str, column: str):
+    async with conn.cursor() as cur:
+        await cur.execute(f"SELECT {column} FROM users WHERE userid = %s", (userID,), prepare=True)
+        value = await cur.fetchone()
+    if value is None:
         raise UserNotFoundError(userID)
-    else:
-        async with conn.cursor() as cur:
-            await cur.execute("DELETE FROM users WHERE userid = %s", (userID,))
-            await conn.commit()
-            return await verifyUserUUID(conn,userID)
+    return str(value[0]) if value[0] is not None else None
+
+async def _setUserColumn(conn:psycopg.AsyncConnection, userID: str, column: str, value: str):
+    #Returns the updated column, no row back means there was no such user
+    async with conn.cursor() as cur:
+        await cur.execute(f"UPDATE users SET {column} = %s WHERE userid = %s RETURNING {column}", (value, userID))
+        updated = await cur.fetchone()
+    if updated is None:
+        raise UserNotFoundError(userID)
+    await _commit(conn)
+    referenceCache.invalidate("users", userID)
+    return str(updated[0])
 
 #TODO: Might deprecate bc of user class?
 async def getUserEmail(conn:psycopg.AsyncConnection, userID: str):
-    if await verifyUserUUID(conn, userID) is None:
-        raise UserNotFoundError(userID)
-    else:
-        async with conn.cursor() as cur:
-            await cur.execute("SELECT email FROM users WHERE userid = %s", (userID,))
-            email = await cur.fetchone()
-            return str(email[0]) if email else None
+    return await _getUserColumn(conn, userID, "email")
 
 async def getUserRole(conn:psycopg.AsyncConnection, userID: str):
-    if await verifyUserUUID(conn, userID) is None:
-        raise UserNotFoundError(userID)
-    else:
-        async with conn.cursor() as cur:
-            await cur.execute("SELECT role FROM users WHERE userid = %s", (userID,))
-            role = await cur.fetchone()
-            return str(role[0]) if role else None
+    return await _getUserColumn(conn, userID, "role")
 
 async def setUserRole(conn:psycopg.AsyncConnection, userID: str, userRole: str):
     if userRole not in ["member", "staff", "eboard"]:
         raise RoleNotFound(userRole)
-    elif await verifyUserUUID(conn, userID) is None:
-        raise UserNotFoundError(userID)
-    else:
-        async with conn.cursor() as cur:
-            await cur.execute("UPDATE users SET role = %s WHERE userID = %s", (userRole, userID))
-            await conn.commit()
-            return await getUserRole(conn,userID)
+    return await _setUserColumn(conn, userID, "role", userRole)
 
 async def modifyEmail(conn:psycopg.AsyncConnection, userID: str, newEmail: str):
-    if await verifyUserUUID(conn, userID) is None:
-        raise UserNotFoundError(userID)
-    else:
-        async with conn.cursor() as cur:
-            await cur.execute("UPDATE users SET email = %s WHERE userid = %s", (newEmail, userID))
-            await conn.commit()
-            return await verifyUserUUID(conn,userID) #TODO: return something useful if needed
+    return await _setUserColumn(conn, userID, "email", newEmail)
 
 async def modifyFirstName(conn:psycopg.AsyncConnection, userID: str, newName: str):
-    if await verifyUserUUID(conn, userID) is None:
-        raise UserNotFoundError(userID)
-    else:
-        async with conn.cursor() as cur:
-            await cur.execute("UPDATE users SET firstname = %s WHERE userid = %s", (newName, userID))
-            await conn.commit()
-            return await verifyUserUUID(conn,userID) #TODO: return something useful if needed
+    return await _setUserColumn(conn, userID, "firstname", newName)
 
 
@@ -1,15 +1,23 @@
-import os, base64, requests
+import os, base64, logging, requests
 from dotenv import load_dotenv
 import discogs_client
 from library_manager.classes import AlbumEntry
+from library_manager.discogs_cache import DiscogsCache, CachingFetcher, ttl_for
+from library_manager.discogs_limiter import RateLimiter, RateLimitedFetcher
 
 load_dotenv()
+log = logging.getLogger(__name__)
 DISCOGS_KEY = os.getenv("DISCOGS_TOKEN")
 DISCOGS_SECRET = os.getenv("DISCOGS_SECRET")
 HEADERS = {'user-agent': 'WITR-LibraryManager/0.0.1', "Authorization": f"Discogs key={DISCOGS_KEY}, secret={DISCOGS_SECRET}"}
 RATELIMIT = 30
 
 d = discogs_client.Client('WITR-LibraryManager/0.0.1',user_token=DISCOGS_KEY)
+#Every API call and image download goes through the on-disk cache first
+#API calls that miss the cache then queue on the limiter shared by all workers
+cache = DiscogsCache()
+limiter = RateLimiter(RATELIMIT)
+d._fetcher = CachingFetcher(RateLimitedFetcher(d._fetcher, limiter), cache)
 
 def search_by_id(release_id: str):
     #This function searches for a release by its ID and returns an AlbumEntry object
@@ -52,11 +60,16 @@ def results_parsed(results, upc = None):
 
 def image_url_to_base64(image_url):
     try:
-        response = requests.get(image_url, headers=HEADERS)
-        response.raise_for_status()
-        image_bytes = response.content
+        cached = cache.get(f"GET {image_url}")
+        if cached is not None:
+            image_bytes = cached[0]
+        else:
+            response = requests.get(image_url, headers=HEADERS)
+            response.raise_for_status()
+            image_bytes = response.content
+            cache.set(f"GET {image_url}", image_bytes, response.status_code, ttl_for(image_url))
         encoded_string = base64.b64encode(image_bytes).decode('utf-8')
         return encoded_string
     except Exception as e:
-        print(f"Error downloading or encoding image: {e}")
+        log.warning("Error downloading or encoding image %s: %s", image_url, e)
         return None
\ No newline at end of file
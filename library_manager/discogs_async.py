@@ -0,0 +1,142 @@
+import asyncio, base64, json, os, time
+import httpx
+from dotenv import load_dotenv
+from library_manager import discogs, metrics
+from library_manager.classes import AlbumEntry
+from library_manager.discogs_cache import ttl_for
+
+### Async twin of discogs.py for the web routes
+### Everything here runs on the background loop (see background.py) so the pooled HTTP
+### connections outlive the request, routes call it with background.wait(...)
+### Responses share the on-disk cache and the cross-worker rate limiter with the sync client
+
+load_dotenv()
+API_URL = "https://api.discogs.com"
+#Seconds for a single HTTP call (connect, read, write and pool wait each)
+DISCOGS_TIMEOUT = float(os.getenv("DISCOGS_TIMEOUT", 10))
+#Seconds for a whole lookup, including time spent queued on the rate limiter
+DISCOGS_LOOKUP_TIMEOUT = float(os.getenv("DISCOGS_LOOKUP_TIMEOUT", 30))
+DISCOGS_MAX_CONNECTIONS = int(os.getenv("DISCOGS_MAX_CONNECTIONS", 10))
+
+_client = None
+_pid = None
+
+
+def _http():
+    #One pooled client per process, made on first use so it belongs to the background loop
+    global _client, _pid
+    if _client is None or _pid != os.getpid():
+        _client = httpx.AsyncClient(
+            headers={"User-Agent": "WITR-LibraryManager/0.0.1"},
+            timeout=DISCOGS_TIMEOUT,
+            limits=httpx.Limits(max_connections=DISCOGS_MAX_CONNECTIONS, max_keepalive_connections=DISCOGS_MAX_CONNECTIONS),
+            follow_redirects=True,
+        )
+        _pid = os.getpid()
+    return _client
+
+
+async def _get(url: str, params: dict = None, api: bool = True):
+    #Returns the response body, or None for a 404
+    #The token only goes in a header so cache keys match the sync client's
+    #The cache and the limiter are SQLite files, every call into them goes through a worker thread
+    #so a locked file or a large cover write never holds up the pool and listener on this loop
+    key = f"GET {httpx.URL(url, params=params)}"
+    cached = await asyncio.to_thread(discogs.cache.get, key)
+    if cached is not None:
+        return cached[0]
+    headers = {"Authorization": f"Discogs token={discogs.DISCOGS_KEY}"} if api else None
+    while True:
+        if api:
+            await discogs.limiter.acquire_async()
+        start = time.perf_counter()
+        try:
+            response = await _http().get(url, params=params, headers=headers)
+        finally:
+            metrics.record_discogs(time.perf_counter() - start)
+        if not api:
+            break
+        await asyncio.to_thread(discogs.limiter.update_from_headers, response.headers.get("X-Discogs-Ratelimit"), response.headers.get("X-Discogs-Ratelimit-Remaining"))
+        if response.status_code != 429:
+            break
+        await asyncio.to_thread(discogs.limiter.drain)
+    if response.status_code == 404:
+        return None
+    response.raise_for_status()
+    await asyncio.to_thread(discogs.cache.set, key, response.content, response.status_code, ttl_for(url))
+    return response.content
+
+
+async def _get_json(path: str, **params):
+    body = await _get(API_URL + path, params or None)
+    return json.loads(body) if body is not None else None
+
+
+async def _get_image(image_url: str):
+    #Base64 like discogs.image_url_to_base64, a failed cover download never fails the lookup
+    if not image_url:
+        return None
+    try:
+        image_bytes = await _get(image_url, api=False)
+    except httpx.HTTPError:
+        return None
+    return base64.b64encode(image_bytes).decode('utf-8') if image_bytes else None
+
+
+async def search_upc(upc: str):
+    return await asyncio.wait_for(_search_upc(upc), DISCOGS_LOOKUP_TIMEOUT)
+
+
+async def _search_upc(upc: str):
+    #Same path as discogs.search_upc: first barcode hit -> its master -> the master's main release
+    #The master already lists the cover, so the release and its image are fetched side by side
+    search = await _get_json("/database/search", barcode=upc)
+    hits = search.get("results", []) if search else []
+    if not hits:
+        return None
+    hit = hits[0]
+    release_id = hit["id"]
+    cover = hit.get("cover_image")
+    if hit.get("master_id"):
+        master = await _get_json(f"/masters/{hit['master_id']}")
+        if master:
+            release_id = master.get("main_release", release_id)
+            if master.get("images"):
+                cover = master["images"][0]["uri"]
+    release, image = await asyncio.gather(_get_json(f"/releases/{release_id}"), _get_image(cover))
+    if release is None:
+        return None
+    return results_parsed(release, image, upc)
+
+
+async def search_by_id(release_id: str):
+    return await asyncio.wait_for(_search_by_id(release_id), DISCOGS_LOOKUP_TIMEOUT)
+
+
+async def _search_by_id(release_id: str):
+    if release_id.startswith("[r"):
+        release_id = release_id[2:-1]
+    release = await _get_json(f"/releases/{release_id}")
+    if release is None:
+        return None
+    image = await _get_image(release["images"][0]["uri"]) if release.get("images") else None
+    return results_parsed(release, image)
+
+
+def results_parsed(release: dict, image: str, upc: str = None):
+    #Mirrors discogs.results_parsed, working from the raw release JSON instead of client objects
+    parsedart = [artist["name"] for artist in release.get("artists", [])]
+    parsedtrack = []
+    for track in release.get("tracklist", []):
+        credit = parsedart + [artist["name"] for artist in track.get("extraartists", [])]
+        parsedtrack += [[track.get("title"), credit, track.get("duration")]]
+    parseformat = [mformat["name"] for mformat in release.get("formats", [])]
+
+    if upc:
+        barcode = upc
+    else:
+        barcodes = [i["value"] for i in release.get("identifiers", []) if i.get("type") == "Barcode"]
+        barcode = barcodes[0] if barcodes else None
+
+    genres = release.get("genres") or [None]
+    return AlbumEntry(barcode, release.get("title"), parsedart, genres[0], None, release.get("year"), parseformat, image, parsedtrack)
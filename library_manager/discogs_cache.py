@@ -0,0 +1,114 @@
+import os, sqlite3, threading, time
+from dotenv import load_dotenv
+
+load_dotenv()
+#One SQLite file shared by every worker on the box
+CACHE_PATH = os.getenv("DISCOGS_CACHE_PATH", "discogs_cache.sqlite3")
+#Least recently used entries are evicted past this size
+CACHE_MAX_BYTES = int(os.getenv("DISCOGS_CACHE_MAX_MB", 256)) * 1024 * 1024
+#Search results change as people add releases, release/master data and images almost never do
+SEARCH_TTL = int(os.getenv("DISCOGS_CACHE_SEARCH_TTL", 60 * 60 * 24))
+RELEASE_TTL = int(os.getenv("DISCOGS_CACHE_RELEASE_TTL", 60 * 60 * 24 * 30))
+IMAGE_TTL = int(os.getenv("DISCOGS_CACHE_IMAGE_TTL", 60 * 60 * 24 * 90))
+
+
+def ttl_for(url: str):
+    if "/database/search" in url:
+        return SEARCH_TTL
+    if "api.discogs.com" in url:
+        return RELEASE_TTL
+    return IMAGE_TTL
+
+
+class DiscogsCache():
+    #On-disk cache of Discogs responses keyed by method and URL, the user token is never part of the URL
+    def __init__(self, path: str = CACHE_PATH, max_bytes: int = CACHE_MAX_BYTES):
+        self.path = path
+        self.max_bytes = max_bytes
+        #Counters are per process
+        self.stats = {"hits": 0, "misses": 0, "evictions": 0}
+        self._lock = threading.Lock()
+        with self._connect() as db:
+            db.execute("""
+                CREATE TABLE IF NOT EXISTS responses (
+                    key TEXT PRIMARY KEY,
+                    status INTEGER NOT NULL,
+                    body BLOB NOT NULL,
+                    size INTEGER NOT NULL,
+                    expires REAL NOT NULL,
+                    accessed REAL NOT NULL
+                )
+            """)
+            db.execute("CREATE INDEX IF NOT EXISTS responses_accessed ON responses (accessed)")
+
+    def _connect(self):
+        #Short lived connections keep this safe across threads and forked workers
+        db = sqlite3.connect(self.path, timeout=10, isolation_level=None)
+        db.execute("PRAGMA journal_mode=WAL")
+        db.execute("PRAGMA synchronous=NORMAL")
+        return db
+
+    def get(self, key: str):
+        #Returns (body, status) or None on a miss or an expired entry
+        now = time.time()
+        db = self._connect()
+        try:
+            row = db.execute("SELECT body, status FROM responses WHERE key = ? AND expires > ?", (key, now)).fetchone()
+            if row is not None:
+                db.execute("UPDATE responses SET accessed = ? WHERE key = ?", (now, key))
+        finally:
+            db.close()
+        with self._lock:
+            self.stats["hits" if row is not None else "misses"] += 1
+        return (bytes(row[0]), row[1]) if row is not None else None
+
+    def set(self, key: str, body: bytes, status: int = 200, ttl: int = RELEASE_TTL):
+        now = time.time()
+        db = self._connect()
+        try:
+            db.execute("INSERT OR REPLACE INTO responses (key, status, body, size, expires, accessed) VALUES (?, ?, ?, ?, ?, ?)",
+                       (key, status, body, len(body), now + ttl, now))
+            self._evict(db, now)
+        finally:
+            db.close()
+
+    def _evict(self, db, now: float):
+        expired = db.execute("DELETE FROM responses WHERE expires <= ?", (now,)).rowcount
+        #Keep the most recently used entries whose sizes add up to max_bytes, drop the rest
+        evicted = db.execute("""
+            DELETE FROM responses WHERE key IN (
+                SELECT key FROM (
+                    SELECT key, sum(size) OVER (ORDER BY accessed DESC, key) AS running
+                    FROM responses
+                ) WHERE running > ?
+            )
+        """, (self.max_bytes,)).rowcount
+        with self._lock:
+            self.stats["evictions"] += expired + evicted
+
+    def hit_ratio(self):
+        lookups = self.stats["hits"] + self.stats["misses"]
+        return self.stats["hits"] / lookups if lookups else 0.0
+
+
+class CachingFetcher():
+    #Wraps the discogs_client fetcher the same way its LoggingDelegator does, caching successful GETs
+    def __init__(self, fetcher, cache: DiscogsCache):
+        self.fetcher = fetcher
+        self.cache = cache
+
+    def __getattr__(self, name):
+        #rate_limit_remaining and friends still come from the real fetcher
+        return getattr(self.fetcher, name)
+
+    def fetch(self, client, method, url, data=None, headers=None, json=True):
+        if method != "GET":
+            return self.fetcher.fetch(client, method, url, data, headers, json)
+        key = f"GET {url}"
+        cached = self.cache.get(key)
+        if cached is not None:
+            return cached
+        content, status_code = self.fetcher.fetch(client, method, url, data, headers, json)
+        if status_code == 200:
+            self.cache.set(key, content, status_code, ttl_for(url))
+        return content, status_code
@@ -0,0 +1,164 @@
+import asyncio, os, sqlite3, threading, time
+from dotenv import load_dotenv
+from library_manager.exceptions import DiscogsRateLimitError
+
+load_dotenv()
+#Lives next to the response cache, every worker and CLI process on the box shares the one bucket
+LIMITER_PATH = os.getenv("DISCOGS_LIMITER_PATH", "discogs_limiter.sqlite3")
+#Requests allowed to go out back to back before the per-minute rate kicks in
+LIMITER_BURST = float(os.getenv("DISCOGS_LIMITER_BURST", 5))
+#Longest a caller queues for a slot before giving up with DiscogsRateLimitError
+LIMITER_MAX_WAIT = float(os.getenv("DISCOGS_LIMITER_MAX_WAIT", 20))
+
+
+class RateLimiter():
+    #Token bucket stored in SQLite, BEGIN IMMEDIATE makes each refill-and-take atomic across processes
+    def __init__(self, per_minute: int, path: str = LIMITER_PATH, burst: float = LIMITER_BURST, max_wait: float = LIMITER_MAX_WAIT):
+        self.path = path
+        self.max_wait = max_wait
+        #Wait counters are per process, queue depth is global
+        self.stats = {"acquired": 0, "rejected": 0, "waited": 0, "wait_seconds": 0.0, "max_wait_seconds": 0.0}
+        self._lock = threading.Lock()
+        db = self._connect()
+        try:
+            db.execute("""
+                CREATE TABLE IF NOT EXISTS bucket (
+                    id INTEGER PRIMARY KEY CHECK (id = 1),
+                    tokens REAL NOT NULL,
+                    capacity REAL NOT NULL,
+                    rate REAL NOT NULL,
+                    updated REAL NOT NULL,
+                    waiting INTEGER NOT NULL DEFAULT 0
+                )
+            """)
+            db.execute("INSERT OR IGNORE INTO bucket (id, tokens, capacity, rate, updated) VALUES (1, ?, ?, ?, ?)",
+                       (burst, burst, per_minute / 60, time.time()))
+        finally:
+            db.close()
+
+    def _connect(self):
+        db = sqlite3.connect(self.path, timeout=10, isolation_level=None)
+        db.execute("PRAGMA journal_mode=WAL")
+        return db
+
+    def _transaction(self, fn):
+        db = self._connect()
+        try:
+            db.execute("BEGIN IMMEDIATE")
+            try:
+                result = fn(db, time.time())
+                db.execute("COMMIT")
+                return result
+            except Exception:
+                db.execute("ROLLBACK")
+                raise
+        finally:
+            db.close()
+
+    def reserve(self):
+        #Takes a token if one is free and returns 0, otherwise returns the seconds until the next one
+        def take(db, now):
+            tokens, capacity, rate, updated = db.execute("SELECT tokens, capacity, rate, updated FROM bucket WHERE id = 1").fetchone()
+            tokens = min(capacity, tokens + (now - updated) * rate)
+            wait = 0.0
+            if tokens >= 1:
+                tokens -= 1
+            else:
+                wait = (1 - tokens) / rate
+            db.execute("UPDATE bucket SET tokens = ?, updated = ? WHERE id = 1", (tokens, now))
+            return wait
+        return self._transaction(take)
+
+    def _waiting(self, delta: int):
+        self._transaction(lambda db, now: db.execute("UPDATE bucket SET waiting = max(0, waiting + ?) WHERE id = 1", (delta,)))
+
+    def acquire(self):
+        #Blocks until a slot is free, raising DiscogsRateLimitError if that would take longer than max_wait
+        start = time.monotonic()
+        wait = self.reserve()
+        if wait:
+            self._waiting(1)
+            try:
+                while wait:
+                    if time.monotonic() - start + wait > self.max_wait:
+                        self._record(None)
+                        raise DiscogsRateLimitError(self.max_wait)
+                    time.sleep(wait)
+                    wait = self.reserve()
+            finally:
+                self._waiting(-1)
+            self._record(time.monotonic() - start)
+        else:
+            self._record(0.0)
+
+    async def acquire_async(self):
+        #Same as acquire but queues with asyncio.sleep so the event loop keeps serving other lookups
+        #The SQLite work runs in a worker thread, a busy bucket file must never stall the loop
+        start = time.monotonic()
+        wait = await asyncio.to_thread(self.reserve)
+        if wait:
+            await asyncio.to_thread(self._waiting, 1)
+            try:
+                while wait:
+                    if time.monotonic() - start + wait > self.max_wait:
+                        self._record(None)
+                        raise DiscogsRateLimitError(self.max_wait)
+                    await asyncio.sleep(wait)
+                    wait = await asyncio.to_thread(self.reserve)
+            finally:
+                await asyncio.to_thread(self._waiting, -1)
+            self._record(time.monotonic() - start)
+        else:
+            self._record(0.0)
+
+    def _record(self, waited):
+        with self._lock:
+            if waited is None:
+                self.stats["rejected"] += 1
+                return
+            self.stats["acquired"] += 1
+            if waited:
+                self.stats["waited"] += 1
+                self.stats["wait_seconds"] += waited
+                self.stats["max_wait_seconds"] = max(self.stats["max_wait_seconds"], waited)
+
+    def update_from_headers(self, limit, remaining):
+        #Discogs reports its own view of the window in X-Discogs-Ratelimit(-Remaining), trust it over ours
+        def adapt(db, now):
+            if limit:
+                db.execute("UPDATE bucket SET rate = ? WHERE id = 1", (float(limit) / 60,))
+            if remaining is not None:
+                db.execute("UPDATE bucket SET tokens = min(tokens, ?) WHERE id = 1", (float(remaining),))
+        self._transaction(adapt)
+
+    def drain(self):
+        #After a 429 nobody goes until the bucket refills
+        self._transaction(lambda db, now: db.execute("UPDATE bucket SET tokens = 0, updated = ? WHERE id = 1", (now,)))
+
+    def queue_depth(self):
+        db = self._connect()
+        try:
+            return db.execute("SELECT waiting FROM bucket WHERE id = 1").fetchone()[0]
+        finally:
+            db.close()
+
+
+class RateLimitedFetcher():
+    #Sits between the response cache and the real fetcher so cache hits never use up a slot
+    def __init__(self, fetcher, limiter: RateLimiter):
+        self.fetcher = fetcher
+        self.limiter = limiter
+        #Queueing is our job now, the client's own backoff would retry a 429 up to 100 times
+        self.fetcher.backoff_enabled = False
+
+    def __getattr__(self, name):
+        return getattr(self.fetcher, name)
+
+    def fetch(self, client, method, url, data=None, headers=None, json=True):
+        while True:
+            self.limiter.acquire()
+            content, status_code = self.fetcher.fetch(client, method, url, data, headers, json)
+            self.limiter.update_from_headers(getattr(self.fetcher, "rate_limit", None), getattr(self.fetcher, "rate_limit_remaining", None))
+            if status_code != 429:
+                return content, status_code
+            self.limiter.drain()
@@ -65,3 +65,9 @@ class RoleNotFound(Exception):
         self.userRole = userRole
         super().__init__(f"Role '{userRole}' not found.")
 
+
+class DiscogsRateLimitError(Exception):
+    """Raised when no Discogs request slot frees up within the allowed wait"""
+    def __init__(self, maxWait: float):
+        self.maxWait = maxWait
+        super().__init__(f"No Discogs request slot available within {maxWait} seconds.")
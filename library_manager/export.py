@@ -0,0 +1,72 @@
+import csv, io, json, os
+from contextlib import aclosing
+from dotenv import load_dotenv
+from library_manager import dbq
+
+### Full catalog dumps for the automation system and audits, as CSV or JSONL
+### Albums come off a server-side cursor one batch at a time and each batch is written out before the
+### next is fetched, so memory stays flat however big the library is. Run it through database.stream(...)
+### from sync code (the streamed /export route, the export-catalog command).
+
+load_dotenv()
+#Albums fetched and written per chunk
+EXPORT_BATCH = int(os.getenv("EXPORT_BATCH", 500))
+
+FORMATS = {"csv": "text/csv", "jsonl": "application/x-ndjson"}
+#CSV is flat, one line per track with the album columns repeated, an album without tracks gets one line
+CSV_COLUMNS = ["album_id", "album_name", "album_short", "genre", "release_date", "artists", "mediums", "upcs",
+               "track_name", "track_artists", "track_duration", "fcc_clean"]
+#Joins the list columns in a CSV cell
+CSV_SEPARATOR = "; "
+
+
+def _album(row):
+    albumID, albumName, albumShort, genre, releaseDate, artists, mediums, tracks = row
+    return {
+        "album_id": str(albumID),
+        "album_name": albumName,
+        "album_short": albumShort,
+        "genre": genre,
+        "release_date": releaseDate,
+        "artists": artists,
+        "mediums": [{"medium": mediumName, "upc": upc} for mediumName, upc in mediums],
+        "tracks": [{"name": name, "artists": credits, "duration": duration, "fcc_clean": fccClean}
+                   for name, credits, duration, fccClean in tracks],
+    }
+
+
+def _csv_rows(album: dict):
+    head = [album["album_id"], album["album_name"], album["album_short"], album["genre"], album["release_date"],
+            CSV_SEPARATOR.join(album["artists"]),
+            CSV_SEPARATOR.join(medium["medium"] for medium in album["mediums"]),
+            CSV_SEPARATOR.join(medium["upc"] or "" for medium in album["mediums"])]
+    if not album["tracks"]:
+        return [head + ["", "", "", ""]]
+    return [head + [track["name"], CSV_SEPARATOR.join(track["artists"]), track["duration"], track["fcc_clean"]]
+            for track in album["tracks"]]
+
+
+async def chunks(conn, fmt: str, batch: int = EXPORT_BATCH):
+    #Yields the export as text, one chunk per batch of albums, the CSV header goes out with the first
+    if fmt not in FORMATS:
+        raise ValueError(f"Unknown export format {fmt}")
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    if fmt == "csv":
+        writer.writerow(CSV_COLUMNS)
+    #Closed with this generator, so an export stopped part way ends the cursor's transaction straight away
+    async with aclosing(dbq.exportAlbums(conn, batch)) as batches:
+        async for rows in batches:
+            for row in rows:
+                album = _album(row)
+                if fmt == "csv":
+                    writer.writerows(_csv_rows(album))
+                else:
+                    buffer.write(json.dumps(album, ensure_ascii=False))
+                    buffer.write("\n")
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    #An empty library still gets its CSV header
+    if buffer.tell():
+        yield buffer.getvalue()
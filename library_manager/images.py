@@ -0,0 +1,68 @@
+import base64, binascii, io
+from PIL import Image, UnidentifiedImageError, features
+
+#Magic numbers for the image formats we expect from Discogs and browser uploads
+SIGNATURES = [
+    (b"\xff\xd8\xff", "image/jpeg"),
+    (b"\x89PNG\r\n\x1a\n", "image/png"),
+    (b"GIF87a", "image/gif"),
+    (b"GIF89a", "image/gif"),
+]
+
+#Widths (in px) the templates display album art at, home.html uses 100 and album_detail.html 300
+THUMBNAIL_SIZES = (100, 300)
+#WebP is a lot smaller, JPEG is only used if this Pillow build can't write WebP
+THUMBNAIL_FORMAT = ("WEBP", "image/webp") if features.check("webp") else ("JPEG", "image/jpeg")
+THUMBNAIL_QUALITY = 80
+
+def sniff_type(image: bytes):
+    for signature, mimetype in SIGNATURES:
+        if image.startswith(signature):
+            return mimetype
+    if image[:4] == b"RIFF" and image[8:12] == b"WEBP":
+        return "image/webp"
+    return "application/octet-stream"
+
+def decode_picture(picture):
+    #album.picture holds the data URL the manage_library form posts, or bare base64 from Discogs
+    #Returns (raw image bytes, mimetype), or (None, None) if there's nothing usable
+    if not picture:
+        return None, None
+    if isinstance(picture, memoryview):
+        picture = bytes(picture)
+    if isinstance(picture, str):
+        picture = picture.encode("utf-8")
+    mimetype = None
+    if picture.startswith(b"data:"):
+        header, _, picture = picture.partition(b",")
+        mimetype = header[5:].split(b";")[0].decode("ascii") or None
+    try:
+        image = base64.b64decode(picture, validate=False)
+    except (binascii.Error, ValueError):
+        return None, None
+    if not image:
+        return None, None
+    return image, mimetype or sniff_type(image)
+
+def make_thumbnails(picture):
+    #Returns [(size, mimetype, image bytes)] for every THUMBNAIL_SIZES entry, empty if picture isn't an image
+    #Kept at module level (and free of db access) so the backfill can run it in a process pool
+    image, _ = decode_picture(picture)
+    if image is None:
+        return []
+    try:
+        original = Image.open(io.BytesIO(image))
+        original.load()
+    except (UnidentifiedImageError, OSError):
+        return []
+    original = original.convert("RGB")
+    image_format, mimetype = THUMBNAIL_FORMAT
+    thumbnails = []
+    for size in THUMBNAIL_SIZES:
+        thumbnail = original.copy()
+        #thumbnail() only ever shrinks, small covers keep their own size
+        thumbnail.thumbnail((size, size), Image.LANCZOS)
+        out = io.BytesIO()
+        thumbnail.save(out, image_format, quality=THUMBNAIL_QUALITY)
+        thumbnails.append((size, mimetype, out.getvalue()))
+    return thumbnails
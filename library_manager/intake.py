@@ -0,0 +1,79 @@
+import asyncio, csv, io
+import httpx, psycopg
+from library_manager import dbq, discogs_async, images
+from library_manager.exceptions import DiscogsRateLimitError
+
+### Bulk barcode intake for boxes of donations
+### Lookups run on the background loop like the web routes (see discogs_async.py),
+### so call intake() through database.run(...) or background.wait(...)
+
+#Lookups in flight at once, the shared rate limiter still decides how fast they actually go
+INTAKE_CONCURRENCY = 4
+
+
+def read_upcs(text: str):
+    #Accepts a newline list or a CSV whose first column is the barcode, header rows are skipped
+    upcs = []
+    for row in csv.reader(io.StringIO(text)):
+        if not row:
+            continue
+        upc = row[0].strip().replace(" ", "").replace("-", "")
+        if upc.isdigit():
+            upcs.append(upc)
+    return upcs
+
+
+async def intake(conn, upcs: list, concurrency: int = INTAKE_CONCURRENCY):
+    #Returns one report row per input barcode, in input order and repeats included: (upc, status, detail)
+    #status is added, duplicate, not_found or error, detail is the new album id or what went wrong
+    report = [None] * len(upcs)
+    todo = {}
+    existing = await dbq.getExistingUPCs(conn, upcs)
+    for position, upc in enumerate(upcs):
+        if upc in existing:
+            report[position] = (upc, "duplicate", "already in the library")
+        elif upc in todo:
+            report[position] = (upc, "duplicate", "repeated in this batch")
+        else:
+            todo[upc] = position
+
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def resolve(upc):
+        async with semaphore:
+            try:
+                album_entry = await discogs_async.search_upc(upc)
+                # Resized off the event loop, like the thumbnails of an album added from the web form
+                image = album_entry.get_image() if album_entry is not None else None
+                thumbnails = await asyncio.to_thread(images.make_thumbnails, image) if image else None
+                return upc, album_entry, thumbnails, None
+            except DiscogsRateLimitError:
+                return upc, None, None, "Discogs rate limit"
+            except (asyncio.TimeoutError, httpx.HTTPError) as e:
+                return upc, None, None, f"Discogs lookup failed: {e!r}"
+            except Exception as e:
+                # A release whose JSON isn't shaped the way results_parsed expects only fails its own row
+                return upc, None, None, f"unexpected Discogs response: {e!r}"
+
+    # Inserts run as lookups finish, the connection only ever does one thing at a time
+    for finished in asyncio.as_completed([resolve(upc) for upc in todo]):
+        upc, album_entry, thumbnails, error = await finished
+        position = todo[upc]
+        if error:
+            report[position] = (upc, "error", error)
+            continue
+        if album_entry is None:
+            report[position] = (upc, "not_found", "no Discogs release with this barcode")
+            continue
+        # Each album and its thumbnails are their own unit of work so one bad release doesn't undo the rest of the box
+        try:
+            async with dbq.unitOfWork(conn):
+                album_id = await dbq.addAlbum(conn, album_entry.get_album_name(), album_entry.get_shortcode(), upc,
+                                              album_entry.get_genre(), album_entry.get_release_date(), album_entry.get_artist_name(),
+                                              album_entry.get_mediums(), album_entry.get_image(), album_entry.get_tracks())
+                if thumbnails is not None:
+                    await dbq.setAlbumThumbnails(conn, album_id, thumbnails)
+            report[position] = (upc, "added", album_id)
+        except psycopg.Error as e:
+            report[position] = (upc, "error", f"insert failed: {e}")
+    return report
@@ -0,0 +1,142 @@
+import contextvars, os, time
+import psycopg
+from dotenv import load_dotenv
+from flask import g, request, template_rendered, before_render_template
+#prometheus_client picks single or multiprocess storage when it is imported, so .env has to be loaded first
+load_dotenv()
+from prometheus_client import CollectorRegistry, Counter, Histogram, generate_latest, CONTENT_TYPE_LATEST, REGISTRY
+from prometheus_client import multiprocess
+
+### Per-request timings for every route: database, Discogs, template rendering and the whole request
+### Each response carries them in a Server-Timing header, and they feed per-endpoint Prometheus histograms
+### With several workers set PROMETHEUS_MULTIPROC_DIR to an empty directory shared by all of them,
+### each worker then writes its samples there and /metrics adds them up. gunicorn.conf.py in the repository
+### root marks exited workers dead, other servers need the same multiprocess.mark_process_dead(pid) on worker exit
+
+#Buckets in seconds, from a cache hit to a slow Discogs lookup
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+QUERY_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100)
+
+REQUEST_SECONDS = Histogram("library_request_seconds", "Total time spent handling a request", ["endpoint"], buckets=LATENCY_BUCKETS)
+DB_SECONDS = Histogram("library_request_db_seconds", "Time a request spent waiting on Postgres", ["endpoint"], buckets=LATENCY_BUCKETS)
+DB_QUERIES = Histogram("library_request_db_queries", "Statements a request sent to Postgres", ["endpoint"], buckets=QUERY_BUCKETS)
+DISCOGS_SECONDS = Histogram("library_request_discogs_seconds", "Time a request spent on Discogs HTTP calls", ["endpoint"], buckets=LATENCY_BUCKETS)
+DISCOGS_CALLS = Histogram("library_request_discogs_calls", "Discogs HTTP calls made by a request", ["endpoint"], buckets=QUERY_BUCKETS)
+RENDER_SECONDS = Histogram("library_request_render_seconds", "Time a request spent rendering templates", ["endpoint"], buckets=LATENCY_BUCKETS)
+RESPONSES = Counter("library_responses_total", "Responses sent", ["endpoint", "method", "status"])
+
+#The timings of the request being handled, async views and the background loop see it through the copied context
+_current = contextvars.ContextVar("requestTimings", default=None)
+
+
+class RequestTimings():
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.db_queries = 0
+        self.db_seconds = 0.0
+        self.discogs_calls = 0
+        self.discogs_seconds = 0.0
+        self.render_seconds = 0.0
+        self.render_start = None
+
+    def server_timing(self, total: float):
+        #Server-Timing durations are in milliseconds
+        return ", ".join([
+            f'db;dur={self.db_seconds * 1000:.1f};desc="{self.db_queries} queries"',
+            f'discogs;dur={self.discogs_seconds * 1000:.1f};desc="{self.discogs_calls} calls"',
+            f'render;dur={self.render_seconds * 1000:.1f}',
+            f'total;dur={total * 1000:.1f}',
+        ])
+
+
+def record_db(seconds: float):
+    timings = _current.get()
+    if timings is not None:
+        timings.db_queries += 1
+        timings.db_seconds += seconds
+
+
+def record_discogs(seconds: float):
+    timings = _current.get()
+    if timings is not None:
+        timings.discogs_calls += 1
+        timings.discogs_seconds += seconds
+
+
+class TimedCursor(psycopg.AsyncCursor):
+    #Cursor factory for the pool, every statement counts towards the current request
+    #Pipelined statements are counted too, their wait shows up in whichever call syncs the pipeline
+    async def execute(self, query, params=None, **kwargs):
+        start = time.perf_counter()
+        try:
+            return await super().execute(query, params, **kwargs)
+        finally:
+            record_db(time.perf_counter() - start)
+
+    async def executemany(self, query, params_seq, **kwargs):
+        start = time.perf_counter()
+        try:
+            return await super().executemany(query, params_seq, **kwargs)
+        finally:
+            record_db(time.perf_counter() - start)
+
+
+def _render_started(sender, template, context, **extra):
+    timings = _current.get()
+    if timings is not None:
+        timings.render_start = time.perf_counter()
+
+
+def _render_finished(sender, template, context, **extra):
+    timings = _current.get()
+    if timings is not None and timings.render_start is not None:
+        timings.render_seconds += time.perf_counter() - timings.render_start
+        timings.render_start = None
+
+
+def _start_request():
+    #Sync on purpose, so the context var is set in the request's own context before any async hook copies it
+    g.timings = RequestTimings()
+    g.timings_token = _current.set(g.timings)
+
+
+def _finish_request(response):
+    timings = g.get("timings")
+    if timings is None:
+        return response
+    total = time.perf_counter() - timings.start
+    response.headers["Server-Timing"] = timings.server_timing(total)
+    endpoint = request.endpoint or "unmatched"
+    REQUEST_SECONDS.labels(endpoint).observe(total)
+    DB_SECONDS.labels(endpoint).observe(timings.db_seconds)
+    DB_QUERIES.labels(endpoint).observe(timings.db_queries)
+    DISCOGS_SECONDS.labels(endpoint).observe(timings.discogs_seconds)
+    DISCOGS_CALLS.labels(endpoint).observe(timings.discogs_calls)
+    RENDER_SECONDS.labels(endpoint).observe(timings.render_seconds)
+    RESPONSES.labels(endpoint, request.method, str(response.status_code)).inc()
+    return response
+
+
+def _end_request(exception):
+    token = g.pop("timings_token", None)
+    if token is not None:
+        _current.reset(token)
+
+
+def exposition():
+    #Text for /metrics, summed over every worker when running in multiprocess mode
+    if os.getenv("PROMETHEUS_MULTIPROC_DIR"):
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+    return generate_latest(registry), CONTENT_TYPE_LATEST
+
+
+def init_app(app):
+    #Registered before the other hooks so the total includes waiting for a pooled connection
+    app.before_request(_start_request)
+    app.after_request(_finish_request)
+    app.teardown_request(_end_request)
+    before_render_template.connect(_render_started, app)
+    template_rendered.connect(_render_finished, app)
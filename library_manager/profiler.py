@@ -0,0 +1,208 @@
+import functools, os, random, re, sys, threading, time
+from collections import deque
+import psycopg
+from psycopg import pq, sql
+from dotenv import load_dotenv
+from library_manager import metrics
+
+### Statement profiler for the data access layer, installed as the pool's cursor factory
+### Every statement is tagged with the dbq function that sent it and added to per (function, SQL shape)
+### totals. Statements slower than SLOW_QUERY_MS are kept in a short log, a sample of the read-only ones
+### with the plan from EXPLAIN (ANALYZE, BUFFERS). Numbers are per worker, read them from /sql_profile.
+
+load_dotenv()
+#0 turns the profiler off, the pool then uses the plain timing cursor from metrics.py
+SQL_PROFILE = os.getenv("SQL_PROFILE", "1") == "1"
+#Statements slower than this many milliseconds go in the slow log
+SLOW_QUERY_MS = float(os.getenv("SLOW_QUERY_MS", 250))
+#Fraction of slow read-only statements whose plan is captured with EXPLAIN (ANALYZE, BUFFERS)
+EXPLAIN_SAMPLE_RATE = float(os.getenv("EXPLAIN_SAMPLE_RATE", 0.1))
+#Slow statements kept per worker, oldest dropped first
+SLOW_QUERY_LOG_SIZE = int(os.getenv("SLOW_QUERY_LOG_SIZE", 50))
+#Distinct (function, SQL shape) pairs tracked per worker, anything past that is counted under "(other)"
+PROFILE_MAX_STATEMENTS = int(os.getenv("PROFILE_MAX_STATEMENTS", 1000))
+
+DBQ_MODULE = "library_manager.dbq"
+#Frames from these modules are plumbing, never the caller
+_SKIP_MODULES = (__name__, metrics.__name__, "psycopg", "psycopg_pool", "contextlib", "asyncio")
+
+_NORMALIZE = [
+    (re.compile(r"--[^\n]*"), " "),
+    (re.compile(r"/\*.*?\*/", re.S), " "),
+    (re.compile(r"'(?:[^']|'')*'"), "?"),
+    (re.compile(r"%\(\w+\)[sbt]|%[sbt]|\$\d+"), "?"),
+    (re.compile(r"(?<![\w.])\d+(?:\.\d+)?\b"), "?"),
+    (re.compile(r"\s+"), " "),
+    #IN lists and VALUES rows of any length are the same statement
+    (re.compile(r"\(\s*\?(?:\s*,\s*\?)+\s*\)"), "(?, ...)"),
+]
+
+
+@functools.lru_cache(maxsize=1024)
+def normalize(query: str):
+    #SQL text with literals and placeholders replaced by ?, so every call of a statement lands in one row
+    for pattern, replacement in _NORMALIZE:
+        query = pattern.sub(replacement, query)
+    return query.strip()
+
+
+def _caller():
+    #The outermost dbq function on the stack, so a helper like _writeAndList is reported as the public call using it
+    #Statements sent from outside dbq are reported as module.function of the first frame that isn't plumbing
+    frame = sys._getframe(2)
+    found = None
+    outside = None
+    while frame is not None:
+        module = frame.f_globals.get("__name__", "")
+        if module == DBQ_MODULE:
+            found = frame.f_code.co_name
+        elif found is None and outside is None and not module.startswith(_SKIP_MODULES):
+            outside = f"{module.rsplit('.', 1)[-1]}.{frame.f_code.co_name}"
+        frame = frame.f_back
+    return found or outside or "(unknown)"
+
+
+class Profile():
+    def __init__(self):
+        self._statements = {}
+        self._slow = deque(maxlen=SLOW_QUERY_LOG_SIZE)
+        self._lock = threading.Lock()
+        self.since = time.time()
+
+    def record(self, function: str, statement: str, seconds: float, rows: int):
+        key = (function, statement)
+        with self._lock:
+            entry = self._statements.get(key)
+            if entry is None:
+                if len(self._statements) >= PROFILE_MAX_STATEMENTS:
+                    key = ("(other)", "(other)")
+                entry = self._statements.setdefault(key, {"calls": 0, "seconds": 0.0, "max_seconds": 0.0, "rows": 0})
+            entry["calls"] += 1
+            entry["seconds"] += seconds
+            entry["max_seconds"] = max(entry["max_seconds"], seconds)
+            entry["rows"] += max(rows, 0)
+
+    def slow(self, function: str, statement: str, seconds: float, rows: int, plan: str = None):
+        with self._lock:
+            self._slow.append({
+                "at": time.time(),
+                "function": function,
+                "sql": statement,
+                "ms": round(seconds * 1000, 3),
+                "rows": rows,
+                "plan": plan,
+            })
+
+    def top(self, limit: int = 20, by: str = "seconds"):
+        #Statements ranked by total time (or "calls", "max_seconds", "rows"), heaviest first
+        with self._lock:
+            entries = [dict(entry, function=function, sql=statement) for (function, statement), entry in self._statements.items()]
+        entries.sort(key=lambda entry: entry[by], reverse=True)
+        for entry in entries:
+            entry["mean_ms"] = round(entry["seconds"] / entry["calls"] * 1000, 3)
+            entry["seconds"] = round(entry["seconds"], 6)
+            entry["max_seconds"] = round(entry["max_seconds"], 6)
+        return entries[:limit]
+
+    def functions(self, limit: int = 20):
+        #Per dbq function totals, heaviest first
+        totals = {}
+        with self._lock:
+            for (function, _), entry in self._statements.items():
+                total = totals.setdefault(function, {"function": function, "calls": 0, "seconds": 0.0})
+                total["calls"] += entry["calls"]
+                total["seconds"] += entry["seconds"]
+        return sorted(totals.values(), key=lambda total: total["seconds"], reverse=True)[:limit]
+
+    def slow_log(self):
+        with self._lock:
+            return list(reversed(self._slow))
+
+    def reset(self):
+        with self._lock:
+            self._statements.clear()
+            self._slow.clear()
+            self.since = time.time()
+
+
+profile = Profile()
+
+
+#EXPLAIN ANALYZE runs the statement again, anything that changes data or has an effect outside the
+#transaction (notifications, sequences, advisory locks) can't be run twice, even inside a rolled back savepoint
+_SIDE_EFFECTS = re.compile(r"\b(insert|update|delete|merge|refresh_album_summary|rebuild_suggestions|count_suggestions"
+                           r"|pg_notify|nextval|setval|pg_advisory_\w+)\b", re.I)
+
+
+def _explainable(statement: str):
+    #Read-only queries, writes and COPY, DDL and the like are left out
+    #statement is normalized, so a word inside a string literal can't rule a query out
+    if statement.split(" ", 1)[0].upper() not in ("SELECT", "WITH", "VALUES"):
+        return False
+    return _SIDE_EFFECTS.search(statement) is None
+
+
+class ProfilingCursor(metrics.TimedCursor):
+    #Pool cursor that feeds the profile on top of the per-request timings
+
+    def _text(self, query):
+        if isinstance(query, sql.Composable):
+            return query.as_string(self)
+        if isinstance(query, bytes):
+            return query.decode()
+        return query
+
+    def _record(self, query, seconds: float):
+        function = _caller()
+        statement = normalize(self._text(query))
+        #rowcount is -1 until a pipeline syncs, those statements only count towards calls and time
+        profile.record(function, statement, seconds, self.rowcount)
+        return function, statement
+
+    async def execute(self, query, params=None, **kwargs):
+        start = time.perf_counter()
+        try:
+            result = await super().execute(query, params, **kwargs)
+        except BaseException:
+            self._record(query, time.perf_counter() - start)
+            raise
+        seconds = time.perf_counter() - start
+        function, statement = self._record(query, seconds)
+        if seconds * 1000 >= SLOW_QUERY_MS:
+            plan = None
+            if random.random() < EXPLAIN_SAMPLE_RATE and _explainable(statement):
+                plan = await self._explain(query, params)
+            profile.slow(function, statement, seconds, self.rowcount, plan)
+        return result
+
+    async def executemany(self, query, params_seq, **kwargs):
+        start = time.perf_counter()
+        try:
+            return await super().executemany(query, params_seq, **kwargs)
+        finally:
+            self._record(query, time.perf_counter() - start)
+
+    async def _explain(self, query, params):
+        #Runs the (read-only, see _explainable) statement again under EXPLAIN (ANALYZE, BUFFERS) for actual
+        #row counts, timings and buffer hits
+        #Runs on the same connection so the plan sees the same uncommitted rows, in a savepoint that is
+        #always rolled back so a failing EXPLAIN can't abort the caller's transaction
+        #Skipped inside a pipeline or a failed transaction, where another statement can't be slipped in
+        conn = self.connection
+        if self.pgconn.pipeline_status != pq.PipelineStatus.OFF or conn.info.transaction_status == pq.TransactionStatus.INERROR:
+            return None
+        if isinstance(query, bytes):
+            query = query.decode()
+        explain = sql.SQL("EXPLAIN (ANALYZE, BUFFERS) ") + (query if isinstance(query, sql.Composable) else sql.SQL(query))
+        try:
+            async with conn.transaction(force_rollback=True):
+                #A plain cursor, the EXPLAIN must not count towards the request or the profile
+                async with psycopg.AsyncCursor(conn) as cur:
+                    await cur.execute(explain, params)
+                    return "\n".join(row[0] for row in await cur.fetchall())
+        except psycopg.Error as e:
+            return f"EXPLAIN failed: {e}"
+
+
+def cursor_factory():
+    return ProfilingCursor if SQL_PROFILE else metrics.TimedCursor
@@ -0,0 +1,99 @@
+import asyncio, os, threading, time
+import psycopg
+from dotenv import load_dotenv
+from library_manager import background, database
+
+load_dotenv()
+#Triggers in libraryschema.sql send the changed table's name on this channel
+CHANNEL = "reference_data"
+#Seconds between attempts to get the listener back after its connection drops
+LISTEN_RETRY = float(os.getenv("REFERENCE_CACHE_LISTEN_RETRY", 5))
+#Seconds a logged in user's User object is reused before load_user asks the database again
+USER_TTL = float(os.getenv("USER_CACHE_TTL", 300))
+
+
+class ReferenceCache():
+    #In-process cache of rarely-changing tables (medium, parameters, users), keyed by (table, key)
+    #Every worker keeps one LISTEN connection open, a NOTIFY for a table drops that table's entries
+    #Nothing is served from the cache while the listener is down, since a change could be missed
+    def __init__(self, channel: str = CHANNEL):
+        self.channel = channel
+        #Counters are per process
+        self.stats = {"hits": 0, "misses": 0, "invalidations": 0}
+        self._entries = {}
+        #Bumped on every invalidation so a load that raced a change isn't stored
+        self._generations = {}
+        self._epoch = 0
+        self._listening = False
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def _start(self):
+        #One listener per process, restarted after a fork like the pool
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            self._entries.clear()
+            self._listening = False
+        background.submit(self._listen())
+
+    async def _listen(self):
+        while True:
+            try:
+                async with await psycopg.AsyncConnection.connect(database.DATABASE_URL, autocommit=True) as conn:
+                    await conn.execute(f"LISTEN {self.channel}")
+                    with self._lock:
+                        self._listening = True
+                    async for notify in conn.notifies():
+                        self.invalidate(notify.payload)
+            except psycopg.Error:
+                pass
+            with self._lock:
+                self._listening = False
+            #Whatever changed while nobody was listening is unknown, start over once we're back
+            self.invalidate()
+            await asyncio.sleep(LISTEN_RETRY)
+
+    async def get(self, table: str, key: str, load, ttl: float = None):
+        #Returns the cached value for (table, key), calling load() on a miss
+        #ttl bounds how long an entry lives even if no NOTIFY ever comes for it
+        self._start()
+        with self._lock:
+            listening = self._listening
+            entry = self._entries.get((table, key))
+            if listening and entry is not None and (entry[1] is None or entry[1] > time.monotonic()):
+                self.stats["hits"] += 1
+                return entry[0]
+            self.stats["misses"] += 1
+            generation = (self._epoch, self._generations.get(table, 0))
+        value = await load()
+        with self._lock:
+            if listening and (self._epoch, self._generations.get(table, 0)) == generation:
+                self._entries[(table, key)] = (value, time.monotonic() + ttl if ttl else None)
+        return value
+
+    def invalidate(self, table: str = None, key: str = None):
+        #Drops one entry, one table's entries, or everything when table is None
+        with self._lock:
+            for cached in [cached for cached in self._entries if table is None or cached == (table, key) or (key is None and cached[0] == table)]:
+                del self._entries[cached]
+            if table is None:
+                self._epoch += 1
+            else:
+                self._generations[table] = self._generations.get(table, 0) + 1
+            self.stats["invalidations"] += 1
+
+    def generation(self, table: str):
+        #Current (epoch, generation) for a table, caches built on top of a table compare it to spot stale entries
+        #None while the listener is down, nothing derived from the table should be trusted then
+        self._start()
+        with self._lock:
+            return (self._epoch, self._generations.get(table, 0)) if self._listening else None
+
+    def hit_ratio(self):
+        lookups = self.stats["hits"] + self.stats["misses"]
+        return self.stats["hits"] / lookups if lookups else 0.0
+
+
+cache = ReferenceCache()
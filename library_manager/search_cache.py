@@ -0,0 +1,88 @@
+import os, threading
+from collections import OrderedDict
+from dotenv import load_dotenv
+from library_manager import dbq
+from library_manager.reference_cache import cache as referenceCache
+
+load_dotenv()
+#Most recently used result pages kept per worker
+SEARCH_CACHE_SIZE = int(os.getenv("SEARCH_CACHE_SIZE", 512))
+#Most recently used autocomplete responses kept per worker, one per (kind, typed prefix)
+SUGGEST_CACHE_SIZE = int(os.getenv("SUGGEST_CACHE_SIZE", 4096))
+#Suggestions returned per keystroke
+SUGGEST_LIMIT = int(os.getenv("SUGGEST_LIMIT", 10))
+#Generation name bumped by the album add/edit/delete paths and the library triggers
+LIBRARY = "library"
+
+
+def normalize(term: str):
+    #Cache key for a search term, terms that only differ in case share an entry
+    #ILIKE, lower() and trigram similarity all ignore case, so they match the same rows, but the key is only
+    #a key: the term as typed is what gets searched. casefold() or collapsing whitespace would change what
+    #a substring search matches (ß -> ss, double spaces in a name)
+    return (term or "").lower()
+
+
+class SearchCache():
+    #Bounded LRU of query results built from the library tables
+    #Every entry remembers the library generation it was built at, an entry from an older generation is a miss
+    def __init__(self, max_entries: int = SEARCH_CACHE_SIZE):
+        self.max_entries = max_entries
+        #Counters are per process
+        self.stats = {"hits": 0, "misses": 0, "stale": 0, "evictions": 0}
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    async def get(self, key, load):
+        #Returns the cached result for key, calling load() on a miss
+        #Results are shared between requests, load() should hand back something nobody mutates
+        generation = referenceCache.generation(LIBRARY)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and generation is not None and entry[0] == generation:
+                self._entries.move_to_end(key)
+                self.stats["hits"] += 1
+                return entry[1]
+            self.stats["stale" if entry is not None else "misses"] += 1
+        value = await load()
+        if generation is not None:
+            with self._lock:
+                #The generation read before the query, a write that lands meanwhile makes this entry stale at once
+                self._entries[key] = (generation, value)
+                self._entries.move_to_end(key)
+                while len(self._entries) > self.max_entries:
+                    self._entries.popitem(last=False)
+                    self.stats["evictions"] += 1
+        return value
+
+    def __len__(self):
+        return len(self._entries)
+
+    def hit_ratio(self):
+        lookups = self.stats["hits"] + self.stats["misses"] + self.stats["stale"]
+        return self.stats["hits"] / lookups if lookups else 0.0
+
+
+pages = SearchCache(SEARCH_CACHE_SIZE)
+suggestions = SearchCache(SUGGEST_CACHE_SIZE)
+
+
+async def search(conn, album: str, artist: str, genre: str, track: str, cursor: tuple = None, backward: bool = False):
+    #Drop-in for dbq.searchlibrary keyed on the normalized terms and the page position, returns (rows, more)
+    album, artist, genre, track = album or "", artist or "", genre or "", track or ""
+    async def load():
+        rows, more = await dbq.searchlibrary(conn, album, artist, genre, track, cursor, backward)
+        return tuple(rows), more
+    key = (normalize(album), normalize(artist), normalize(genre), normalize(track), cursor, backward)
+    rows, more = await pages.get(key, load)
+    return list(rows), more
+
+
+async def suggest(conn, kind: str, term: str):
+    #Autocomplete names of one kind for what's been typed so far, as (name, uses) pairs
+    term = term or ""
+    if not term.strip():
+        return ()
+    async def load():
+        return tuple(await dbq.suggest(conn, kind, term, SUGGEST_LIMIT))
+    return await suggestions.get((kind, normalize(term)), load)
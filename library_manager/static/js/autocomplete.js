@@ -0,0 +1,40 @@
+// Typeahead for inputs marked with data-autocomplete="artist|album|track|genre"
+// Suggestions come from /autocomplete/<kind> and are shown through a <datalist>
+// Inputs that also have data-autocomplete-list complete the last entry of a comma delimited list
+$(function() {
+    $('input[data-autocomplete]').each(function(index) {
+        const input = $(this);
+        const kind = input.data('autocomplete');
+        const isList = input.is('[data-autocomplete-list]');
+        const listId = 'autocomplete-' + kind + '-' + index;
+        const datalist = $('<datalist>').attr('id', listId).insertAfter(input);
+        input.attr('list', listId).attr('autocomplete', 'off');
+
+        let timer = null;
+        let request = null;
+        input.on('input', function() {
+            clearTimeout(timer);
+            timer = setTimeout(function() {
+                const value = input.val();
+                const cut = isList ? value.lastIndexOf(',') + 1 : 0;
+                const before = value.slice(0, cut);
+                const term = value.slice(cut).trim();
+                if (!term) {
+                    datalist.empty();
+                    return;
+                }
+                // Only the latest keystroke's answer matters
+                if (request) {
+                    request.abort();
+                }
+                request = $.getJSON('/autocomplete/' + kind, { q: term }, function(data) {
+                    datalist.empty();
+                    data.suggestions.forEach(function(suggestion) {
+                        const option = before ? before.trimEnd() + ' ' + suggestion.value : suggestion.value;
+                        datalist.append($('<option>').attr('value', option));
+                    });
+                });
+            }, 100);
+        });
+    });
+});
@@ -1,6 +1,9 @@
+-- Creates the database from scratch, upgrade an existing one with migrations/upgrade.sql instead
 CREATE DATABASE library;
 \c library;
 
+CREATE EXTENSION IF NOT EXISTS pg_trgm;
+
 CREATE TABLE users (
     userID uuid PRIMARY KEY DEFAULT gen_random_uuid(),
     firstName varchar(300) NOT NULL,
@@ -30,7 +33,9 @@ CREATE TABLE album (
     albumShort varchar(5) NOT NULL,
     genre varchar(25) NOT NULL,
     picture bytea,
-    releaseDate int
+    releaseDate int,
+    -- ETag for album_art, hashed once whenever picture is written instead of on every request
+    pictureTag char(32) GENERATED ALWAYS AS (md5(picture)) STORED
 );
 
 CREATE TABLE medium (
@@ -53,6 +58,8 @@ CREATE TABLE track (
 CREATE TABLE album_track (
     albumID uuid REFERENCES album(albumID),
     trackID uuid REFERENCES track(trackID),
+    -- Position on the album, 1 based, NULL for rows written before tracks were numbered
+    trackNumber int,
     PRIMARY KEY (albumID, trackID)
 );
 
@@ -81,11 +88,249 @@ CREATE TABLE album_medium (
     PRIMARY KEY (mediumID, albumID)
 );
 
+-- Pre-sized copies of album.picture, regenerated whenever the picture changes
+CREATE TABLE album_thumbnail (
+    albumID uuid REFERENCES album(albumID) ON DELETE CASCADE,
+    size int NOT NULL,
+    mimetype varchar(25) NOT NULL,
+    image bytea NOT NULL,
+    -- ETag for album_art ?size=, same as album.pictureTag
+    tag char(32) GENERATED ALWAYS AS (md5(image)) STORED,
+    PRIMARY KEY (albumID, size)
+);
+
+-- One row per album with everything the home listing shows, so listing a page needs no joins
+-- Rebuilt by refresh_album_summary() whenever dbq changes an album or its artists, mediums or tracks
+CREATE TABLE album_summary (
+    albumID uuid PRIMARY KEY REFERENCES album(albumID) ON DELETE CASCADE,
+    albumName varchar(255) NOT NULL,
+    genre varchar(25) NOT NULL,
+    artists text NOT NULL DEFAULT '',
+    mediums text[] NOT NULL DEFAULT '{}',
+    trackCount int NOT NULL DEFAULT 0,
+    sortKey text NOT NULL
+);
+
+CREATE FUNCTION refresh_album_summary(ids uuid[]) RETURNS void AS $$
+    INSERT INTO album_summary (albumID, albumName, genre, artists, mediums, trackCount, sortKey)
+    SELECT album.albumID, album.albumName, album.genre,
+        coalesce((SELECT string_agg(artist.artistName, ', ' ORDER BY artist.artistName)
+                  FROM album_artist
+                  JOIN artist ON artist.artistID = album_artist.artistID
+                  WHERE album_artist.albumID = album.albumID), ''),
+        coalesce((SELECT array_agg(medium.mediumName::text ORDER BY medium.mediumName)
+                  FROM album_medium
+                  JOIN medium ON medium.mediumID = album_medium.mediumID
+                  WHERE album_medium.albumID = album.albumID), '{}'),
+        (SELECT count(*) FROM album_track WHERE album_track.albumID = album.albumID),
+        -- Shelf order: case-insensitive, ignoring a leading "The", "A" or "An"
+        lower(regexp_replace(album.albumName, '^(the|a|an)\s+', '', 'i'))
+    FROM album
+    WHERE album.albumID = ANY(ids)
+    ON CONFLICT (albumID) DO UPDATE
+    SET albumName = EXCLUDED.albumName, genre = EXCLUDED.genre, artists = EXCLUDED.artists,
+        mediums = EXCLUDED.mediums, trackCount = EXCLUDED.trackCount, sortKey = EXCLUDED.sortKey;
+$$ LANGUAGE sql;
+
+-- Typeahead suggestions, every artist, album name, track name and genre with how often the library uses it
+-- Artists count their album credits, the other kinds the rows carrying the name
+-- Kept current by the *_suggestions triggers, so autocomplete never has to count the library itself
+CREATE TABLE suggestion (
+    kind varchar(10) NOT NULL,
+    name varchar(255) NOT NULL,
+    uses int NOT NULL DEFAULT 0,
+    PRIMARY KEY (kind, name)
+);
+
+-- One use for every name in added, one less for every name in removed
+-- Names nothing uses any more are dropped, artists are listed for as long as the artist row exists
+CREATE FUNCTION count_suggestions(suggestionKind text, added text[], removed text[]) RETURNS void AS $$
+    INSERT INTO suggestion (kind, name, uses)
+    SELECT suggestionKind, name, sum(change)
+    FROM (SELECT name, 1 AS change FROM unnest(added) AS name
+          UNION ALL
+          SELECT name, -1 FROM unnest(removed) AS name) changes
+    GROUP BY name
+    HAVING sum(change) <> 0
+    ON CONFLICT (kind, name) DO UPDATE SET uses = suggestion.uses + EXCLUDED.uses;
+    DELETE FROM suggestion
+    WHERE kind = suggestionKind AND kind <> 'artist' AND uses <= 0 AND name = ANY(removed);
+$$ LANGUAGE sql;
+
+-- Counts every suggestion from scratch, for a database that had none and after a bulk load
+CREATE FUNCTION rebuild_suggestions() RETURNS void AS $$
+    DELETE FROM suggestion;
+    INSERT INTO suggestion (kind, name, uses)
+    SELECT 'artist', artist.artistName, count(album_artist.albumID)
+    FROM artist LEFT JOIN album_artist ON album_artist.artistID = artist.artistID
+    GROUP BY artist.artistName
+    UNION ALL
+    SELECT 'album', albumName, count(*) FROM album_summary GROUP BY albumName
+    UNION ALL
+    SELECT 'genre', genre, count(*) FROM album_summary GROUP BY genre
+    UNION ALL
+    SELECT 'track', trackName, count(*) FROM track GROUP BY trackName;
+$$ LANGUAGE sql;
+
 CREATE TABLE parameters (
     key varchar(50) PRIMARY KEY,
     value text NOT NULL
 );
 
 
+-- Search indexes, trigram GIN indexes let ILIKE '%term%' skip the sequential scan
+-- Album name and genre are searched through album_summary, so only its copies of them are indexed
+CREATE INDEX artist_artistname_trgm_idx ON artist USING gin (artistName gin_trgm_ops);
+CREATE INDEX track_trackname_trgm_idx ON track USING gin (trackName gin_trgm_ops);
+-- The home listing reads album_summary, keyset pagination walks (sortKey, albumID) in order
+CREATE INDEX album_summary_albumname_trgm_idx ON album_summary USING gin (albumName gin_trgm_ops);
+CREATE INDEX album_summary_genre_trgm_idx ON album_summary USING gin (genre gin_trgm_ops);
+CREATE INDEX album_summary_artists_trgm_idx ON album_summary USING gin (artists gin_trgm_ops);
+CREATE INDEX album_summary_sortkey_idx ON album_summary (sortKey, albumID);
+-- Typeahead, a typed prefix is a range of the first index, one or two letters walk the most used names
+-- in order with the second, and typos get the closest names in distance order from the GiST index
+CREATE INDEX suggestion_prefix_idx ON suggestion (kind, lower(name) text_pattern_ops, uses DESC);
+CREATE INDEX suggestion_uses_idx ON suggestion (kind, uses DESC, name);
+CREATE INDEX suggestion_name_trgm_idx ON suggestion USING gist (name gist_trgm_ops);
+-- Reverse lookups for the link tables, the primary keys only cover the other direction
+CREATE INDEX album_artist_albumid_idx ON album_artist (albumID);
+CREATE INDEX album_track_trackid_idx ON album_track (trackID);
+CREATE INDEX artist_track_trackid_idx ON artist_track (trackID);
+-- Barcode lookups for intake duplicate checks
+CREATE INDEX album_medium_albumupc_idx ON album_medium (albumUPC);
+
+-- Workers cache medium, parameters and logged in users in process, any change tells them to drop the table's entries
+-- A trigger argument names the cached table when it isn't the one that changed
+CREATE FUNCTION notify_reference_change() RETURNS trigger AS $$
+BEGIN
+    PERFORM pg_notify('reference_data', coalesce(TG_ARGV[0], TG_TABLE_NAME));
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+CREATE TRIGGER medium_reference_change AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON medium
+    FOR EACH STATEMENT EXECUTE FUNCTION notify_reference_change();
+CREATE TRIGGER parameters_reference_change AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON parameters
+    FOR EACH STATEMENT EXECUTE FUNCTION notify_reference_change();
+CREATE TRIGGER users_reference_change AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON users
+    FOR EACH STATEMENT EXECUTE FUNCTION notify_reference_change();
+CREATE TRIGGER invitedusers_reference_change AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON invitedusers
+    FOR EACH STATEMENT EXECUTE FUNCTION notify_reference_change('users');
+-- Any change to what the home listing shows makes every worker's cached search pages stale
+CREATE TRIGGER album_library_change AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON album
+    FOR EACH STATEMENT EXECUTE FUNCTION notify_reference_change('library');
+CREATE TRIGGER album_artist_library_change AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON album_artist
+    FOR EACH STATEMENT EXECUTE FUNCTION notify_reference_change('library');
+CREATE TRIGGER album_medium_library_change AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON album_medium
+    FOR EACH STATEMENT EXECUTE FUNCTION notify_reference_change('library');
+CREATE TRIGGER album_track_library_change AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON album_track
+    FOR EACH STATEMENT EXECUTE FUNCTION notify_reference_change('library');
+CREATE TRIGGER artist_library_change AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON artist
+    FOR EACH STATEMENT EXECUTE FUNCTION notify_reference_change('library');
+CREATE TRIGGER track_library_change AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON track
+    FOR EACH STATEMENT EXECUTE FUNCTION notify_reference_change('library');
+CREATE TRIGGER artist_track_library_change AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON artist_track
+    FOR EACH STATEMENT EXECUTE FUNCTION notify_reference_change('library');
+
+-- Suggestion counts follow the rows they count, statement triggers so a bulk write is counted in one go
+-- Arguments are (kind, column) pairs naming where the suggestions of each kind come from
+CREATE FUNCTION row_suggestions() RETURNS trigger AS $$
+DECLARE
+    added text[];
+    removed text[];
+BEGIN
+    FOR i IN 0 .. TG_NARGS - 1 BY 2 LOOP
+        IF TG_OP = 'TRUNCATE' THEN
+            DELETE FROM suggestion WHERE kind = TG_ARGV[i];
+            CONTINUE;
+        END IF;
+        added := '{}';
+        removed := '{}';
+        IF TG_OP IN ('INSERT', 'UPDATE') THEN
+            EXECUTE format('SELECT coalesce(array_agg(%I), ''{}'') FROM new_rows', TG_ARGV[i + 1]) INTO added;
+        END IF;
+        IF TG_OP IN ('UPDATE', 'DELETE') THEN
+            EXECUTE format('SELECT coalesce(array_agg(%I), ''{}'') FROM old_rows', TG_ARGV[i + 1]) INTO removed;
+        END IF;
+        PERFORM count_suggestions(TG_ARGV[i], added, removed);
+    END LOOP;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+-- Artists are counted by album credit, so both artist and album_artist feed them
+CREATE FUNCTION artist_suggestions() RETURNS trigger AS $$
+DECLARE
+    added text[] := '{}';
+    removed text[] := '{}';
+BEGIN
+    IF TG_OP = 'TRUNCATE' AND TG_TABLE_NAME = 'artist' THEN
+        DELETE FROM suggestion WHERE kind = 'artist';
+        RETURN NULL;
+    ELSIF TG_OP = 'TRUNCATE' THEN
+        UPDATE suggestion SET uses = 0 WHERE kind = 'artist';
+        RETURN NULL;
+    END IF;
+    IF TG_TABLE_NAME = 'artist' THEN
+        -- A new artist is listed with the credits it has, a rename takes them along, a deleted artist goes
+        IF TG_OP IN ('UPDATE', 'DELETE') THEN
+            DELETE FROM suggestion WHERE kind = 'artist' AND name IN (SELECT artistName FROM old_rows);
+        END IF;
+        IF TG_OP IN ('INSERT', 'UPDATE') THEN
+            INSERT INTO suggestion (kind, name, uses)
+            SELECT 'artist', new_rows.artistName, count(album_artist.albumID)
+            FROM new_rows LEFT JOIN album_artist ON album_artist.artistID = new_rows.artistID
+            GROUP BY new_rows.artistName
+            ON CONFLICT (kind, name) DO UPDATE SET uses = EXCLUDED.uses;
+        END IF;
+        RETURN NULL;
+    END IF;
+    IF TG_OP IN ('INSERT', 'UPDATE') THEN
+        added := array(SELECT artist.artistName FROM new_rows JOIN artist ON artist.artistID = new_rows.artistID);
+    END IF;
+    IF TG_OP IN ('UPDATE', 'DELETE') THEN
+        removed := array(SELECT artist.artistName FROM old_rows JOIN artist ON artist.artistID = old_rows.artistID);
+    END IF;
+    PERFORM count_suggestions('artist', added, removed);
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+-- Transition tables differ per event, so each event gets its own trigger
+CREATE TRIGGER artist_suggestions_insert AFTER INSERT ON artist REFERENCING NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION artist_suggestions();
+CREATE TRIGGER artist_suggestions_update AFTER UPDATE ON artist REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION artist_suggestions();
+CREATE TRIGGER artist_suggestions_delete AFTER DELETE ON artist REFERENCING OLD TABLE AS old_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION artist_suggestions();
+CREATE TRIGGER artist_suggestions_truncate AFTER TRUNCATE ON artist
+    FOR EACH STATEMENT EXECUTE FUNCTION artist_suggestions();
+CREATE TRIGGER album_artist_suggestions_insert AFTER INSERT ON album_artist REFERENCING NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION artist_suggestions();
+CREATE TRIGGER album_artist_suggestions_update AFTER UPDATE ON album_artist REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION artist_suggestions();
+CREATE TRIGGER album_artist_suggestions_delete AFTER DELETE ON album_artist REFERENCING OLD TABLE AS old_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION artist_suggestions();
+CREATE TRIGGER album_artist_suggestions_truncate AFTER TRUNCATE ON album_artist
+    FOR EACH STATEMENT EXECUTE FUNCTION artist_suggestions();
+CREATE TRIGGER album_summary_suggestions_insert AFTER INSERT ON album_summary REFERENCING NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION row_suggestions('album', 'albumname', 'genre', 'genre');
+CREATE TRIGGER album_summary_suggestions_update AFTER UPDATE ON album_summary REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION row_suggestions('album', 'albumname', 'genre', 'genre');
+CREATE TRIGGER album_summary_suggestions_delete AFTER DELETE ON album_summary REFERENCING OLD TABLE AS old_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION row_suggestions('album', 'albumname', 'genre', 'genre');
+CREATE TRIGGER album_summary_suggestions_truncate AFTER TRUNCATE ON album_summary
+    FOR EACH STATEMENT EXECUTE FUNCTION row_suggestions('album', 'albumname', 'genre', 'genre');
+CREATE TRIGGER track_suggestions_insert AFTER INSERT ON track REFERENCING NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION row_suggestions('track', 'trackname');
+CREATE TRIGGER track_suggestions_update AFTER UPDATE ON track REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION row_suggestions('track', 'trackname');
+CREATE TRIGGER track_suggestions_delete AFTER DELETE ON track REFERENCING OLD TABLE AS old_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION row_suggestions('track', 'trackname');
+CREATE TRIGGER track_suggestions_truncate AFTER TRUNCATE ON track
+    FOR EACH STATEMENT EXECUTE FUNCTION row_suggestions('track', 'trackname');
+
+
+
+-- The app's role reads and writes rows only, generate-catalog connects as the table owner (CATALOG_DATABASE_URL)
 CREATE USER library WITH PASSWORD 'library';
 GRANT SELECT, INSERT, UPDATE, DELETE ON ALL TABLES IN SCHEMA public TO library;
@@ -0,0 +1,298 @@
+-- Brings a database created from an older libraryschema.sql up to date, run it as the owner of the tables:
+--     psql -d library -f migrations/upgrade.sql
+-- Every step checks what is already there, so it is safe to run again or on a database that is already current
+-- Run it outside a transaction (psql's default), CREATE/DROP INDEX CONCURRENTLY can't run inside one
+
+CREATE EXTENSION IF NOT EXISTS pg_trgm;
+
+
+-- Album art ETags, hashed once when the picture is written (adding a stored column rewrites the table)
+ALTER TABLE album ADD COLUMN IF NOT EXISTS pictureTag char(32) GENERATED ALWAYS AS (md5(picture)) STORED;
+
+CREATE TABLE IF NOT EXISTS album_thumbnail (
+    albumID uuid REFERENCES album(albumID) ON DELETE CASCADE,
+    size int NOT NULL,
+    mimetype varchar(25) NOT NULL,
+    image bytea NOT NULL,
+    PRIMARY KEY (albumID, size)
+);
+ALTER TABLE album_thumbnail ADD COLUMN IF NOT EXISTS tag char(32) GENERATED ALWAYS AS (md5(image)) STORED;
+
+
+-- Track positions, existing albums are numbered in the order their tracks were listed before numbering (trackID)
+-- Tracks already numbered keep their place, unnumbered ones go after them
+ALTER TABLE album_track ADD COLUMN IF NOT EXISTS trackNumber int;
+UPDATE album_track
+SET trackNumber = numbered.trackNumber
+FROM (
+    SELECT albumID, trackID,
+        coalesce(max(trackNumber) OVER (PARTITION BY albumID), 0)
+        + row_number() OVER (PARTITION BY albumID, trackNumber IS NULL ORDER BY trackID) AS trackNumber
+    FROM album_track
+) numbered
+WHERE album_track.trackNumber IS NULL
+AND numbered.albumID = album_track.albumID AND numbered.trackID = album_track.trackID;
+
+
+-- Home listing summary, filled for every album once the table and function exist
+CREATE TABLE IF NOT EXISTS album_summary (
+    albumID uuid PRIMARY KEY REFERENCES album(albumID) ON DELETE CASCADE,
+    albumName varchar(255) NOT NULL,
+    genre varchar(25) NOT NULL,
+    artists text NOT NULL DEFAULT '',
+    mediums text[] NOT NULL DEFAULT '{}',
+    trackCount int NOT NULL DEFAULT 0,
+    sortKey text NOT NULL
+);
+
+CREATE OR REPLACE FUNCTION refresh_album_summary(ids uuid[]) RETURNS void AS $$
+    INSERT INTO album_summary (albumID, albumName, genre, artists, mediums, trackCount, sortKey)
+    SELECT album.albumID, album.albumName, album.genre,
+        coalesce((SELECT string_agg(artist.artistName, ', ' ORDER BY artist.artistName)
+                  FROM album_artist
+                  JOIN artist ON artist.artistID = album_artist.artistID
+                  WHERE album_artist.albumID = album.albumID), ''),
+        coalesce((SELECT array_agg(medium.mediumName::text ORDER BY medium.mediumName)
+                  FROM album_medium
+                  JOIN medium ON medium.mediumID = album_medium.mediumID
+                  WHERE album_medium.albumID = album.albumID), '{}'),
+        (SELECT count(*) FROM album_track WHERE album_track.albumID = album.albumID),
+        -- Shelf order: case-insensitive, ignoring a leading "The", "A" or "An"
+        lower(regexp_replace(album.albumName, '^(the|a|an)\s+', '', 'i'))
+    FROM album
+    WHERE album.albumID = ANY(ids)
+    ON CONFLICT (albumID) DO UPDATE
+    SET albumName = EXCLUDED.albumName, genre = EXCLUDED.genre, artists = EXCLUDED.artists,
+        mediums = EXCLUDED.mediums, trackCount = EXCLUDED.trackCount, sortKey = EXCLUDED.sortKey;
+$$ LANGUAGE sql;
+
+-- Before the indexes below, so they are built once over the full table instead of row by row
+SELECT refresh_album_summary(array(SELECT albumID FROM album));
+
+
+-- Indexes, built without locking out writes to the live tables
+CREATE INDEX CONCURRENTLY IF NOT EXISTS artist_artistname_trgm_idx ON artist USING gin (artistName gin_trgm_ops);
+CREATE INDEX CONCURRENTLY IF NOT EXISTS track_trackname_trgm_idx ON track USING gin (trackName gin_trgm_ops);
+CREATE INDEX CONCURRENTLY IF NOT EXISTS album_summary_albumname_trgm_idx ON album_summary USING gin (albumName gin_trgm_ops);
+CREATE INDEX CONCURRENTLY IF NOT EXISTS album_summary_genre_trgm_idx ON album_summary USING gin (genre gin_trgm_ops);
+CREATE INDEX CONCURRENTLY IF NOT EXISTS album_summary_artists_trgm_idx ON album_summary USING gin (artists gin_trgm_ops);
+CREATE INDEX CONCURRENTLY IF NOT EXISTS album_summary_sortkey_idx ON album_summary (sortKey, albumID);
+CREATE INDEX CONCURRENTLY IF NOT EXISTS album_artist_albumid_idx ON album_artist (albumID);
+CREATE INDEX CONCURRENTLY IF NOT EXISTS album_track_trackid_idx ON album_track (trackID);
+CREATE INDEX CONCURRENTLY IF NOT EXISTS artist_track_trackid_idx ON artist_track (trackID);
+CREATE INDEX CONCURRENTLY IF NOT EXISTS album_medium_albumupc_idx ON album_medium (albumUPC);
+-- Album name and genre searches moved to album_summary
+DROP INDEX CONCURRENTLY IF EXISTS album_albumname_trgm_idx;
+DROP INDEX CONCURRENTLY IF EXISTS album_genre_trgm_idx;
+-- Typeahead reads the suggestion table now
+DROP INDEX CONCURRENTLY IF EXISTS artist_artistname_prefix_idx;
+DROP INDEX CONCURRENTLY IF EXISTS track_trackname_prefix_idx;
+DROP INDEX CONCURRENTLY IF EXISTS album_summary_albumname_prefix_idx;
+DROP INDEX CONCURRENTLY IF EXISTS album_summary_genre_prefix_idx;
+
+
+-- Cache invalidation notifications, recreated so a rerun picks up changed trigger definitions
+CREATE OR REPLACE FUNCTION notify_reference_change() RETURNS trigger AS $$
+BEGIN
+    PERFORM pg_notify('reference_data', coalesce(TG_ARGV[0], TG_TABLE_NAME));
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+BEGIN;
+DROP TRIGGER IF EXISTS medium_reference_change ON medium;
+CREATE TRIGGER medium_reference_change AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON medium
+    FOR EACH STATEMENT EXECUTE FUNCTION notify_reference_change();
+DROP TRIGGER IF EXISTS parameters_reference_change ON parameters;
+CREATE TRIGGER parameters_reference_change AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON parameters
+    FOR EACH STATEMENT EXECUTE FUNCTION notify_reference_change();
+DROP TRIGGER IF EXISTS users_reference_change ON users;
+CREATE TRIGGER users_reference_change AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON users
+    FOR EACH STATEMENT EXECUTE FUNCTION notify_reference_change();
+DROP TRIGGER IF EXISTS invitedusers_reference_change ON invitedusers;
+CREATE TRIGGER invitedusers_reference_change AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON invitedusers
+    FOR EACH STATEMENT EXECUTE FUNCTION notify_reference_change('users');
+DROP TRIGGER IF EXISTS album_library_change ON album;
+CREATE TRIGGER album_library_change AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON album
+    FOR EACH STATEMENT EXECUTE FUNCTION notify_reference_change('library');
+DROP TRIGGER IF EXISTS album_artist_library_change ON album_artist;
+CREATE TRIGGER album_artist_library_change AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON album_artist
+    FOR EACH STATEMENT EXECUTE FUNCTION notify_reference_change('library');
+DROP TRIGGER IF EXISTS album_medium_library_change ON album_medium;
+CREATE TRIGGER album_medium_library_change AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON album_medium
+    FOR EACH STATEMENT EXECUTE FUNCTION notify_reference_change('library');
+DROP TRIGGER IF EXISTS album_track_library_change ON album_track;
+CREATE TRIGGER album_track_library_change AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON album_track
+    FOR EACH STATEMENT EXECUTE FUNCTION notify_reference_change('library');
+DROP TRIGGER IF EXISTS artist_library_change ON artist;
+CREATE TRIGGER artist_library_change AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON artist
+    FOR EACH STATEMENT EXECUTE FUNCTION notify_reference_change('library');
+DROP TRIGGER IF EXISTS track_library_change ON track;
+CREATE TRIGGER track_library_change AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON track
+    FOR EACH STATEMENT EXECUTE FUNCTION notify_reference_change('library');
+DROP TRIGGER IF EXISTS artist_track_library_change ON artist_track;
+CREATE TRIGGER artist_track_library_change AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON artist_track
+    FOR EACH STATEMENT EXECUTE FUNCTION notify_reference_change('library');
+COMMIT;
+
+
+-- Typeahead suggestions with their use counts, kept current by triggers
+CREATE TABLE IF NOT EXISTS suggestion (
+    kind varchar(10) NOT NULL,
+    name varchar(255) NOT NULL,
+    uses int NOT NULL DEFAULT 0,
+    PRIMARY KEY (kind, name)
+);
+
+CREATE OR REPLACE FUNCTION count_suggestions(suggestionKind text, added text[], removed text[]) RETURNS void AS $$
+    INSERT INTO suggestion (kind, name, uses)
+    SELECT suggestionKind, name, sum(change)
+    FROM (SELECT name, 1 AS change FROM unnest(added) AS name
+          UNION ALL
+          SELECT name, -1 FROM unnest(removed) AS name) changes
+    GROUP BY name
+    HAVING sum(change) <> 0
+    ON CONFLICT (kind, name) DO UPDATE SET uses = suggestion.uses + EXCLUDED.uses;
+    DELETE FROM suggestion
+    WHERE kind = suggestionKind AND kind <> 'artist' AND uses <= 0 AND name = ANY(removed);
+$$ LANGUAGE sql;
+
+-- Counts every suggestion from scratch, for a database that had none and after a bulk load
+CREATE OR REPLACE FUNCTION rebuild_suggestions() RETURNS void AS $$
+    DELETE FROM suggestion;
+    INSERT INTO suggestion (kind, name, uses)
+    SELECT 'artist', artist.artistName, count(album_artist.albumID)
+    FROM artist LEFT JOIN album_artist ON album_artist.artistID = artist.artistID
+    GROUP BY artist.artistName
+    UNION ALL
+    SELECT 'album', albumName, count(*) FROM album_summary GROUP BY albumName
+    UNION ALL
+    SELECT 'genre', genre, count(*) FROM album_summary GROUP BY genre
+    UNION ALL
+    SELECT 'track', trackName, count(*) FROM track GROUP BY trackName;
+$$ LANGUAGE sql;
+
+CREATE OR REPLACE FUNCTION row_suggestions() RETURNS trigger AS $$
+DECLARE
+    added text[];
+    removed text[];
+BEGIN
+    FOR i IN 0 .. TG_NARGS - 1 BY 2 LOOP
+        IF TG_OP = 'TRUNCATE' THEN
+            DELETE FROM suggestion WHERE kind = TG_ARGV[i];
+            CONTINUE;
+        END IF;
+        added := '{}';
+        removed := '{}';
+        IF TG_OP IN ('INSERT', 'UPDATE') THEN
+            EXECUTE format('SELECT coalesce(array_agg(%I), ''{}'') FROM new_rows', TG_ARGV[i + 1]) INTO added;
+        END IF;
+        IF TG_OP IN ('UPDATE', 'DELETE') THEN
+            EXECUTE format('SELECT coalesce(array_agg(%I), ''{}'') FROM old_rows', TG_ARGV[i + 1]) INTO removed;
+        END IF;
+        PERFORM count_suggestions(TG_ARGV[i], added, removed);
+    END LOOP;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+-- Artists are counted by album credit, so both artist and album_artist feed them
+CREATE OR REPLACE FUNCTION artist_suggestions() RETURNS trigger AS $$
+DECLARE
+    added text[] := '{}';
+    removed text[] := '{}';
+BEGIN
+    IF TG_OP = 'TRUNCATE' AND TG_TABLE_NAME = 'artist' THEN
+        DELETE FROM suggestion WHERE kind = 'artist';
+        RETURN NULL;
+    ELSIF TG_OP = 'TRUNCATE' THEN
+        UPDATE suggestion SET uses = 0 WHERE kind = 'artist';
+        RETURN NULL;
+    END IF;
+    IF TG_TABLE_NAME = 'artist' THEN
+        -- A new artist is listed with the credits it has, a rename takes them along, a deleted artist goes
+        IF TG_OP IN ('UPDATE', 'DELETE') THEN
+            DELETE FROM suggestion WHERE kind = 'artist' AND name IN (SELECT artistName FROM old_rows);
+        END IF;
+        IF TG_OP IN ('INSERT', 'UPDATE') THEN
+            INSERT INTO suggestion (kind, name, uses)
+            SELECT 'artist', new_rows.artistName, count(album_artist.albumID)
+            FROM new_rows LEFT JOIN album_artist ON album_artist.artistID = new_rows.artistID
+            GROUP BY new_rows.artistName
+            ON CONFLICT (kind, name) DO UPDATE SET uses = EXCLUDED.uses;
+        END IF;
+        RETURN NULL;
+    END IF;
+    IF TG_OP IN ('INSERT', 'UPDATE') THEN
+        added := array(SELECT artist.artistName FROM new_rows JOIN artist ON artist.artistID = new_rows.artistID);
+    END IF;
+    IF TG_OP IN ('UPDATE', 'DELETE') THEN
+        removed := array(SELECT artist.artistName FROM old_rows JOIN artist ON artist.artistID = old_rows.artistID);
+    END IF;
+    PERFORM count_suggestions('artist', added, removed);
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+-- The triggers lock out writes to the tables they are created on until COMMIT, so the counts rebuilt
+-- here can't miss a change made while the upgrade runs
+BEGIN;
+DROP TRIGGER IF EXISTS artist_suggestions_insert ON artist;
+DROP TRIGGER IF EXISTS artist_suggestions_update ON artist;
+DROP TRIGGER IF EXISTS artist_suggestions_delete ON artist;
+DROP TRIGGER IF EXISTS artist_suggestions_truncate ON artist;
+DROP TRIGGER IF EXISTS album_artist_suggestions_insert ON album_artist;
+DROP TRIGGER IF EXISTS album_artist_suggestions_update ON album_artist;
+DROP TRIGGER IF EXISTS album_artist_suggestions_delete ON album_artist;
+DROP TRIGGER IF EXISTS album_artist_suggestions_truncate ON album_artist;
+DROP TRIGGER IF EXISTS album_summary_suggestions_insert ON album_summary;
+DROP TRIGGER IF EXISTS album_summary_suggestions_update ON album_summary;
+DROP TRIGGER IF EXISTS album_summary_suggestions_delete ON album_summary;
+DROP TRIGGER IF EXISTS album_summary_suggestions_truncate ON album_summary;
+DROP TRIGGER IF EXISTS track_suggestions_insert ON track;
+DROP TRIGGER IF EXISTS track_suggestions_update ON track;
+DROP TRIGGER IF EXISTS track_suggestions_delete ON track;
+DROP TRIGGER IF EXISTS track_suggestions_truncate ON track;
+CREATE TRIGGER artist_suggestions_insert AFTER INSERT ON artist REFERENCING NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION artist_suggestions();
+CREATE TRIGGER artist_suggestions_update AFTER UPDATE ON artist REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION artist_suggestions();
+CREATE TRIGGER artist_suggestions_delete AFTER DELETE ON artist REFERENCING OLD TABLE AS old_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION artist_suggestions();
+CREATE TRIGGER artist_suggestions_truncate AFTER TRUNCATE ON artist
+    FOR EACH STATEMENT EXECUTE FUNCTION artist_suggestions();
+CREATE TRIGGER album_artist_suggestions_insert AFTER INSERT ON album_artist REFERENCING NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION artist_suggestions();
+CREATE TRIGGER album_artist_suggestions_update AFTER UPDATE ON album_artist REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION artist_suggestions();
+CREATE TRIGGER album_artist_suggestions_delete AFTER DELETE ON album_artist REFERENCING OLD TABLE AS old_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION artist_suggestions();
+CREATE TRIGGER album_artist_suggestions_truncate AFTER TRUNCATE ON album_artist
+    FOR EACH STATEMENT EXECUTE FUNCTION artist_suggestions();
+CREATE TRIGGER album_summary_suggestions_insert AFTER INSERT ON album_summary REFERENCING NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION row_suggestions('album', 'albumname', 'genre', 'genre');
+CREATE TRIGGER album_summary_suggestions_update AFTER UPDATE ON album_summary REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION row_suggestions('album', 'albumname', 'genre', 'genre');
+CREATE TRIGGER album_summary_suggestions_delete AFTER DELETE ON album_summary REFERENCING OLD TABLE AS old_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION row_suggestions('album', 'albumname', 'genre', 'genre');
+CREATE TRIGGER album_summary_suggestions_truncate AFTER TRUNCATE ON album_summary
+    FOR EACH STATEMENT EXECUTE FUNCTION row_suggestions('album', 'albumname', 'genre', 'genre');
+CREATE TRIGGER track_suggestions_insert AFTER INSERT ON track REFERENCING NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION row_suggestions('track', 'trackname');
+CREATE TRIGGER track_suggestions_update AFTER UPDATE ON track REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION row_suggestions('track', 'trackname');
+CREATE TRIGGER track_suggestions_delete AFTER DELETE ON track REFERENCING OLD TABLE AS old_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION row_suggestions('track', 'trackname');
+CREATE TRIGGER track_suggestions_truncate AFTER TRUNCATE ON track
+    FOR EACH STATEMENT EXECUTE FUNCTION row_suggestions('track', 'trackname');
+SELECT rebuild_suggestions();
+COMMIT;
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS suggestion_prefix_idx ON suggestion (kind, lower(name) text_pattern_ops, uses DESC);
+CREATE INDEX CONCURRENTLY IF NOT EXISTS suggestion_uses_idx ON suggestion (kind, uses DESC, name);
+CREATE INDEX CONCURRENTLY IF NOT EXISTS suggestion_name_trgm_idx ON suggestion USING gist (name gist_trgm_ops);
+
+
+-- New tables need the app role's grants too
+GRANT SELECT, INSERT, UPDATE, DELETE ON ALL TABLES IN SCHEMA public TO library;
+ANALYZE album, album_track, album_thumbnail, album_summary, suggestion;